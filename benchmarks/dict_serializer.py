@@ -0,0 +1,83 @@
+#    Copyright 2012 ClusterPoint, SIA
+#
+#    This file is part of Pycps.
+#
+#    Pycps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Pycps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Pycps.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Documents per second serializing dict documents for insert requests.
+
+    Compares the etree path set_documents used (dict_to_etree, adding the id tag and
+    ET.tostring) with dict_to_xml writing the xml directly, on flat and deeply nested
+    documents, and checks that both give the same strings.
+
+    Usage: python2 benchmarks/dict_serializer.py [documents]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pycps.converters import ET, dict_to_etree, dict_to_xml, _set_id
+
+
+def flat_document(i):
+    document = dict(('field{0}'.format(field), 'value {0} of field {1}'.format(i, field)) for field in range(20))
+    document['field0'] = 'needs <escaping> & {0}'.format(i)
+    return document
+
+
+def nested_document(i, depth=6):
+    document = {'title': 'document {0}'.format(i), 'number': i}
+    for level in range(depth):
+        document = {'level{0}'.format(level): document, 'items': [{'item': n} for n in range(3)],
+                    'note': 'level <{0}>'.format(level)}
+    return document
+
+
+def etree_path(document, doc_id):
+    root = dict_to_etree(document, 'document')
+    _set_id(root, './id'.split('/'), doc_id)
+    return ET.tostring(root, encoding='utf-8')
+
+
+def direct_path(document, doc_id):
+    return dict_to_xml(document, 'document', './id', doc_id)
+
+
+def rate(serialize, documents):
+    start = time.time()
+    for doc_id, document in enumerate(documents):
+        serialize(document, doc_id)
+    return len(documents) / (time.time() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print('{0:>8} {1:>14} {2:>14} {3:>8}'.format('shape', 'etree docs/s', 'direct docs/s', 'speedup'))
+    for name, make in (('flat', flat_document), ('nested', nested_document)):
+        documents = [make(i) for i in range(count)]
+        for doc_id, document in enumerate(documents[:1000]):
+            assert etree_path(document, doc_id) == direct_path(document, doc_id)
+        etree_rate = max(rate(etree_path, documents) for repeat in range(3))
+        direct_rate = max(rate(direct_path, documents) for repeat in range(3))
+        print('{0:>8} {1:>14.0f} {2:>14.0f} {3:>7.1f}x'.format(name, etree_rate, direct_rate,
+                                                              direct_rate / etree_rate))
+
+
+if __name__ == '__main__':
+    main()
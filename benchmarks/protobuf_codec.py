@@ -0,0 +1,107 @@
+#    Copyright 2012 ClusterPoint, SIA
+#
+#    This file is part of Pycps.
+#
+#    Pycps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Pycps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Pycps.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Microbenchmark of the protobuf field codec on response messages up to 100 MB.
+
+    Compares the old decoder, that sliced the rest of the message for every varint,
+    with pycps.protobuf decoding in place, and the old and new varint encoders.
+
+    Usage: python2 benchmarks/protobuf_codec.py
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pycps import protobuf
+
+
+def legacy_to_variant(number):
+    buff = []
+    while number:
+        byte = number % 128
+        number = number // 128
+        if number > 0:
+            byte |= 0x80
+        buff.append(chr(byte))
+    return ''.join(buff)
+
+
+def legacy_from_variant(stream):
+    used = 0
+    number = 0
+    q = 1
+    while True:
+        byte = ord(stream[used])
+        used += 1
+        number += q * (byte & 0x7F)
+        q *= 128
+        if byte & 0x80 == 0:
+            break
+    return (number, used)
+
+
+def legacy_decode_fields(stream):
+    fields = {}
+    offset = 0
+    while offset < len(stream):
+        field_header, used = legacy_from_variant(stream[offset:])
+        offset += used
+        message_lenght, used = legacy_from_variant(stream[offset:])
+        offset += used
+        fields[field_header >> 3] = stream[offset:offset + message_lenght]
+        offset += message_lenght
+    return fields
+
+
+def best_of(function, repeat=3):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def main():
+    print('Decoding a response message (xml field and storage field):')
+    print('{0:>8} {1:>12} {2:>12} {3:>16} {4:>12}'.format('MB', 'legacy ms', 'decode ms', 'decode+copy ms', 'ms/MB'))
+    for megabytes in (1, 10, 100):
+        message = protobuf.encode_fields({protobuf.REQUEST_FIELD: 'x' * (megabytes << 20),
+                                          protobuf.STORAGE_FIELD: 'storage'})
+        view = memoryview(message)
+        legacy = best_of(lambda: legacy_decode_fields(message))
+        decode = best_of(lambda: protobuf.decode_fields(view))
+        copy = best_of(lambda: protobuf.decode_fields(view)[protobuf.REQUEST_FIELD].tobytes())
+        print('{0:>8} {1:>12.3f} {2:>12.4f} {3:>16.3f} {4:>12.4f}'.format(megabytes, legacy * 1000, decode * 1000,
+                                                                       copy * 1000, copy * 1000 / megabytes))
+
+    print('\nDecoding many small fields:')
+    print('{0:>8} {1:>12} {2:>12}'.format('fields', 'legacy ms', 'in place ms'))
+    for count in (5000, 10000, 20000, 40000):
+        message = protobuf.encode_fields(dict((field_id, 'abcdefgh') for field_id in range(1, count + 1)))
+        legacy = best_of(lambda: legacy_decode_fields(message), 1)
+        in_place = best_of(lambda: protobuf.decode_fields(message))
+        print('{0:>8} {1:>12.3f} {2:>12.3f}'.format(count, legacy * 1000, in_place * 1000))
+
+    print('\nEncoding 100000 varints:')
+    numbers = [1 << (i % 35) for i in range(100000)]
+    print('{0:>22} {1:>10.3f} ms'.format('legacy', best_of(lambda: [legacy_to_variant(n) for n in numbers]) * 1000))
+    print('{0:>22} {1:>10.3f} ms'.format('encode_varint', best_of(lambda: [protobuf.encode_varint(n) for n in numbers]) * 1000))
+
+
+if __name__ == '__main__':
+    main()
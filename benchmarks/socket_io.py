@@ -0,0 +1,192 @@
+#    Copyright 2012 ClusterPoint, SIA
+#
+#    This file is part of Pycps.
+#
+#    Pycps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Pycps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Pycps.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Compare the old string slicing socket transport with the buffer based one.
+
+    Sends and recieves framed messages of several sizes over a local socket pair and
+    reports bytes copied in Python per message byte and the time per MB.
+
+    Usage: python2 benchmarks/socket_io.py
+"""
+
+from __future__ import print_function
+
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pycps
+from pycps.connection import _SEND_JOIN_LIMIT
+from pycps.protobuf import encode_fields, make_header
+
+
+class Counter(object):
+    copied = 0
+
+
+def legacy_send(sock, xml_request, counter):
+    """ The transport before buffers: one joined message, resliced on every partial send."""
+    encoded_message = encode_fields({1: xml_request, 2: 'storage'})
+    counter.copied += len(encoded_message)
+    data = make_header(len(encoded_message)) + encoded_message
+    counter.copied += len(data)
+    sent_bytes = 0
+    while sent_bytes < len(data):
+        remaining = data[sent_bytes:]
+        if sent_bytes:
+            counter.copied += len(remaining)
+        sent_bytes += sock.send(remaining)
+
+
+def legacy_recieve(sock, counter):
+    def socket_recieve(lenght):
+        chunks = []
+        total = 0
+        while total < lenght:
+            chunk = sock.recv(lenght - total)
+            counter.copied += len(chunk)
+            chunks.append(chunk)
+            total += len(chunk)
+        counter.copied += lenght
+        return ''.join(chunks)
+
+    def from_variant(stream):
+        counter.copied += len(stream)   # Every call gets a copy of the rest of the message.
+        used = number = 0
+        q = 1
+        while True:
+            byte = ord(stream[used])
+            used += 1
+            number += q * (byte & 0x7F)
+            q *= 128
+            if byte & 0x80 == 0:
+                return number, used
+
+    header = socket_recieve(8)
+    lenght = ord(header[4]) | (ord(header[5]) << 8) | (ord(header[6]) << 16) | (ord(header[7]) << 24)
+    stream = socket_recieve(lenght)
+    fields = {}
+    offset = 0
+    while offset < lenght:
+        field_header, used = from_variant(stream[offset:])
+        offset += used
+        message_lenght, used = from_variant(stream[offset:])
+        offset += used
+        fields[field_header >> 3] = stream[offset:offset + message_lenght]
+        counter.copied += message_lenght
+        offset += message_lenght
+    return fields[1]
+
+
+class CountingSocket(object):
+    """ Socket wrapper counting bytes written into Python memory by recv_into."""
+    def __init__(self, sock, counter):
+        self._sock = sock
+        self._counter = counter
+
+    def send(self, data):
+        return self._sock.send(data)
+
+    def settimeout(self, timeout):
+        self._sock.settimeout(timeout)
+
+    def recv_into(self, buffer):
+        recieved = self._sock.recv_into(buffer)
+        self._counter.copied += recieved
+        return recieved
+
+
+def make_connection(sock):
+    connection = pycps.Connection.__new__(pycps.Connection)
+    connection._storage = 'storage'
+    connection._recv_buffer = None
+    connection._deadline = None
+    connection._connection = sock
+    return connection
+
+
+def drain(sock, total):
+    buffer = bytearray(1 << 20)
+    while total > 0:
+        total -= sock.recv_into(buffer)
+
+
+def feed(sock, message, count):
+    for i in range(count):
+        sock.sendall(message)
+
+
+def bench(size, repeat):
+    payload = 'x' * size
+    message = ''.join(make_connection(None)._encode_socket_request(payload))
+    results = {}
+    for name in ('legacy', 'buffers'):
+        counter = Counter()
+        client, server = socket.socketpair()
+        connection = make_connection(CountingSocket(client, counter))
+        # Send direction.
+        reader = threading.Thread(target=drain, args=(server, len(message) * repeat))
+        reader.start()
+        start = time.time()
+        for i in range(repeat):
+            if name == 'legacy':
+                legacy_send(client, payload, counter)
+            else:
+                connection._socket_send(connection._encode_socket_request(payload))
+                if len(message) <= _SEND_JOIN_LIMIT:
+                    counter.copied += len(message)  # Small messages are joined before sending.
+        reader.join()
+        send_time = time.time() - start
+        send_copied = counter.copied
+        # Recieve direction.
+        counter.copied = 0
+        writer = threading.Thread(target=feed, args=(server, message, repeat))
+        writer.start()
+        start = time.time()
+        for i in range(repeat):
+            if name == 'legacy':
+                response = legacy_recieve(client, counter)
+            else:
+                response = connection._recieve_socket_response()
+                counter.copied += len(response)
+        writer.join()
+        recieve_time = time.time() - start
+        assert len(response) == size
+        client.close()
+        server.close()
+        megabytes = float(size * repeat) / (1 << 20)
+        results[name] = (float(send_copied) / (size * repeat), send_time * 1000 / megabytes,
+                         float(counter.copied) / (size * repeat), recieve_time * 1000 / megabytes)
+    return results
+
+
+def main():
+    print('{0:>10} {1:>8} | {2:>12} {3:>10} | {4:>12} {5:>10}'.format(
+          'size', 'mode', 'send copies', 'send ms/MB', 'recv copies', 'recv ms/MB'))
+    for size, repeat in ((4096, 2000), (1 << 20, 40), (16 << 20, 4), (64 << 20, 2)):
+        results = bench(size, repeat)
+        for name in ('legacy', 'buffers'):
+            print('{0:>10} {1:>8} | {2:>11.2f}x {3:>10.2f} | {4:>11.2f}x {5:>10.2f}'.format(
+                  size, name, *results[name]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#    Copyright 2012 ClusterPoint, SIA
+#
+#    This file is part of Pycps.
+#
+#    Pycps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Pycps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Pycps.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Documents per second preparing pre-rendered xml string documents for insert requests.
+
+    Compares parsing every string, adding the id tag and serializing it again, as set_documents
+    used to, with set_documents splicing the id tag into the string, for documents with the
+    root tag and for ones it has to wrap in the root tag.
+
+    Usage: python2 benchmarks/string_documents.py [documents]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pycps
+from pycps.converters import ET, to_etree, to_raw_xml, _set_id
+
+
+def make_connection():
+    connection = pycps.Connection.__new__(pycps.Connection)
+    connection.document_root_xpath = 'document'
+    connection.document_id_xpath = './id'
+    return connection
+
+
+def parsed_path(documents):
+    for doc_id, document in documents:
+        document = to_etree(document, 'document')
+        if document.tag != 'document':
+            root = ET.Element('document')
+            root.append(document)
+            document = root
+        _set_id(document, './id'.split('/'), doc_id)
+        to_raw_xml(document)
+
+
+def spliced_path(documents):
+    pycps.Request(make_connection(), 'insert').set_documents(documents)
+
+
+def rate(prepare, documents):
+    start = time.time()
+    prepare(documents)
+    return len(documents) / (time.time() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    body = ''.join('<field{0}>value of field {0}</field{0}>'.format(field) for field in range(20))
+    print('{0:>10} {1:>15} {2:>15} {3:>8}'.format('shape', 'parsed docs/s', 'spliced docs/s', 'speedup'))
+    for name, template in (('root', '<document>{0}</document>'), ('wrapped', '<item>{0}</item>')):
+        documents = [(str(i), template.format(body)) for i in range(count)]
+        parsed = max(rate(parsed_path, documents) for repeat in range(3))
+        spliced = max(rate(spliced_path, documents) for repeat in range(3))
+        print('{0:>10} {1:>15.0f} {2:>15.0f} {3:>7.1f}x'.format(name, parsed, spliced, spliced / parsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#    Copyright 2012 ClusterPoint, SIA
+#
+#    This file is part of Pycps.
+#
+#    Pycps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Pycps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Pycps.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Client request throughput and latency against the bundled fake CPS server.
+
+    Runs retrieve requests sequentially, from threads over a ConnectionPool, pipelined and
+    through an AsyncConnection, over tcp and http, with the given server side latency and
+    response padding.
+
+    Usage: python2 benchmarks/throughput.py [requests] [latency seconds] [padding bytes]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pycps
+from pycps.fakeserver import FakeServer
+
+
+def percentile(latencies, fraction):
+    latencies = sorted(latencies)
+    return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)]
+
+
+def sequential(server, scheme, count):
+    connection = server.connection(scheme)
+    latencies = []
+    for i in range(count):
+        start = time.time()
+        connection.retrieve(str(i % 100))
+        latencies.append(time.time() - start)
+    connection.close()
+    return latencies
+
+
+def pooled(server, scheme, count, threads=8):
+    connection = server.connection(scheme, pycps.ConnectionPool, max_connections=threads)
+    latencies = []
+
+    def work(offset):
+        for i in range(offset, count, threads):
+            start = time.time()
+            connection.retrieve(str(i % 100))
+            latencies.append(time.time() - start)
+    workers = [threading.Thread(target=work, args=(offset,)) for offset in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    connection.close()
+    return latencies
+
+
+def pipelined(server, scheme, count):
+    connection = server.connection(scheme)
+    start = time.time()
+    connection.pipeline([pycps.RetrieveRequest(connection, str(i % 100)) for i in range(count)])
+    connection.close()
+    return [(time.time() - start) / count] * count
+
+
+def asynchronous(server, scheme, count):
+    connection = server.connection(scheme, pycps.AsyncConnection)
+    start = time.time()
+    futures = [connection.retrieve(str(i % 100)) for i in range(count)]
+    connection.run()
+    for future in futures:
+        future.result()
+    return [(time.time() - start) / count] * count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.001
+    padding = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    server = FakeServer(latency=latency, response_padding=padding).start()
+    server.connection().insert(dict((str(i), {'title': 'document {0}'.format(i)}) for i in range(100)))
+    print('{0} requests, {1} s server latency, {2} bytes padding'.format(count, latency, padding))
+    print('{0:>6} {1:>14} {2:>10} {3:>10} {4:>10}'.format('scheme', 'mode', 'req/s', 'p50 ms', 'p99 ms'))
+    for scheme in ('tcp', 'http'):
+        for name, run in (('sequential', sequential), ('pool x8', pooled), ('pipeline', pipelined),
+                          ('async', asynchronous)):
+            start = time.time()
+            latencies = run(server, scheme, count)
+            elapsed = time.time() - start
+            print('{0:>6} {1:>14} {2:>10.0f} {3:>10.2f} {4:>10.2f}'.format(
+                  scheme, name, count / elapsed, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000))
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
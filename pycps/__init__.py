@@ -38,9 +38,17 @@ from errors import *
 from converters import *
 from utils import *
 from connection import *
+from pool import *
+from asynchronous import *
+from cluster import *
 from request import *
 from response import *
+from bulk import *
+from batching import *
+from cache import *
 import query
+import protobuf
+import fakeserver
 
 
 try:
@@ -64,9 +72,17 @@ if __name__ == '__main__':
     import converters
     import utils
     import connection
+    import pool
+    import asynchronous
+    import cluster
     import request
     import response
+    import bulk
+    import batching
+    import cache
     import query
+    import protobuf
+    import fakeserver
 
     def doctest_a_module(module):
         Debug.warn("Running doctests on {0} module ...".format(module.__name__))
@@ -79,6 +95,11 @@ if __name__ == '__main__':
 
     doctest_a_module(converters)
     doctest_a_module(query)
+    doctest_a_module(request)
+    doctest_a_module(protobuf)
+    doctest_a_module(batching)
+    doctest_a_module(cache)
+    doctest_a_module(bulk)
 
 # Rudimentary functional tests using a CP server running on a local VBox instance.
     import re
@@ -122,6 +143,11 @@ if __name__ == '__main__':
         vbox_string = subprocess.check_output(["VBoxManage", "guestproperty", "enumerate", "CPS2"])
     except:
         Debug.fail("Can't find VBox for testing!")
+        for scheme in ('tcp', 'http'):
+            Debug.warn("Running functests with a local fake server over {0} ...".format(scheme))
+            with fakeserver.FakeServer(document_root_xpath='page') as server:
+                test(server.connection(scheme))
+            Debug.ok("FUNCTESTS PASSED!")
     else:
         try:
             index = vbox_string.find("/VirtualBox/GuestInfo/Net/0/V4/I")
@@ -133,3 +159,236 @@ if __name__ == '__main__':
             t=Connection("tcp://{0}:{1}".format(ip_string,5550), 'test_storage', 'root', 'password', document_root_xpath='page')
             test(t)
             Debug.ok("FUNCTESTS PASSED!")
+
+# Client side error handling tests, with a local fake server that can misbehave on purpose.
+    import threading
+
+    def test_parallel_load_unpicklable(server):
+        for queue_size in (1, 10):
+            documents = [('{0}-{1}'.format(queue_size, i), {'lock': threading.Lock()} if i == 12 else {'title': 'doc'})
+                         for i in range(30)]
+            try:
+                bulk.parallel_load(server.connection, documents, chunk_size=10, queue_size=queue_size, workers=2)
+            except ParameterError:
+                pass
+            else:
+                raise AssertionError("parallel_load didn't raise for a document that can't be pickled")
+
+    def test_retry_after_dropped_response(server):
+        connection = server.connection('tcp')
+        connection.insert(dict((str(i), {'title': 'old'}) for i in range(10)))
+        dropped = []
+        server.drop = lambda command: command == 'update' and not dropped and not dropped.append(command)
+        result = bulk.modify_with_retry(connection, 'update', dict((str(i), {'title': 'new'}) for i in range(10)),
+                                        retries=1)
+        assert not result['failed'] and len(result['modified']) == 10, result
+        assert server.requests['update'] == 2, server.requests
+        server.reset = True     # The plain socket transport sees a reset connection as a socket error.
+        dropped[:] = []
+        result = bulk.modify_with_retry(connection, 'update', dict((str(i), {'title': 'newer'}) for i in range(10)),
+                                        retries=1)
+        assert not result['failed'] and len(result['modified']) == 10, result
+        assert server.requests['update'] == 4, server.requests
+
+    def test_coalesced_future_of_failed_batch(server):
+        connection = server.connection('tcp')
+        connection.insert({'1': {'title': 'old'}, '2': {'title': 'old'}})
+        server.drop = lambda command: command == 'replace'
+        outcomes = []
+        with bulk.CoalescingWriter(connection, max_age=60) as writer:
+            writer.replace('1', {'title': 'replaced'}).add_done_callback(
+                lambda future: outcomes.append(future.exception(0) or future.result(0)))
+            failed = writer.replace('2', {'title': 'replaced'})
+            updated = writer.update('1', {'title': 'updated'})     # Coalesced into an update of '1'.
+        assert isinstance(failed.exception(0), ConnectionError), failed.exception(0)
+        assert updated.result(0) is True and outcomes == [True], outcomes
+
+    def test_coalesced_delete_of_new_document(server):
+        connection = server.connection('tcp')
+        for retries in (0, 1):
+            with bulk.CoalescingWriter(connection, max_age=60, retries=retries) as writer:
+                futures = [writer.insert('new', {'title': 'new'}), writer.delete('new'),
+                           writer.update('upserted', {'title': 'new'}), writer.delete('upserted')]
+                missing = writer.delete('missing')
+            assert [future.result(0) for future in futures] == [True] * 4, futures
+            assert isinstance(missing.exception(0), APIError), missing.exception(0)
+        assert not server.documents and server.requests['delete'] == 2, server.requests
+
+    def test_import_file_self_closing_document(server):
+        import os
+        import tempfile
+        connection = server.connection('tcp')
+        for content, error in (('<documents><document><id>1</id></document>\n<document><id>2</id></document></documents>',
+                                None),
+                               ('<document><id>3</id></document><document/><document><id>4</id></document>', XMLError),
+                               ('<document><id>5</id></document>\n<document />\n', XMLError)):
+            descriptor, path = tempfile.mkstemp(suffix='.xml')
+            try:
+                os.write(descriptor, content)
+                os.close(descriptor)
+                try:
+                    stats = bulk.import_file(connection, path)
+                except XMLError:
+                    assert error is XMLError, content
+                else:
+                    assert error is None and stats['documents'] == stats['modified'] == 2, stats
+            finally:
+                os.remove(path)
+        assert list(server.documents) == ['1', '2', '5'], list(server.documents)   # 5 was sent before the error.
+
+    def test_cache_invalidated_by_pipelined_writes(server):
+        for connection in (server.connection('tcp', cache=ResponseCache()),
+                           server.connection('tcp', ConnectionPool, cache=ResponseCache())):
+            connection.clear()
+            list(connection.insert_iter((str(i), {'title': 'old'}) for i in range(10)))
+            assert connection.search('old').hits == 10
+            list(connection.update_iter(((str(i), {'title': 'new'}) for i in range(5)), chunk_size=2))
+            assert connection.search('old').hits == 5
+            connection.delete([str(i) for i in range(5, 10)], chunk_size=2)
+            assert connection.search('old').hits == 0
+            assert connection.cache.hits == 0 and connection.cache.invalidations == 2, connection.cache.invalidations
+
+    def test_pipeline_after_timeout(server):
+        connection = server.connection('tcp')
+        server.latency = 0.3
+        try:
+            connection.status(deadline=0.05)
+        except TimeoutError:
+            pass
+        else:
+            raise AssertionError("status() didn't time out")
+        server.latency = 0
+        assert len(connection.pipeline([Request(connection, 'status') for i in range(3)])) == 3
+
+    def test_pipeline_partly_sent(server):
+        import socket
+        unresponsive = socket.socket()  # Accepts connections in the backlog, never reads.
+        unresponsive.bind(('127.0.0.1', 0))
+        unresponsive.listen(5)
+        connection = Connection('tcp://127.0.0.1:{0}'.format(unresponsive.getsockname()[1]), server.storage,
+                                'user', 'password', 'account', deadline=0.2)
+        request = Request(connection, 'insert')
+        request.set_documents({'1': {'text': 'x' * (32 << 20)}})    # More than the socket buffers take.
+        try:
+            connection.pipeline([request])
+        except TimeoutError:
+            pass
+        else:
+            raise AssertionError("pipeline() didn't time out")
+        try:
+            closed = connection._connection.fileno() == -1
+        except socket.error:
+            closed = True
+        assert closed, "The socket with a partly sent request wasn't closed"
+        unresponsive.close()
+
+    def test_cluster_probe_doesnt_block(server):
+        import socket
+        import time
+        unresponsive = socket.socket()  # Accepts connections in the backlog, never answers.
+        unresponsive.bind(('127.0.0.1', 0))
+        unresponsive.listen(5)
+        connection = ClusterConnection([server.url('tcp'), 'tcp://127.0.0.1:{0}'.format(unresponsive.getsockname()[1])],
+                                       server.storage, 'user', 'password', 'account', retry_interval=0,
+                                       probe_timeout=1, policy='round-robin')
+        connection._nodes[1].ejected = True     # Due to be probed by the first request.
+        start = time.time()
+        for i in range(5):
+            connection.status()
+        assert time.time() - start < 0.5, time.time() - start
+        time.sleep(1.5)
+        assert connection.nodes[1]['available'] is False and not connection._nodes[1].probing
+        unresponsive.close()
+
+    def test_cluster_busy_node_not_ejected(server):
+        connection = ClusterConnection([server.url('tcp')], server.storage, 'user', 'password', 'account',
+                                       max_connections=1, pool_timeout=0.05)
+        node = connection._nodes[0]
+        held = node.pool._checkout()
+        try:
+            connection.status()
+        except ConnectionError as e:
+            assert not isinstance(e, TransportError), e
+        else:
+            raise AssertionError("status() didn't fail on an exhausted pool")
+        node.pool._checkin(held)
+        assert not node.ejected and connection.status()
+
+    def test_keyset_non_ascii_query(server):
+        connection = server.connection('tcp')
+        connection.insert({'1': {'title': u'\u0101 word'}, '2': {'title': u'\u0101 wordy'}, '3': {'title': u'other'}})
+        for query in (u'\u0101', u'\u0101'.encode('utf-8')):    # Unicode and utf-8 encoded byte string queries.
+            cursor = connection.iter_keyset(query, key_xpath='./title', page_size=1, doc_format='string')
+            assert next(cursor)[0] == '1'
+            cursor.close()
+            resumed = connection.iter_keyset(query, key_xpath='./title', page_size=1, doc_format='string',
+                                             cursor=cursor.token)
+            assert [doc_id for doc_id, document in resumed] == ['2'], cursor.token
+
+    def test_closed_pool(server):
+        pool = ConnectionPool(server.url('tcp'), server.storage, 'user', 'password', 'account')
+        pool.status()
+        pool.close()
+        try:
+            pool.status()
+        except ConnectionError as e:
+            assert 'closed' in str(e), e
+        else:
+            raise AssertionError("A closed pool sent a request")
+        assert pool._size == 0, pool._size
+
+    def test_stop_closes_clients(server):
+        import threading
+        threads = threading.active_count()
+        connections = [server.connection('tcp'), server.connection('http')]
+        for connection in connections:
+            connection.status()
+        server.stop()
+        assert threading.active_count() == threads - 2, (threads, threading.active_count())
+
+    def test_async_http_chunked_responses(server):
+        import socket
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+
+        def serve(chunk_size_line):    # Answers one request with a chunked body, chunk_size_line formats a chunk's size.
+            client = listener.accept()[0]
+            head = ''
+            while '\r\n\r\n' not in head:
+                head += client.recv(65536)
+            head, body = head.split('\r\n\r\n', 1)
+            lenght = int(re.search(r'Content-Length: (\d+)', head).group(1))
+            while len(body) < lenght:
+                body += client.recv(65536)
+            response = server.handle_request(body)
+            chunks = [response[i:i + 7] for i in range(0, len(response), 7)]
+            client.sendall('HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n' +
+                           ''.join(chunk_size_line(len(chunk)) + '\r\n' + chunk + '\r\n' for chunk in chunks) +
+                           '0\r\n\r\n')
+            client.close()
+
+        url = 'http://127.0.0.1:{0}'.format(listener.getsockname()[1])
+        for chunk_size_line, error in ((lambda size: '{0:x};ext=1'.format(size), None),
+                                       (lambda size: 'zz', ConnectionError)):
+            thread = threading.Thread(target=serve, args=(chunk_size_line,))
+            thread.start()
+            connection = AsyncConnection(url, server.storage, 'user', 'password', 'account')
+            future = connection.status()
+            if error is None:
+                future.result(5)
+            else:
+                assert isinstance(future.exception(5), error), future.exception(5)
+            connection.close()
+            thread.join()
+        listener.close()
+
+    for client_test in (test_parallel_load_unpicklable, test_retry_after_dropped_response,
+                        test_coalesced_future_of_failed_batch, test_coalesced_delete_of_new_document,
+                        test_import_file_self_closing_document, test_cache_invalidated_by_pipelined_writes, test_pipeline_after_timeout,
+                        test_pipeline_partly_sent, test_cluster_probe_doesnt_block, test_cluster_busy_node_not_ejected,
+                        test_keyset_non_ascii_query, test_closed_pool, test_stop_closes_clients, test_async_http_chunked_responses):
+        Debug.warn("Running {0} with a local fake server ...".format(client_test.__name__))
+        with fakeserver.FakeServer() as server:
+            client_test(server)
+        Debug.ok("CLIENT TESTS PASSED!")
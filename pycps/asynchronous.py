@@ -0,0 +1,579 @@
+#    Copyright 2012 ClusterPoint, SIA
+#
+#    This file is part of Pycps.
+#
+#    Pycps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Pycps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Pycps.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import errno
+import functools
+import itertools
+import select
+import socket
+import time
+import zlib
+
+from connection import *
+from connection import _response_from_fields, _iter_gzip_chunks, _page_end, _GZIP_WBITS, _NOT_RESENT_COMMANDS
+
+
+class ResponseFuture(Future):
+    """ Future of a Response object for a request sent through an AsyncConnection.
+
+        Attributes:
+            request -- The Request object this future is for.
+            deadline -- Monotonic time the response must be recieved by or None.
+            raw_response -- The raw xml response string once it's recieved or None.
+    """
+    def __init__(self, connection, request, deadline=None):
+        Future.__init__(self)
+        self._async_connection = connection
+        self.request = request
+        self.deadline = deadline
+        self.raw_response = None
+
+    def result(self, timeout=None):
+        """ Run the connection's event loop until the response is recieved and return it.
+
+            Keyword args:
+                timeout -- Seconds to wait for the response. Default is None - wait forever.
+
+            Raises:
+                RuntimeError -- The response is not recieved in timeout seconds.
+                Any error raised by the request or while parsing the response.
+        """
+        self._async_connection.run(timeout, until=self)
+        return Future.result(self, 0)
+
+
+class AsyncConnection(Connection):
+    """ Connection that multiplexes many requests over non-blocking sockets in a single thread.
+
+        Has the same API as Connection, but every command returns a ResponseFuture right away.
+        Requests are sent over up to max_connections sockets while the event loop runs -
+        by calling run() or poll(), or by waiting on a future's result().
+        The same 8 byte header and protobuf field framing is used for unix and tcp schemes and
+        HTTP/1.1 with keep-alive for the http scheme.
+
+        .. note:: Not thread-safe, use it from the thread that runs its event loop.
+
+        >>> con = AsyncConnection('tcp://127.0.0.1:5550', 'storage', 'user', 'password', 'account')  # doctest: +SKIP
+        >>> futures = [con.search(query.term(word, 'title')) for word in words]  # doctest: +SKIP
+        >>> con.run()  # doctest: +SKIP
+        >>> hits = [future.result().hits for future in futures]  # doctest: +SKIP
+    """
+
+    def __init__(self, url, storage, user, password, account, max_connections=16, **kwargs):
+        """ Create a new asynchronous connection to CPS. Sockets are opened when requests are sent.
+
+            Args:
+                See Connection.__init__().
+
+            Keyword args:
+                max_connections -- Maximum number of sockets with requests in flight. Default is 16.
+                See Connection.__init__().
+        """
+        if max_connections < 1:
+            raise ParameterError("max_connections={0}".format(max_connections))
+        self._max_connections = max_connections
+        self._channels = []
+        self._queue = collections.deque()   # (future, xml_request) pairs waiting for a free channel.
+        Connection.__init__(self, url, storage, user, password, account, **kwargs)
+
+    def _open_connection(self):
+        pass
+
+    def close(self):
+        """ Close all sockets, failing requests that are still in flight or queued."""
+        for channel in list(self._channels):
+            channel.close(ConnectionError("Connection closed."))
+        while self._queue:
+            self._queue.popleft()[0].set_exception(ConnectionError("Connection closed."))
+
+    def _execute(self, request, xml_request):
+        future = ResponseFuture(self, request, self._make_deadline(request.deadline))
+        if self.cache is not None and not request.stream:
+            raw_response, ticket = self.cache.lookup(request._command, xml_request)
+            if raw_response is not None:
+                try:
+                    future.set_result(request.handle_response(raw_response))
+                except Exception as e:
+                    future.set_exception(e)
+                return future
+            if ticket is not None:
+                future.add_done_callback(lambda future: self._complete_cached(ticket, future))
+        self._queue.append((future, xml_request))
+        return future
+
+    def _complete_cached(self, ticket, future):
+        """ Store the raw response of a completed future in the cache. See Connection._send_cached()."""
+        failed = future._exception is not None or future._result.errors
+        self.cache.complete(ticket, None if failed else future.raw_response)
+
+    def _send_request(self, xml_request, deadline=None):
+        raise ConnectionError("AsyncConnection can't send blocking requests.")
+
+    def pipeline(self, requests, lazy=False, depth=None):
+        """ Send several requests at once. See Connection.pipeline().
+
+            Returns:
+                A list of ResponseFuture objects matching the requests.
+        """
+        return [request.send() for request in requests]
+
+    def _send_chunks(self, requests, merge):
+        """ Queue the chunks of a split request. See Connection._send_chunks().
+
+            Returns:
+                A ResponseFuture of the merged response.
+        """
+        return self._merge_chunks([request.send() for request in requests], merge)
+
+    def _merge_chunks(self, futures, merge):
+        """ Merge the futures of a split request's chunks into one ResponseFuture. See Connection._merge_chunks()."""
+        futures = list(futures)
+        merged = ResponseFuture(self, futures[0].request)
+        remaining = [len(futures)]
+
+        def done(future):
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+            try:
+                merged.set_result(merge([Future.result(future, 0) for future in futures]))
+            except Exception as e:
+                merged.set_exception(e)
+        for future in futures:
+            future.add_done_callback(done)
+        return merged
+
+    def _send_adaptive(self, make_request, items, sizer, depth):
+        """ Send all chunks of the items at once, in chunks of the sizer's current size.
+            Responses are recorded in the sizer as they complete, so later calls use the adapted size.
+            As chunks wait for each other, a chunk's wall time is counted from the previous chunk's
+            completion, the time the connections spent on it. See Connection._send_adaptive().
+
+            Returns:
+                A list of ResponseFuture objects.
+        """
+        items = iter(items)
+        size = sizer.size
+        futures = []
+        last_completed = [monotonic()]
+        while True:
+            chunk = list(itertools.islice(items, size))
+            if not chunk:
+                return futures
+            request = make_request(chunk)
+            payload_bytes = sum(len(document) for document in request._documents)
+            future = request.send()
+            future.add_done_callback(functools.partial(self._record_chunk, sizer, len(chunk), payload_bytes,
+                                                       last_completed))
+            futures.append(future)
+
+    def _record_chunk(self, sizer, documents, payload_bytes, last_completed, future):
+        now = monotonic()
+        wall_seconds, last_completed[0] = now - last_completed[0], now
+        exception = Future.exception(future, 0)
+        if isinstance(exception, TimeoutError):
+            sizer.record_failure()
+        elif exception is None:
+            sizer.record(documents, wall_seconds, Future.result(future, 0).seconds, payload_bytes)
+
+    def _fetch_pages(self, make_request, page_size, prefetch, offset):
+        """ Get the responses to the pages of a result set, keeping prefetch requests ahead of the one
+            being waited for. See Connection._fetch_pages().
+        """
+        futures = collections.deque()
+        position = offset
+        end = None
+        while True:
+            while len(futures) <= prefetch and (end is None or position < end):
+                futures.append((position, make_request(page_size, position).send()))
+                position += page_size
+            if not futures:
+                return
+            page_offset, future = futures.popleft()
+            response = future.result()
+            end = _page_end(response, page_offset)
+            if end is None:
+                return
+            yield response
+            if page_offset + page_size >= end:
+                return
+
+    def _fetch_keyset_pages(self, make_request, key_xpath, key, prefetch):
+        """ Request every page when the previous one is recieved, without a thread. See Connection._fetch_keyset_pages()."""
+        return Connection._fetch_keyset_pages(self, make_request, key_xpath, key, 0)
+
+    def _scan(self, requests, parallelism, ordered):
+        """ Keep parallelism requests of a scan in flight. See Connection._scan()."""
+        requests = enumerate(requests)
+        futures = []
+        while True:
+            futures.extend((index, request.send())
+                           for index, request in itertools.islice(requests, parallelism - len(futures)))
+            if not futures:
+                return
+            if ordered:
+                pair = futures[0]
+            else:
+                while not any(future.done() for index, future in futures):
+                    self.poll(1.0)
+                pair = next(pair for pair in futures if pair[1].done())
+            futures.remove(pair)
+            yield pair[0], pair[1].result()
+
+    @property
+    def pending(self):
+        """ Number of requests queued or in flight."""
+        return len(self._queue) + len([channel for channel in self._channels if channel.future is not None])
+
+    def _start_queued(self):
+        """ Hand queued requests to idle channels, opening new ones if allowed."""
+        while self._queue:
+            idle = [channel for channel in self._channels if channel.future is None]
+            if idle:
+                channel = idle[0]
+            elif len(self._channels) < self._max_connections:
+                future, xml_request = self._queue[0]
+                try:
+                    channel = (_HTTPChannel(self) if self._scheme == 'http' else _SocketChannel(self))
+                except socket.error as e:
+                    self._queue.popleft()
+                    future.set_exception(TransportError(str(e)))
+                    continue
+                self._channels.append(channel)
+            else:
+                break
+            future, xml_request = self._queue.popleft()
+            channel.start(future, xml_request)
+
+    def poll(self, timeout=0):
+        """ Run one round of the event loop - send and recieve whatever the sockets are ready for.
+
+            Keyword args:
+                timeout -- Seconds to wait for a socket to get ready. Default is 0.
+
+            Returns:
+                False if there are no requests queued or in flight, True otherwise.
+        """
+        self._expire()
+        self._start_queued()
+        busy = [channel for channel in self._channels if channel.future is not None]
+        if not busy:
+            return False
+        readers = [channel for channel in busy if channel.readable()]
+        writers = [channel for channel in busy if channel.writable()]
+        deadlines = [channel.future.deadline for channel in busy if channel.future.deadline is not None]
+        if deadlines:   # Wake up in time to fail the request.
+            left = max(min(deadlines) - monotonic(), 0)
+            if timeout is None or left < timeout:
+                timeout = left
+        try:
+            readable, writable, _ = select.select(readers, writers, [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return True
+            raise
+        for channel in writable:
+            channel.handle_write()
+        for channel in readable:
+            if channel.future is not None:
+                channel.handle_read()
+        self._expire()
+        self._start_queued()
+        return True
+
+    def _expire(self):
+        """ Fail the queued and in flight requests whose deadline has passed, closing their sockets."""
+        now = monotonic()
+        for channel in list(self._channels):
+            if channel.future is not None and channel.future.deadline is not None and channel.future.deadline <= now:
+                channel.close(TimeoutError("The deadline passed before the response was recieved."))
+        if any(future.deadline is not None and future.deadline <= now for future, xml_request in self._queue):
+            queue = self._queue
+            self._queue = collections.deque()
+            for future, xml_request in queue:
+                if future.deadline is not None and future.deadline <= now:
+                    future.set_exception(TimeoutError("The deadline passed before the request was sent."))
+                else:
+                    self._queue.append((future, xml_request))
+
+    def run(self, timeout=None, until=None):
+        """ Run the event loop until all requests are completed.
+
+            Keyword args:
+                timeout -- Maximum number of seconds to run. Default is None - no limit.
+                until -- A future, if given the loop stops as soon as it is completed.
+        """
+        end_time = (time.time() + timeout if timeout is not None else None)
+        while until is None or not until.done():
+            remaining = None
+            if end_time is not None:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    break
+            if not self.poll(remaining if remaining is not None else 1.0):
+                break
+
+
+class _Channel(object):
+    """ A non-blocking socket of an AsyncConnection carrying one request at a time."""
+
+    def __init__(self, connection, family, address):
+        self.connection = connection
+        self.future = None
+        self._socket = socket.socket(family, socket.SOCK_STREAM)
+        self._socket.setblocking(0)
+        self._connected = False
+        error = self._socket.connect_ex(address)
+        if error in (0, errno.EISCONN):
+            self._connected = True
+        elif error not in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            self._socket.close()
+            raise socket.error(error, errno.errorcode.get(error, 'connect failed'))
+        self._out = ''
+        self._out_offset = 0
+        self._in_chunks = []
+        self._in_size = 0
+        self._xml_request = None
+        self._requests_started = 0
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def start(self, future, xml_request):
+        self.future = future
+        self._xml_request = xml_request
+        self._requests_started += 1
+        self._out = self.encode_request(xml_request)
+        self._out_offset = 0
+        self.reset_reader()
+
+    def readable(self):
+        return self._connected and self._out_offset >= len(self._out)
+
+    def writable(self):
+        return not self._connected or self._out_offset < len(self._out)
+
+    def handle_write(self):
+        if not self._connected:
+            error = self._socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self.close(TransportError(errno.errorcode.get(error, 'connect failed')))
+                return
+            self._connected = True
+        try:
+            self._out_offset += self._socket.send(self._out[self._out_offset:self._out_offset + 65536])
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.close(TransportError(str(e)))
+
+    def handle_read(self):
+        try:
+            chunk = self._socket.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.close(TransportError(str(e)))
+            return
+        if not chunk:
+            self.handle_eof()
+            return
+        self._in_chunks.append(chunk)
+        self._in_size += len(chunk)
+        try:
+            self.parse()
+        except CPSError as e:
+            self.close(e)
+
+    def handle_eof(self):
+        self.close(TransportError("Connection closed by the server."))
+
+    def take(self, size):
+        """ Remove and return size bytes from the recieved data, or None if not enough recieved yet."""
+        if self._in_size < size:
+            return None
+        data = ''.join(self._in_chunks)
+        self._in_chunks = [data[size:]] if size < len(data) else []
+        self._in_size -= size
+        return data[:size]
+
+    def finish(self, response):
+        """ Complete the current request with the raw xml response string."""
+        future, self.future = self.future, None
+        future.raw_response = response
+        try:
+            future.set_result(future.request.handle_response(response))
+        except Exception as e:
+            future.set_exception(e)
+
+    def close(self, exception):
+        self._socket.close()
+        if self in self.connection._channels:
+            self.connection._channels.remove(self)
+        future, self.future = self.future, None
+        if future is not None:
+            if (self._requests_started > 1 and not self._in_size and isinstance(exception, ConnectionError)
+                    and not isinstance(exception, TimeoutError)
+                    and future.request._command not in _NOT_RESENT_COMMANDS):
+                # A reused socket may have been closed by the server while idle, resend on a new one.
+                self.connection._queue.appendleft((future, self._xml_request))
+            else:
+                future.set_exception(exception)
+
+
+class _SocketChannel(_Channel):
+    """ Channel for unix and tcp schemes using the 8 byte header and protobuf field framing."""
+
+    def __init__(self, connection):
+        if connection._scheme == 'unix':
+            _Channel.__init__(self, connection, socket.AF_UNIX, connection._path)
+        else:
+            _Channel.__init__(self, connection, socket.AF_INET, (connection._host, connection._port))
+
+    def encode_request(self, xml_request):
+        return ''.join(self.connection._encode_socket_request(xml_request))
+
+    def reset_reader(self):
+        self._message_lenght = None
+
+    def parse(self):
+        if self._message_lenght is None:
+            header = self.take(HEADER_LENGHT)
+            if header is None:
+                return
+            self._message_lenght = parse_header(header)
+        encoded_response = self.take(self._message_lenght)
+        if encoded_response is not None:
+            self.reset_reader()
+            self.finish(_response_from_fields(decode_fields(encoded_response)))
+
+
+class _HTTPChannel(_Channel):
+    """ Channel for http scheme speaking HTTP/1.1 with keep-alive."""
+
+    def __init__(self, connection):
+        _Channel.__init__(self, connection, socket.AF_INET, (connection._host, connection._port))
+
+    def encode_request(self, xml_request):
+        connection = self.connection
+        if isinstance(xml_request, unicode):
+            xml_request = xml_request.encode('utf-8')
+        headers = ["POST ", connection._selector_url, " HTTP/1.1\r\n",
+                   "Host: ", connection._host, "\r\n",
+                   "Content-Type: text/xml\r\n",
+                   "Recipient: ", connection._storage, "\r\n"]
+        if connection.accept_gzip:
+            headers.append("Accept-Encoding: gzip\r\n")
+        if connection.gzip_requests is not None and len(xml_request) >= connection.gzip_requests:
+            xml_request = ''.join(_iter_gzip_chunks(xml_request))
+            headers.append("Content-Encoding: gzip\r\n")
+        return ''.join(headers + ["Content-Length: ", str(len(xml_request)), "\r\n\r\n", xml_request])
+
+    def reset_reader(self):
+        self._headers = None
+        self._body_lenght = None    # None with chunked encoding or body until connection close.
+        self._chunks = []
+        self._keep_alive = True
+
+    def parse(self):
+        if self._headers is None:
+            data = ''.join(self._in_chunks)
+            end = data.find('\r\n\r\n')
+            if end < 0:
+                return
+            head = self.take(end + 4)
+            lines = head.split('\r\n')
+            status = lines[0].split(' ', 2)
+            if len(status) < 2 or not status[0].startswith('HTTP/'):
+                raise TransportError("Bad HTTP status line: " + lines[0])
+            if status[1] != '200':
+                raise ConnectionError("HTTP error: " + lines[0])
+            self._headers = {}
+            for line in lines[1:]:
+                if ':' in line:
+                    name, value = line.split(':', 1)
+                    self._headers[name.strip().lower()] = value.strip()
+            connection_header = self._headers.get('connection', '').lower()
+            self._keep_alive = (connection_header != 'close' and
+                                (status[0] != 'HTTP/1.0' or connection_header == 'keep-alive'))
+            if 'content-length' in self._headers:
+                try:
+                    self._body_lenght = int(self._headers['content-length'])
+                except ValueError:
+                    self._body_lenght = -1
+                if self._body_lenght < 0:
+                    raise TransportError("Bad HTTP Content-Length: " + self._headers['content-length'])
+            elif self._headers.get('transfer-encoding', '').lower() != 'chunked':
+                self._keep_alive = False
+        if 'content-length' in self._headers:
+            body = self.take(self._body_lenght)
+            if body is not None:
+                self.done(body)
+        elif self._headers.get('transfer-encoding', '').lower() == 'chunked':
+            self.parse_chunks()
+
+    def parse_chunks(self):
+        data = ''.join(self._in_chunks)
+        position = 0    # Start of the first chunk not parsed yet.
+        finished = False
+        while True:
+            end = data.find('\r\n', position)
+            if end < 0:
+                break
+            try:
+                size = int(data[position:end].split(';', 1)[0], 16)
+            except ValueError:
+                size = -1
+            if size < 0:
+                raise TransportError("Bad HTTP chunk size line: " + repr(data[position:end][:80]))
+            if size == 0:
+                trailer_end = data.find('\r\n\r\n', end)
+                if trailer_end < 0:
+                    break
+                position = trailer_end + 4
+                finished = True
+                break
+            chunk_end = end + 2 + size
+            if len(data) < chunk_end + 2:
+                break
+            if data[chunk_end:chunk_end + 2] != '\r\n':
+                raise TransportError("Bad HTTP chunk: missing the CRLF after {0} bytes of data.".format(size))
+            self._chunks.append(data[end + 2:chunk_end])
+            position = chunk_end + 2
+        self._in_chunks = [data[position:]] if position < len(data) else []
+        self._in_size = len(data) - position
+        if finished:
+            self.done(''.join(self._chunks))
+
+    def handle_eof(self):
+        if self._headers is not None and self._body_lenght is None and\
+                self._headers.get('transfer-encoding', '').lower() != 'chunked':
+            self.done(''.join(self._in_chunks))     # Body delimited by connection close.
+        else:
+            _Channel.handle_eof(self)
+
+    def done(self, body):
+        keep_alive = self._keep_alive
+        if self._headers.get('content-encoding', '').lower() == 'gzip':
+            try:
+                body = zlib.decompress(body, _GZIP_WBITS)
+            except zlib.error as e:
+                self.close(TransportError("Invalid gzip compressed response: {0}".format(e)))
+                return
+        self.finish(body)
+        if not keep_alive:
+            self.close(None)
@@ -0,0 +1,144 @@
+#    Copyright 2012 ClusterPoint, SIA
+#
+#    This file is part of Pycps.
+#
+#    Pycps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Pycps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Pycps.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+from errors import *
+
+
+class AdaptiveBatchSize(object):
+    """ Chooses the number of documents per request from the measured latency of the previous ones.
+
+        Pass it as chunk_size to Connection.insert_iter() and the other *_iter() methods, or to
+        Connection.retrieve(), lookup() and delete(). Every response is recorded: its client wall time
+        (from making the request to recieving the response), the server's Response.seconds and the
+        request's document bytes. The next batch size is scaled so a request would take target_seconds:
+
+            size = documents * target_seconds / max(wall seconds, server seconds)
+
+        limited to grow by at most increase and shrink by at most decrease times per response (a
+        multiplicative step that keeps one outlier from swinging the size), to the documents that fit
+        in max_bytes and to [minimum, maximum]. A timeout shrinks the size by decrease.
+        As a request's time is a fixed overhead plus a cost per document, the size settles where
+        requests take target_seconds, following the cluster's capacity as it changes.
+
+        The same object can be shared by threads and reused by many calls, so later calls start
+        from the size the earlier ones found.
+
+        Attributes:
+            size -- The current batch size in documents.
+            documents_per_second -- Documents per second of client wall time, smoothed documents per request
+                    divided by smoothed wall_seconds.
+            wall_seconds -- Smoothed client wall time of recent requests.
+            server_seconds -- Smoothed Response.seconds of recent requests.
+            bytes_per_document -- Smoothed request document bytes per document.
+            requests -- Number of responses recorded.
+            failures -- Number of timeouts recorded.
+
+        >>> sizer = AdaptiveBatchSize(initial=100, target_seconds=1.0)
+        >>> sizer.record(100, 0.25, 0.2)
+        >>> sizer.size
+        200
+        >>> sizer.record(200, 4.0, 3.5)
+        >>> sizer.size
+        100
+        >>> sizer.record_failure()
+        >>> sizer.size
+        50
+    """
+
+    def __init__(self, initial=1000, minimum=10, maximum=100000, target_seconds=1.0, max_bytes=16 << 20,
+                 increase=2.0, decrease=0.5, smoothing=0.3):
+        """
+            Keyword args:
+                initial -- The first batch size. Default is 1000.
+                minimum -- The smallest batch size. Default is 10.
+                maximum -- The largest batch size. Default is 100000.
+                target_seconds -- Wall time a request should take. Default is 1.0.
+                max_bytes -- Maximum document bytes in a request or None. Default is 16 MB.
+                increase -- Largest factor the size grows by after a response. Default is 2.0.
+                decrease -- Smallest factor the size shrinks by after a response or timeout. Default is 0.5.
+                smoothing -- Weight of the latest response in the smoothed statistics. Default is 0.3.
+
+            Raises:
+                ParameterError -- The sizes or factors are out of range.
+        """
+        if not (1 <= minimum <= initial <= maximum) or target_seconds <= 0 or increase < 1 or \
+                not 0 < decrease <= 1 or not 0 < smoothing <= 1 or (max_bytes is not None and max_bytes < 1):
+            raise ParameterError("initial={0}, minimum={1}, maximum={2}, target_seconds={3}, max_bytes={4}, "
+                                 "increase={5}, decrease={6}, smoothing={7}".format(initial, minimum, maximum,
+                                 target_seconds, max_bytes, increase, decrease, smoothing))
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        self.increase = increase
+        self.decrease = decrease
+        self.smoothing = smoothing
+        self.documents_per_second = None
+        self.wall_seconds = None
+        self.server_seconds = None
+        self.bytes_per_document = None
+        self.requests = 0
+        self.failures = 0
+        self._documents = None     # Smoothed documents per request.
+        self._lock = threading.Lock()
+
+    def record(self, documents, wall_seconds, server_seconds=None, payload_bytes=None):
+        """ Record a response and choose the next batch size.
+
+            Args:
+                documents -- Number of documents or ids in the request.
+                wall_seconds -- Client wall time of the request.
+
+            Keyword args:
+                server_seconds -- The response's Response.seconds or None.
+                payload_bytes -- Size of the request's documents in bytes or None.
+        """
+        if documents < 1:
+            return
+        with self._lock:
+            self.requests += 1
+            self.wall_seconds = self._smooth(self.wall_seconds, wall_seconds)
+            self._documents = self._smooth(self._documents, documents)
+            if self.wall_seconds > 0:
+                self.documents_per_second = self._documents / self.wall_seconds
+            if server_seconds is not None:
+                self.server_seconds = self._smooth(self.server_seconds, server_seconds)
+            if payload_bytes is not None:
+                self.bytes_per_document = self._smooth(self.bytes_per_document, payload_bytes / float(documents))
+            seconds = max(wall_seconds, server_seconds or 0)
+            size = documents * self.target_seconds / seconds if seconds > 0 else self.maximum
+            size = min(max(size, self.size * self.decrease), self.size * self.increase)
+            if self.max_bytes is not None and self.bytes_per_document:
+                size = min(size, self.max_bytes / self.bytes_per_document)
+            self._set_size(size)
+
+    def record_failure(self):
+        """ Record a request that timed out, shrinking the batch size."""
+        with self._lock:
+            self.failures += 1
+            self._set_size(self.size * self.decrease)
+
+    def _smooth(self, average, value):
+        if average is None:
+            return float(value)
+        return average + self.smoothing * (value - average)
+
+    def _set_size(self, size):
+        self.size = int(min(max(size, self.minimum), self.maximum))
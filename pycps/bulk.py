@@ -0,0 +1,989 @@
+#    Copyright 2012 ClusterPoint, SIA
+#
+#    This file is part of Pycps.
+#
+#    Pycps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Pycps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Pycps.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import itertools
+import json
+import mmap
+import multiprocessing
+import os
+import Queue
+import threading
+import time
+
+from utils import *
+from errors import *
+from request import *
+from request import _documents_to_xml
+
+
+_FATAL_LEVELS = ('rejected', 'failed', 'error', 'fatal')
+
+LOAD_COMMANDS = ('insert', 'update', 'replace', 'partial-replace')
+
+IMPORT_FORMATS = ('xml', 'ndjson')
+
+_DOCUMENT_NOT_FOUND = 2824
+
+# Error codes meaning a resent document was already modified by a try whose response was lost.
+_ALREADY_APPLIED = {'insert': 2626, 'delete': _DOCUMENT_NOT_FOUND}
+
+
+class _Batch(object):
+    """ Documents buffered for a single modify request."""
+    def __init__(self, command, sequence):
+        self.command = command
+        self.sequence = sequence    # Batches are sent in the order they were started.
+        self.started = monotonic()
+        self.ids = []
+        self.documents = []     # Xml strings with the root tag and id, None if taken out.
+        self.futures = []
+        self.positions = {}     # Document id -> index of its last document.
+        self.absent_ok = set()  # Ids of deletes that succeed if the document doesn't exist.
+        self.count = 0
+        self.size = 0
+
+    def append(self, doc_id, xml_document, future):
+        self.positions[doc_id] = len(self.ids)
+        self.ids.append(doc_id)
+        self.documents.append(xml_document)
+        self.futures.append(future)
+        self.count += 1
+        self.size += len(xml_document)
+
+    def take(self, doc_id):
+        """ Take a document out of the batch.
+
+            Returns:
+                The document's (xml string, future) pair.
+        """
+        index = self.positions.pop(doc_id)
+        self.absent_ok.discard(doc_id)
+        xml_document = self.documents[index]
+        self.documents[index] = None
+        self.count -= 1
+        self.size -= len(xml_document)
+        return xml_document, self.futures[index]
+
+
+class BulkWriter(object):
+    """ Buffers single document modifications and sends them in batches, one request per command.
+
+        A batch is sent by a background thread when it reaches max_documents or max_bytes,
+        or when its oldest document has waited max_age seconds. Every modification returns a
+        Future resolved when its batch is sent: the result is True if the document's id is among
+        the response's modified_ids and False if it isn't, the exception is the APIError that
+        refers to the document or failed the whole request, or the error sending the request.
+
+        Batches are sent one at a time in the order they were started. When a document that is
+        already buffered for another command is modified, the buffered batches are sent first,
+        so modifications of the same document are applied in order.
+
+        The writer's thread sends requests through the connection, so it should not be used
+        by other threads meanwhile unless it's a ConnectionPool or ClusterConnection.
+
+        Usage:
+            with BulkWriter(connection, max_documents=500) as writer:
+                for event in events:
+                    writer.insert(event['id'], event)
+    """
+
+    def __init__(self, connection, max_documents=1000, max_bytes=1 << 20, max_age=1.0, max_pending=2, retries=0,
+                 **kwargs):
+        """
+            Args:
+                connection -- A Connection object the batches are sent through.
+
+            Keyword args:
+                max_documents -- Documents in a batch that trigger sending it. Default is 1000.
+                max_bytes -- Size of a batch's xml documents in bytes that triggers sending it. Default is 1 MB.
+                max_age -- Seconds after which a batch is sent even if it's not full. Default is 1.0.
+                max_pending -- Full batches waiting to be sent before modifications block. Default is 2.
+                retries -- Rounds of resends of a batch's documents that were not modified, see modify_with_retry().
+                        Default is 0 - no resends.
+                See Request.__init__(), the rest of keyword args are passed to every request.
+
+            Raises:
+                ParameterError -- Thresholds are not positive.
+        """
+        if max_documents < 1 or max_bytes < 1 or max_age <= 0 or max_pending < 1 or retries < 0:
+            raise ParameterError("max_documents={0}, max_bytes={1}, max_age={2}, max_pending={3}, retries={4}".format(
+                                 max_documents, max_bytes, max_age, max_pending, retries))
+        self.connection = connection
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_pending = max_pending
+        self.retries = retries
+        self._request_kwargs = kwargs
+        self._condition = threading.Condition()
+        self._buffers = {}      # Command -> _Batch being filled.
+        self._buffered_ids = {}     # Document id -> command of the batch it's buffered in.
+        self._ready = collections.deque()   # Batches waiting to be sent.
+        self._sending = False
+        self._sequence = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='pycps-bulk-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def insert(self, doc_id, document):
+        """ Buffer a new document to be inserted.
+
+            Args:
+                doc_id -- The document's id.
+                document -- A xml string, etree.ElementTree or dict representation of the document, see Connection.insert().
+
+            Returns:
+                A Future resolved when the batch is sent.
+        """
+        return self._add('insert', doc_id, document)
+
+    def update(self, doc_id, document):
+        """ Buffer a document to be replaced or created. See insert() and Connection.update()."""
+        return self._add('update', doc_id, document)
+
+    def replace(self, doc_id, document):
+        """ Buffer an existing document to be replaced. See insert() and Connection.replace()."""
+        return self._add('replace', doc_id, document)
+
+    def partial_replace(self, doc_id, document):
+        """ Buffer an existing document's fields to be replaced. See insert() and Connection.partial_replace()."""
+        return self._add('partial-replace', doc_id, document)
+
+    def delete(self, doc_id):
+        """ Buffer a document to be deleted. See insert() and Connection.delete()."""
+        return self._add('delete', doc_id, None)
+
+    def flush(self):
+        """ Send all buffered documents and wait until their futures are resolved.
+
+            Raises:
+                ParameterError -- The writer is closed.
+        """
+        with self._condition:
+            if self._closed:
+                raise ParameterError("The BulkWriter is closed.")
+            self._queue_all()
+            while self._ready or self._sending:
+                self._condition.wait()
+
+    def close(self):
+        """ Send all buffered documents and stop the writer's thread. Calling it again does nothing."""
+        with self._condition:
+            if self._closed:
+                return
+            self._queue_all()
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _serialize(self, command, doc_id, document):
+        """ Make the xml string the document is sent as in the connection's document format."""
+        return _documents_to_xml([(doc_id, document)], self.connection.document_root_xpath,
+                                 self.connection.document_id_xpath)[0]
+
+    def _add(self, command, doc_id, document):
+        xml_document = self._serialize(command, doc_id, document)    # Outside the lock, it's the costly part.
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise ParameterError("The BulkWriter is closed.")
+            if self._buffered_ids.get(doc_id, command) != command:
+                self._queue_all()
+            self._append(command, doc_id, xml_document, future)
+        return future
+
+    def _append(self, command, doc_id, xml_document, future, absent_ok=False):
+        """ Add a document to the command's batch. Called with the lock held, waits if too many batches are ready.
+            If absent_ok, a delete that fails as the document doesn't exist is counted as done.
+        """
+        batch = self._buffers.get(command)
+        if batch is None:
+            batch = self._buffers[command] = _Batch(command, self._sequence)
+            self._sequence += 1
+            self._condition.notify_all()    # The thread has to wait for the new batch's age.
+        batch.append(doc_id, xml_document, future)
+        if absent_ok:
+            batch.absent_ok.add(doc_id)
+        self._buffered_ids[doc_id] = command
+        if batch.count >= self.max_documents or batch.size >= self.max_bytes:
+            self._queue(batch)
+        while len(self._ready) > self.max_pending:  # Backpressure when sending can't keep up.
+            self._condition.wait()
+
+    def _queue(self, batch):
+        """ Move a filled batch to the ones waiting to be sent. Called with the lock held."""
+        del self._buffers[batch.command]
+        for doc_id in batch.ids:
+            if self._buffered_ids.get(doc_id) == batch.command:
+                del self._buffered_ids[doc_id]
+        self._ready.append(batch)
+        self._condition.notify_all()
+
+    def _queue_all(self):
+        for batch in sorted(self._buffers.values(), key=lambda batch: batch.sequence):
+            self._queue(batch)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = monotonic()
+                    for batch in sorted(self._buffers.values(), key=lambda batch: batch.sequence):
+                        if batch.started + self.max_age <= now:
+                            self._queue(batch)
+                    if self._ready:
+                        batch = self._ready.popleft()
+                        self._sending = True
+                        self._condition.notify_all()
+                        break
+                    if self._closed:
+                        return
+                    if self._buffers:
+                        self._condition.wait(min(batch.started for batch in self._buffers.values()) +
+                                             self.max_age - now)
+                    else:
+                        self._condition.wait()
+            try:
+                self._send(batch)
+            finally:
+                with self._condition:
+                    self._sending = False
+                    self._condition.notify_all()
+
+    def _send(self, batch):
+        """ Send a batch as one request and resolve its futures."""
+        if self.retries:
+            self._send_with_retry(batch)
+            return
+        try:
+            request = Request(self.connection, batch.command, raise_errors=False, **self._request_kwargs)
+            request.set_documents([document for document in batch.documents if document is not None], fully_formed=True)
+            response = request.send()
+            modified_ids = set(response.modified_ids)
+            errors = response.errors
+        except Exception as e:
+            for document, future in zip(batch.documents, batch.futures):
+                if document is not None:    # Taken out by coalescing, resolved with the document it was merged into.
+                    future.set_exception(e)
+            return
+        fatal = [error for error in errors if error.level.lower() in _FATAL_LEVELS and not error.document_id]
+        document_errors = {}
+        for error in errors:
+            for doc_id in error.document_id:
+                document_errors.setdefault(doc_id, error)
+        for doc_id, document, future in zip(batch.ids, batch.documents, batch.futures):
+            if document is None:
+                continue
+            absent_ok = doc_id in batch.absent_ok
+            doc_id = str(doc_id)
+            if doc_id in modified_ids or (absent_ok and _is_not_found(document_errors.get(doc_id))):
+                future.set_result(True)
+            elif doc_id in document_errors:
+                future.set_exception(document_errors[doc_id])
+            elif fatal:
+                future.set_exception(fatal[0])
+            else:
+                future.set_result(False)
+
+    def _send_with_retry(self, batch):
+        """ Send a batch resending the documents that were not modified and resolve its futures."""
+        documents = [(doc_id, document) for doc_id, document in zip(batch.ids, batch.documents) if document is not None]
+        try:
+            outcome = _send_with_retry(self.connection, batch.command, [doc_id for doc_id, document in documents],
+                                       [document for doc_id, document in documents], self.retries, 0.05, 5.0,
+                                       self._request_kwargs)
+        except Exception as e:
+            for document, future in zip(batch.documents, batch.futures):
+                if document is not None:    # Taken out by coalescing, resolved with the document it was merged into.
+                    future.set_exception(e)
+            return
+        modified_ids = set(outcome['modified'])
+        for doc_id, document, future in zip(batch.ids, batch.documents, batch.futures):
+            if document is None:
+                continue
+            absent_ok = doc_id in batch.absent_ok
+            doc_id = str(doc_id)
+            if doc_id in modified_ids or (absent_ok and _is_not_found(outcome['failed'].get(doc_id))):
+                future.set_result(True)
+            elif outcome['failed'].get(doc_id) is not None:
+                future.set_exception(outcome['failed'][doc_id])
+            else:
+                future.set_result(False)
+
+
+# (Buffered command, new command) -> command of the single modification both are coalesced into,
+# chosen so that it leaves the same document as applying both in order does.
+_COALESCED_COMMANDS = {
+    ('update', 'update'): 'update',
+    ('update', 'replace'): 'update',
+    ('replace', 'update'): 'update',
+    ('replace', 'replace'): 'replace',
+    ('partial-replace', 'update'): 'update',
+    ('partial-replace', 'replace'): 'replace',
+    ('update', 'partial-replace'): 'update',
+    ('replace', 'partial-replace'): 'replace',
+    ('partial-replace', 'partial-replace'): 'partial-replace',
+    ('delete', 'update'): 'update',
+    ('delete', 'insert'): 'update',
+    ('insert', 'delete'): 'delete',
+    ('update', 'delete'): 'delete',
+    ('replace', 'delete'): 'delete',
+    ('partial-replace', 'delete'): 'delete',
+    ('delete', 'delete'): 'delete',
+}
+
+
+def _merge_subtrees(target, patch):
+    """ Merge a partial replace patch into an etree Element in place.
+
+        Every child tag of the patch replaces the target's children with that tag. If both have
+        a single child with the tag and both of those have children, they are merged recursively,
+        so fields not in the patch are kept at every level.
+    """
+    patched = collections.OrderedDict()
+    for child in patch:
+        patched.setdefault(child.tag, []).append(child)
+    for tag, children in patched.items():
+        existing = [child for child in target if child.tag == tag]
+        if len(children) == 1 and len(existing) == 1 and len(children[0]) and len(existing[0]):
+            _merge_subtrees(existing[0], children[0])
+            continue
+        index = list(target).index(existing[0]) if existing else len(target)
+        for child in existing:
+            target.remove(child)
+        for offset, child in enumerate(children):
+            target.insert(index + offset, child)
+
+
+class CoalescingWriter(BulkWriter):
+    """ BulkWriter that collapses modifications of a document that is still buffered into one.
+
+        While a document waits in a batch - up to max_age seconds or until the batch reaches
+        max_documents or max_bytes - a new modification of it replaces the buffered one:
+            update or replace -- The last document wins, the command is replace only if both
+                    modifications need the document to exist, otherwise update.
+            partial_replace -- The fields are merged into the buffered update, replace or
+                    partial_replace document, see _merge_subtrees().
+            delete -- Cancels the buffered write, only the delete is sent. After an insert or update
+                    it succeeds even if the document doesn't exist, as the write would have created it.
+            insert or update after delete -- Sent as an update of the new document.
+        Other combinations, e.g. insert followed by replace, send the buffered batches first like
+        BulkWriter does. The future of a modification that was coalesced is resolved with the outcome
+        of the one it was merged into.
+
+        Attributes:
+            received -- Number of modifications made through the writer.
+            coalesced -- Number of them that were merged into another and never sent on their own.
+
+        Usage:
+            with CoalescingWriter(connection, max_age=0.5) as writer:
+                for event in events:
+                    writer.partial_replace(event['id'], event['fields'])
+            print writer.coalescing_ratio
+    """
+
+    def __init__(self, connection, *args, **kwargs):
+        """ See BulkWriter.__init__()."""
+        self.received = 0
+        self.coalesced = 0
+        BulkWriter.__init__(self, connection, *args, **kwargs)
+
+    @property
+    def coalescing_ratio(self):
+        """ Modifications received per document sent, 1.0 if none were coalesced."""
+        with self._condition:
+            if not self.received:
+                return 1.0
+            return float(self.received) / (self.received - self.coalesced)
+
+    def _add(self, command, doc_id, document):
+        xml_document = self._serialize(command, doc_id, document)
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise ParameterError("The BulkWriter is closed.")
+            self.received += 1
+            buffered_command = self._buffered_ids.get(doc_id)
+            absent_ok = False
+            if buffered_command is not None:
+                coalesced_command = _COALESCED_COMMANDS.get((buffered_command, command))
+                if coalesced_command is None:
+                    self._queue_all()
+                else:
+                    xml_document = self._take(buffered_command, doc_id, command, xml_document, future)
+                    # The buffered write may have created the document, so the delete succeeds either way.
+                    absent_ok = (coalesced_command == 'delete' and buffered_command in ('insert', 'update'))
+                    command = coalesced_command
+                    self.coalesced += 1
+            self._append(command, doc_id, xml_document, future, absent_ok)
+        return future
+
+    def _take(self, buffered_command, doc_id, command, xml_document, future):
+        """ Take a buffered document out of its batch and chain its future to the new modification's.
+
+            Returns:
+                The xml document to send for both.
+        """
+        batch = self._buffers[buffered_command]
+        buffered_document, buffered_future = batch.take(doc_id)
+        del self._buffered_ids[doc_id]
+        if not batch.count:
+            del self._buffers[buffered_command]
+        future.add_done_callback(lambda future: _copy_outcome(future, buffered_future))
+        if command == 'partial-replace':
+            root = ET.fromstring(buffered_document)
+            _merge_subtrees(root, ET.fromstring(xml_document))
+            xml_document = to_raw_xml(root)
+        return xml_document
+
+
+def _is_not_found(error):
+    """ Check if a document's error says it doesn't exist."""
+    return getattr(error, 'code', None) == _DOCUMENT_NOT_FOUND
+
+
+def _copy_outcome(source, target):
+    """ Resolve the target future with the source future's result or exception."""
+    exception = source.exception(0)
+    if exception is not None:
+        target.set_exception(exception)
+    else:
+        target.set_result(source.result(0))
+
+
+def modify_with_retry(connection, command, documents, retries=5, backoff=0.05, max_backoff=5.0, **kwargs):
+    """ Send a modify request and resend only the documents that were not modified, with exponential backoff.
+
+        The ids sent are compared with the response's modified_ids:
+            Documents named by an error in the response, e.g. an insert of an existing id, failed and
+                    are not resent.
+            Documents neither modified nor named by an error are resent. If other documents of the
+                    request failed, right away, as the request was split by their errors, otherwise
+                    after a backoff.
+            A request rejected as a whole, without naming documents, is split in halves sent one after
+                    another until the documents that cause it are found.
+            If the connection fails or times out, the whole request is resent after a backoff. An insert
+                    or delete resent this way may be rejected for documents the lost request already
+                    modified ('already exists' or 'does not exist'), such documents count as modified.
+        Backoffs double from backoff seconds up to max_backoff seconds for each round of resends.
+
+        Args:
+            connection -- A Connection object, not an AsyncConnection.
+            command -- One of LOAD_COMMANDS or 'delete'.
+            documents -- A dict or iterable of (id, document) pairs, see Connection.insert().
+                    For 'delete' an iterable of ids.
+
+        Keyword args:
+            retries -- Rounds of resends after the first request. Default is 5.
+            backoff -- Seconds to wait before the first round of resends. Default is 0.05.
+            max_backoff -- The longest wait between rounds in seconds. Default is 5.0.
+            See Request.__init__(), the rest of keyword args are passed to every request.
+
+        Returns:
+            A dict with the outcome:
+                modified -- A list of ids of the modified documents.
+                failed -- A dict of ids of the documents that weren't modified and the APIError or
+                        ConnectionError that caused it, or None if the server didn't say why.
+                requests -- Number of requests sent.
+                resent -- Number of documents sent again.
+
+        Raises:
+            ParameterError -- Unknown command or bad parameters.
+    """
+    if command not in LOAD_COMMANDS + ('delete',):
+        raise ParameterError("Unknown modify command '{0}'".format(command))
+    if retries < 0 or backoff < 0 or max_backoff < 0:
+        raise ParameterError("retries={0}, backoff={1}, max_backoff={2}".format(retries, backoff, max_backoff))
+    if command == 'delete':
+        documents = [(doc_id, None) for doc_id in documents]
+    elif hasattr(documents, 'items'):
+        documents = documents.items()
+    documents = list(documents)
+    xml_documents = _documents_to_xml(documents, connection.document_root_xpath, connection.document_id_xpath)
+    return _send_with_retry(connection, command, [doc_id for doc_id, document in documents], xml_documents,
+                            retries, backoff, max_backoff, kwargs)
+
+
+def _send_with_retry(connection, command, ids, xml_documents, retries, backoff, max_backoff, kwargs):
+    """ Send xml documents with the root tag and id, resending the ones not modified. See modify_with_retry()."""
+    xml_documents = collections.OrderedDict(zip(map(str, ids), xml_documents))
+    already_applied = _ALREADY_APPLIED.get(command)
+    lost = set()    # Ids sent in requests whose responses were lost.
+    outcome = {'modified': [], 'failed': {}, 'requests': 0, 'resent': 0}
+    resend = list(xml_documents)
+    attempt = 0
+    while resend:
+        if attempt:
+            if attempt > retries:
+                break
+            time.sleep(min(backoff * 2 ** (attempt - 1), max_backoff))
+            outcome['resent'] += len(resend)
+        attempt += 1
+        batches = collections.deque([(resend, False)])   # (ids, split from a request that named failed documents)
+        resend = []
+        while batches:
+            batch_ids, split = batches.popleft()
+            outcome['requests'] += 1
+            try:
+                request = Request(connection, command, raise_errors=False, **kwargs)
+                request.set_documents([xml_documents[doc_id] for doc_id in batch_ids], fully_formed=True)
+                response = request.send()
+                modified_ids = set(response.modified_ids)
+                errors = response.errors
+            except ConnectionError as e:
+                lost.update(batch_ids)
+                for doc_id in batch_ids:
+                    outcome['failed'][doc_id] = e
+                resend.extend(batch_ids)
+                continue
+            document_errors = {}
+            for error in errors:
+                for doc_id in error.document_id:
+                    document_errors.setdefault(doc_id, error)
+            fatal = [error for error in errors if error.level.lower() in _FATAL_LEVELS and not error.document_id]
+            if fatal and not modified_ids and not document_errors:
+                if len(batch_ids) > 1:
+                    middle = len(batch_ids) // 2
+                    batches.extend([(batch_ids[:middle], split), (batch_ids[middle:], split)])
+                else:
+                    outcome['failed'][batch_ids[0]] = fatal[0]
+                continue
+            missing = []
+            for doc_id in batch_ids:
+                error = document_errors.get(doc_id)
+                if doc_id in modified_ids or (error is not None and error.code == already_applied and doc_id in lost):
+                    outcome['modified'].append(doc_id)
+                    outcome['failed'].pop(doc_id, None)
+                elif error is not None:
+                    outcome['failed'][doc_id] = error
+                else:
+                    missing.append(doc_id)
+                    outcome['failed'].setdefault(doc_id, fatal[0] if fatal else None)
+            if missing and document_errors and not split:
+                outcome['resent'] += len(missing)
+                batches.append((missing, True))
+            else:
+                resend.extend(missing)
+    return outcome
+
+
+def _serialize_chunk(documents, doc_root_tag, doc_id_xpath, fully_formed):
+    """ Convert a chunk of documents to the content of a modify request in a worker process.
+
+        Returns:
+            A (content, document count, seconds, error) tuple. Content is None and error a message string
+            if the documents could not be converted, as not all exceptions can be sent back from a process.
+    """
+    start = time.time()
+    try:
+        content = '\n'.join(_documents_to_xml(documents, doc_root_tag, doc_id_xpath, fully_formed))
+    except Exception as e:
+        return None, len(documents), time.time() - start, '{0}: {1}'.format(type(e).__name__, e)
+    return content, len(documents), time.time() - start, None
+
+
+def parallel_load(connection_factory, documents, command='insert', workers=None, senders=4, chunk_size=1000,
+                  queue_size=None, fully_formed=False, **kwargs):
+    """ Load documents converting them to xml in worker processes and sending them from several threads.
+
+        Documents are read in chunks of chunk_size in the calling thread, converted to request content
+        by a multiprocessing pool of workers, so conversion isn't limited by one interpreter's lock, and
+        sent by sender threads each with its own connection. At most queue_size chunks are being converted
+        or waiting to be sent, reading waits for room, so memory stays bounded however many documents are
+        loaded. Chunks are sent in no particular order. The first error stops the load and is raised after
+        the chunks already sent are finished.
+
+        Args:
+            connection_factory -- A callable making a new Connection object, called once for every sender.
+                    The document root tag and id xpath are taken from the first connection.
+            documents -- If fully_formed is False (default), an iterable of (id, document) pairs,
+                    otherwise an iterable of fully formed documents. See Connection.insert_iter().
+
+        Keyword args:
+            command -- One of LOAD_COMMANDS. Default is 'insert'.
+            workers -- Number of worker processes. Default is None - the number of CPUs.
+            senders -- Number of sender threads. Default is 4.
+            chunk_size -- Number of documents sent in one request. Default is 1000.
+            queue_size -- Maximum number of chunks being converted or waiting to be sent.
+                    Default is None - twice the number of workers and senders.
+            fully_formed -- See Connection.insert().
+            See Request.__init__(), the rest of keyword args are passed to every request.
+
+        Returns:
+            A dict with the load's statistics:
+                documents -- Documents sent.
+                modified -- Documents reported modified by the server.
+                requests -- Requests sent.
+                seconds -- Wall clock time of the load.
+                documents_per_second -- Overall throughput.
+                read_per_second, convert_per_second, send_per_second -- Throughput of each stage if it
+                        was never waiting for the others: documents divided by the time spent reading the
+                        input, by the workers' conversion time per worker and by the senders' time per sender.
+                read_wait_seconds -- Time reading waited for room in the queue, high if converting or sending is slower.
+                send_idle_seconds -- Time senders waited for converted chunks, summed over senders.
+
+        Raises:
+            ParameterError -- Unknown command, bad parameters or documents that could not be converted.
+            Whatever sending a request raises, e.g. APIError or ConnectionError.
+    """
+    if command not in LOAD_COMMANDS:
+        raise ParameterError("Unknown load command '{0}', use one of: {1}".format(command, ', '.join(LOAD_COMMANDS)))
+    workers = workers or multiprocessing.cpu_count()
+    queue_size = queue_size or 2 * (workers + senders)
+    if chunk_size < 1 or senders < 1 or workers < 1 or queue_size < 1:
+        raise ParameterError("chunk_size={0}, workers={1}, senders={2}, queue_size={3}".format(
+                             chunk_size, workers, senders, queue_size))
+    start = time.time()
+    connections = [connection_factory()]
+    doc_root_tag = connections[0].document_root_xpath
+    doc_id_xpath = connections[0].document_id_xpath
+    connections += [connection_factory() for i in range(senders - 1)]
+    slots = threading.BoundedSemaphore(queue_size)   # Chunks being converted or waiting to be sent.
+    contents = Queue.Queue()
+    lock = threading.Lock()
+    errors = []
+    stats = {'documents': 0, 'modified': 0, 'requests': 0, 'read_seconds': 0.0, 'convert_seconds': 0.0,
+             'send_seconds': 0.0, 'read_wait_seconds': 0.0, 'send_idle_seconds': 0.0}
+
+    pending = Queue.Queue()     # (AsyncResult, document count) of chunks given to the workers.
+    stop_collecting = threading.Event()
+
+    def converted(result):
+        contents.put(result)
+
+    def collect():
+        """ Pass chunks that failed outside _serialize_chunk (e.g. documents that can't be pickled) to the
+            senders as errors, as the pool calls the callback only on success and their slots must be released.
+        """
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            result, count = item
+            while not result.ready():
+                if stop_collecting.is_set():
+                    return
+                result.wait(0.1)
+            if not result.successful():
+                try:
+                    result.get()
+                except Exception as e:
+                    contents.put((None, count, 0.0, '{0}: {1}'.format(type(e).__name__, e)))
+
+    def send(connection):
+        while True:
+            idle = time.time()
+            result = contents.get()
+            if result is None:
+                return
+            content, count, seconds, error = result
+            sending = time.time()
+            try:
+                if error is not None:
+                    raise ParameterError(error)
+                if not errors:  # After an error the rest is only drained.
+                    request = Request(connection, command, **kwargs)
+                    request._documents = [content]
+                    modified = len(request.send().modified_ids)
+                    with lock:
+                        stats['documents'] += count
+                        stats['modified'] += modified
+                        stats['requests'] += 1
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+            finally:
+                with lock:
+                    stats['convert_seconds'] += seconds
+                    stats['send_idle_seconds'] += sending - idle
+                    stats['send_seconds'] += time.time() - sending
+                slots.release()
+
+    threads = [threading.Thread(target=send, args=(connection,), name='pycps-loader-{0}'.format(i))
+               for i, connection in enumerate(connections)]
+    collector = threading.Thread(target=collect, name='pycps-loader-collector')
+    for thread in threads + [collector]:
+        thread.daemon = True
+        thread.start()
+    pool = multiprocessing.Pool(workers)
+    try:
+        documents = iter(documents)
+        while not errors:
+            reading = time.time()
+            chunk = list(itertools.islice(documents, chunk_size))
+            waiting = time.time()
+            stats['read_seconds'] += waiting - reading
+            if not chunk:
+                break
+            slots.acquire()
+            stats['read_wait_seconds'] += time.time() - waiting
+            pending.put((pool.apply_async(_serialize_chunk, (chunk, doc_root_tag, doc_id_xpath, fully_formed),
+                                          callback=converted), len(chunk)))
+        pool.close()
+        pool.join()
+    except BaseException:
+        stop_collecting.set()   # Terminated chunks never get ready.
+        raise
+    finally:
+        pool.terminate()
+        pending.put(None)
+        collector.join()
+        for thread in threads:
+            contents.put(None)
+        for thread in threads:
+            thread.join()
+        for connection in connections:
+            connection.close()
+    if errors:
+        raise errors[0]
+    seconds = time.time() - start
+    documents = float(stats['documents'])
+    return {'documents': stats['documents'], 'modified': stats['modified'], 'requests': stats['requests'],
+            'seconds': seconds, 'documents_per_second': documents / seconds,
+            'read_per_second': documents / max(stats['read_seconds'], 1e-9),
+            'convert_per_second': documents / max(stats['convert_seconds'] / workers, 1e-9),
+            'send_per_second': documents / max(stats['send_seconds'] / senders, 1e-9),
+            'read_wait_seconds': stats['read_wait_seconds'], 'send_idle_seconds': stats['send_idle_seconds']}
+
+
+class _FileRangeRequest(Request):
+    """ Modify request whose content is a range of a memory mapped file of fully formed xml documents."""
+
+    _MARKER = '<!--pycps-file-range-->'
+
+    def __init__(self, connection, command, data, start, end, **kwargs):
+        Request.__init__(self, connection, command, **kwargs)
+        self._documents = [self._MARKER]
+        self._range = (data, start, end)
+
+    def get_xml_request(self):
+        """ Make the xml request as a list of parts, the file range is a buffer of the mapped file, not a copy.
+
+            Returns:
+                A list of the envelope before the content, the file range and the envelope after it.
+        """
+        data, start, end = self._range
+        prefix, suffix = Request.get_xml_request(self).split(self._MARKER)
+        return [prefix, buffer(data, start, end - start), suffix]
+
+
+def _find_start_tag(data, tag, position):
+    """ Find the position of the next start tag with this name, not of a longer tag starting the same way, or -1."""
+    start_tag = '<' + tag
+    while True:
+        position = data.find(start_tag, position)
+        if position < 0 or data[position + len(start_tag):position + len(start_tag) + 1] in ('>', '/', ' ', '\t', '\r', '\n'):
+            return position
+        position += len(start_tag)
+
+
+def _count(data, substring, start, end):
+    count = 0
+    while True:
+        start = data.find(substring, start, end)
+        if start < 0:
+            return count
+        count += 1
+        start += len(substring)
+
+
+def _find_self_closing_tag(data, tag, start, end):
+    """ Find the position of the first self-closing tag with this name between start and end, or -1."""
+    position = _find_start_tag(data, tag, start)
+    while 0 <= position < end:
+        close = data.find('>', position, end)
+        if close > 0 and data[close - 1] == '/':
+            return position
+        position = _find_start_tag(data, tag, position + len(tag) + 1)
+    return -1
+
+
+def _xml_ranges(data, root_tag, batch_bytes):
+    """ Split a buffer of concatenated xml documents in ranges of whole documents without parsing it.
+
+        A range starts at a document's root start tag and ends after the first root end tag at least
+        batch_bytes later, or the last one. Text outside the documents, like a xml declaration or an
+        element wrapping all the documents, is skipped. Documents must not contain their root tag.
+
+        Returns:
+            A generator of (start, end, number of documents) tuples.
+
+        Raises:
+            XMLError -- A document is a self-closing root tag, which has no id, or has no root end tag.
+
+        >>> list(_xml_ranges('<?xml version="1.0"?><documents><document><id>1</id></document>'
+        ...                  '<document><id>2</id></document>\\n</documents>', 'document', 10))
+        [(32, 63, 1), (63, 94, 1)]
+        >>> list(_xml_ranges('<document><id>1</id></document><document/><document><id>2</id></document>',
+        ...                  'document', 100))  # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        XMLError: Bad xml document
+        >>> list(_xml_ranges('<document><id>1</id></document><document/>', 'document', 10))  # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        XMLError: Bad xml document
+    """
+    end_tag = '</' + root_tag + '>'
+    position = 0
+    while True:
+        start = _find_start_tag(data, root_tag, position)
+        if start < 0:
+            return
+        end = data.find(end_tag, start + max(batch_bytes - len(end_tag), 0))
+        if end < 0:
+            end = data.rfind(end_tag, start)
+            if end < 0:     # A self-closing or unclosed document after the last end tag.
+                raise XMLError(data[start:start + 200])
+        end += len(end_tag)
+        self_closing = _find_self_closing_tag(data, root_tag, start, end)
+        if self_closing >= 0:   # It would be counted as a part of the next document.
+            raise XMLError(data[self_closing:self_closing + 200])
+        yield start, end, _count(data, end_tag, start, end)
+        position = end
+
+
+def _ndjson_ranges(data, batch_bytes):
+    """ Split a buffer of json documents, one per line, in ranges of whole lines of about batch_bytes.
+
+        Returns:
+            A generator of (start, end) pairs.
+    """
+    position = 0
+    while position < len(data):
+        end = data.find('\n', position + max(batch_bytes - 1, 0))
+        end = (len(data) if end < 0 else end + 1)
+        yield position, end
+        position = end
+
+
+def import_file(connection, path, command='insert', batch_bytes=1 << 20, format='xml', depth=2, **kwargs):
+    """ Load a file of fully formed documents, sending it in ranges of about batch_bytes without parsing it.
+
+        The file is memory mapped and split on the document root end tags. Every range is sent as the
+        content of a request straight from the mapped file: over tcp and unix sockets it's written to
+        the socket after the message header, over http as a chunk of a chunked request body, so the
+        file is neither read into strings nor parsed and files larger than memory can be imported.
+        Requests are pipelined depth at a time. Every document needs the root tag and id and must not
+        contain another element with the root tag. A xml declaration and an element wrapping all
+        documents are skipped.
+
+        With format 'ndjson' every line of the file is a json object of a document with the id field,
+        see dict_to_etree(), converted to xml before it's sent.
+
+        Args:
+            connection -- A Connection, ConnectionPool or ClusterConnection, not an AsyncConnection.
+            path -- The file's path.
+
+        Keyword args:
+            command -- One of LOAD_COMMANDS. Default is 'insert'.
+            batch_bytes -- Size of the documents sent in one request. A request ends with the first
+                    document reaching it, so it can be larger by a document. Default is 1 MB.
+            format -- One of IMPORT_FORMATS. Default is 'xml'.
+            depth -- Maximum number of requests sent ahead of the recieved responses. Default is 2.
+            See Request.__init__(), the rest of keyword args are passed to every request.
+
+        Returns:
+            A dict with the import's statistics:
+                documents -- Documents sent.
+                modified -- Documents reported modified by the server.
+                requests -- Requests sent.
+                bytes -- Document bytes sent.
+                seconds -- Wall clock time of the import.
+                documents_per_second, bytes_per_second -- Overall throughput.
+
+        Raises:
+            ParameterError -- Unknown command or format or bad parameters.
+            XMLError -- A document is a self-closing root tag or has no root end tag, the ranges before it are sent.
+            Whatever sending a request raises, e.g. APIError or ConnectionError. Requests already sent are not undone.
+    """
+    if command not in LOAD_COMMANDS:
+        raise ParameterError("Unknown load command '{0}', use one of: {1}".format(command, ', '.join(LOAD_COMMANDS)))
+    if format not in IMPORT_FORMATS:
+        raise ParameterError("Unknown import format '{0}', use one of: {1}".format(format, ', '.join(IMPORT_FORMATS)))
+    if batch_bytes < 1:
+        raise ParameterError("batch_bytes={0}".format(batch_bytes))
+    start_time = time.time()
+    stats = {'documents': 0, 'modified': 0, 'requests': 0, 'bytes': 0}
+    root_tag = connection.document_root_xpath
+    with open(path, 'rb') as source:
+        data = (mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(source.fileno()).st_size else '')
+
+    def requests():
+        if format == 'xml':
+            for start, end, documents in _xml_ranges(data, root_tag, batch_bytes):
+                stats['documents'] += documents
+                stats['bytes'] += end - start
+                yield _FileRangeRequest(connection, command, data, start, end, **kwargs)
+        else:
+            for start, end in _ndjson_ranges(data, batch_bytes):
+                documents = [dict_to_xml(json.loads(line), root_tag) for line in data[start:end].splitlines()
+                             if line.strip()]
+                if documents:
+                    stats['documents'] += len(documents)
+                    stats['bytes'] += sum([len(document) for document in documents])
+                    request = Request(connection, command, **kwargs)
+                    request._documents = documents
+                    yield request
+    try:
+        for response in connection.pipeline(requests(), lazy=True, depth=depth):
+            stats['requests'] += 1
+            stats['modified'] += len(response.modified_ids)
+    finally:
+        if data:
+            data.close()
+    seconds = max(time.time() - start_time, 1e-9)
+    stats.update({'seconds': seconds, 'documents_per_second': stats['documents'] / seconds,
+                  'bytes_per_second': stats['bytes'] / seconds})
+    return stats
+
+
+def main(args=None):
+    """ Import a file of documents from the command line: python -m pycps.bulk URL STORAGE USER PASSWORD ACCOUNT PATH"""
+    import argparse
+    from connection import Connection
+    parser = argparse.ArgumentParser(description="Import a file of fully formed documents to a Clusterpoint Storage.")
+    parser.add_argument('url', help="Connection url, e.g. tcp://127.0.0.1:5550.")
+    parser.add_argument('storage')
+    parser.add_argument('user')
+    parser.add_argument('password')
+    parser.add_argument('account')
+    parser.add_argument('path', help="File of documents to import.")
+    parser.add_argument('--command', default='insert', choices=LOAD_COMMANDS)
+    parser.add_argument('--format', default='xml', choices=IMPORT_FORMATS)
+    parser.add_argument('--batch-bytes', type=int, default=1 << 20, help="Document bytes sent in one request.")
+    parser.add_argument('--depth', type=int, default=2, help="Requests sent ahead of the recieved responses.")
+    parser.add_argument('--document-root-xpath', default='document')
+    parser.add_argument('--document-id-xpath', default='./id')
+    options = parser.parse_args(args)
+    connection = Connection(options.url, options.storage, options.user, options.password, options.account,
+                            document_root_xpath=options.document_root_xpath,
+                            document_id_xpath=options.document_id_xpath)
+    stats = import_file(connection, options.path, options.command, options.batch_bytes, options.format, options.depth)
+    connection.close()
+    print("{documents} documents, {modified} modified, {requests} requests in {seconds:.2f} s: "
+          "{documents_per_second:.0f} documents/s, {bytes_per_second:.0f} bytes/s".format(**stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+#    Copyright 2012 ClusterPoint, SIA
+#
+#    This file is part of Pycps.
+#
+#    Pycps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Pycps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Pycps.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import hashlib
+import re
+import threading
+
+from errors import *
+from utils import monotonic
+
+
+# Class of the data every cached command reads, writes invalidate responses by class.
+CACHED_COMMANDS = {'search': 'documents', 'retrieve': 'documents', 'lookup': 'documents',
+                   'similar': 'documents', 'list-first': 'documents', 'list-last': 'documents',
+                   'retrieve-first': 'documents', 'retrieve-last': 'documents',
+                   'list-words': 'terms', 'alternatives': 'terms', 'list-facets': 'terms',
+                   'list-paths': 'paths'}
+
+# Classes of cached responses made stale by every modifying command.
+INVALIDATED_CLASSES = {'insert': ('documents', 'terms', 'paths'),
+                       'update': ('documents', 'terms', 'paths'),
+                       'replace': ('documents', 'terms', 'paths'),
+                       'partial-replace': ('documents', 'terms', 'paths'),
+                       'delete': ('documents', 'terms'),
+                       'search-delete': ('documents', 'terms'),
+                       'clear': ('documents', 'terms', 'paths'),
+                       'reindex': ('documents', 'terms', 'paths'),
+                       'restore': ('documents', 'terms', 'paths')}
+
+# Request fields left out of cache keys: credentials and the request id that differs for equal requests.
+_UNKEYED_FIELDS = re.compile(r'<cps:(request_id|user|password)>[^<]*</cps:\1>\n?')
+
+
+class ResponseCache(object):
+    """ In-process cache of the raw responses to reading commands, shared by the requests of a Connection.
+
+        Pass it as the cache argument of Connection (or ConnectionPool, ClusterConnection, AsyncConnection).
+        A request's key is its xml request without the credentials and request id, so equal requests hit
+        the same entry and a hit is parsed from the stored response string without a round trip.
+        Entries live for the command's ttl seconds and the least recently used ones are evicted to keep
+        at most max_entries entries and max_bytes response bytes. Modifying commands sent through the
+        connection drop the entries of the classes of commands they make stale (see INVALIDATED_CLASSES),
+        and reads in flight while a write is sent aren't stored. Writes from other clients are only seen
+        when entries expire. Streamed requests, requests sent with Connection.pipeline() (and the iterators
+        and chunked commands using it) and responses with errors aren't cached, but pipelined writes invalidate.
+
+        The same object can be shared by threads and connections.
+
+        Attributes:
+            hits -- Number of requests answered from the cache.
+            misses -- Number of cacheable requests sent to the server.
+            evictions -- Number of entries evicted to stay within max_entries and max_bytes.
+            expirations -- Number of entries found expired.
+            invalidations -- Number of entries dropped by writes.
+            bytes -- Response bytes currently stored.
+
+        >>> cache = ResponseCache(max_entries=2)
+        >>> search = '<cps:command>search</cps:command>\\n<cps:content>\\n<query>{0}</query>\\n</cps:content>'
+        >>> cache.lookup('search', search.format('a'))[0] is None
+        True
+        >>> cache.complete(cache.lookup('search', search.format('a'))[1], '<a/>')
+        >>> cache.lookup('search', '<cps:request_id>7</cps:request_id>\\n' + search.format('a'))[0]
+        '<a/>'
+        >>> for word in 'bc':
+        ...     cache.complete(cache.lookup('search', search.format(word))[1], '<{0}/>'.format(word))
+        >>> len(cache), cache.hits, cache.misses, cache.evictions
+        (2, 1, 4, 1)
+        >>> cache.complete(cache.lookup('insert', '')[1])
+        >>> len(cache), cache.invalidations
+        (0, 2)
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=64 << 20, ttl=60, ttls=None):
+        """
+            Keyword args:
+                max_entries -- Maximum number of stored responses. Default is 10000.
+                max_bytes -- Maximum total size of stored responses. Default is 64 MB.
+                ttl -- Seconds a response of any command in CACHED_COMMANDS is used for. Default is 60.
+                ttls -- A dict of command names and seconds overriding ttl for those commands,
+                        0 or None to not cache a command. Default is None.
+
+            Raises:
+                ParameterError -- The limits are not positive or a command can't be cached.
+        """
+        if max_entries < 1 or max_bytes < 1:
+            raise ParameterError("max_entries={0}, max_bytes={1}".format(max_entries, max_bytes))
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttls = dict((command, ttl) for command in CACHED_COMMANDS)
+        for command, seconds in (ttls or {}).items():
+            if command not in CACHED_COMMANDS:
+                raise ParameterError("Command '{0}' can't be cached, use one of: {1}".format(
+                                     command, ', '.join(sorted(CACHED_COMMANDS))))
+            self.ttls[command] = seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.bytes = 0
+        self._entries = collections.OrderedDict()   # key -> (response, expiry time, class), least recent first.
+        self._class_keys = collections.defaultdict(set)
+        self._generations = collections.defaultdict(int)    # Writes started or completed per class.
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, command, xml_request):
+        """ Look up the response to a request before it's sent, invalidate the cache for a write.
+
+            Args:
+                command -- The request's command name.
+                xml_request -- The fully formed xml request string, or a list of its parts.
+
+            Returns:
+                A (response, ticket) pair: the stored raw response string or None, and the ticket to pass
+                to complete() once the request is sent, or None if the request isn't cached.
+        """
+        ticket = self.invalidate(command)
+        if ticket is not None:
+            return None, ticket
+        with self._lock:
+            ttl = self.ttls.get(command)
+            if not ttl or not isinstance(xml_request, basestring):
+                return None, None
+            if isinstance(xml_request, unicode):
+                xml_request = xml_request.encode('utf-8')
+            key = hashlib.sha1(_UNKEYED_FIELDS.sub('', xml_request)).digest()
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                if entry[1] > monotonic():
+                    self._entries[key] = entry  # Reinserted as the most recently used one.
+                    self.hits += 1
+                    return entry[0], None
+                self._class_keys[entry[2]].discard(key)
+                self.bytes -= len(entry[0])
+                self.expirations += 1
+            self.misses += 1
+            data_class = CACHED_COMMANDS[command]
+            return None, (key, data_class, self._generations[data_class], ttl)
+
+    def invalidate(self, command):
+        """ Drop the responses a modifying command makes stale, before it's sent.
+
+            Args:
+                command -- The request's command name.
+
+            Returns:
+                The ticket to pass to complete() once the request is sent, None if the command doesn't modify.
+        """
+        classes = INVALIDATED_CLASSES.get(command)
+        if classes is None:
+            return None
+        with self._lock:
+            self._invalidate(classes)
+        return None, classes, None, None
+
+    def complete(self, ticket, response=None):
+        """ Store the response to a request looked up with lookup(), or invalidate the cache again after a write.
+
+            Args:
+                ticket -- The ticket returned by lookup().
+
+            Keyword args:
+                response -- The raw response string, None if the request failed. Default is None.
+        """
+        if ticket is None:
+            return
+        key, data_class, generation, ttl = ticket
+        with self._lock:
+            if key is None:
+                self._invalidate(data_class)
+            elif response is not None and generation == self._generations[data_class] and \
+                    len(response) <= self.max_bytes:
+                old = self._entries.pop(key, None)
+                if old is not None:
+                    self.bytes -= len(old[0])
+                self._entries[key] = (response, monotonic() + ttl, data_class)
+                self._class_keys[data_class].add(key)
+                self.bytes += len(response)
+                while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                    old_key, old = self._entries.popitem(last=False)
+                    self._class_keys[old[2]].discard(old_key)
+                    self.bytes -= len(old[0])
+                    self.evictions += 1
+
+    def clear(self):
+        """ Drop all stored responses."""
+        with self._lock:
+            self._invalidate(set(CACHED_COMMANDS.values()))
+
+    def _invalidate(self, classes):
+        for data_class in classes:
+            self._generations[data_class] += 1
+            for key in self._class_keys.pop(data_class, ()):
+                self.bytes -= len(self._entries.pop(key)[0])
+                self.invalidations += 1
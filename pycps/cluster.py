@@ -0,0 +1,295 @@
+#    Copyright 2012 ClusterPoint, SIA
+#
+#    This file is part of Pycps.
+#
+#    Pycps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Pycps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Pycps.  If not, see <http://www.gnu.org/licenses/>.
+
+import httplib
+import socket
+import threading
+
+from connection import *
+from pool import *
+from pool import _send_concurrently, _iter_concurrently
+
+
+# Commands that don't modify the Storage and can be safely resent to another node.
+READ_COMMANDS = frozenset(['search', 'retrieve', 'lookup', 'similar', 'alternatives', 'list-words',
+                           'list-first', 'list-last', 'retrieve-first', 'retrieve-last', 'list-paths',
+                           'list-facets', 'status'])
+
+POLICIES = ('round-robin', 'least-outstanding', 'ewma')
+
+# Transport failures that eject a node. Other ConnectionErrors, like an exhausted ConnectionPool or an error
+# message sent by the server, come from a node that is up and are raised without ejecting it.
+_NODE_ERRORS = (TransportError, socket.error, httplib.HTTPException)
+
+
+class _Node(object):
+    """ A single CPS node of a cluster with the statistics the balancing policies use."""
+    def __init__(self, url, pool):
+        self.url = url
+        self.pool = pool
+        self.outstanding = 0    # Requests in flight.
+        self.latency = None     # EWMA of response times in seconds, None until the first response.
+        self.requests = 0
+        self.failures = 0
+        self.ejected = False
+        self.retry_time = 0     # When an ejected node should be probed next.
+        self.probing = False
+
+
+class ClusterConnection(Connection):
+    """ Connection to several nodes of a CPS cluster, spreading requests between them.
+
+        Has the same API as Connection. Every node is accessed through its own ConnectionPool,
+        so the connection is thread-safe. A node is ejected as soon as a request to it fails with
+        a transport error (see TransportError) and is re-admitted when a status() request to it, sent from
+        a background thread every retry_interval seconds, succeeds within probe_timeout.
+        Reading commands (see READ_COMMANDS) that fail with a transport error are retried on another node,
+        commands modifying the Storage are not, as they might have already been executed.
+    """
+
+    def __init__(self, urls, storage, user, password, account, policy='round-robin', retry_interval=5,
+                 probe_timeout=2, ewma_decay=0.3, min_connections=0, max_connections=10, pool_timeout=None,
+                 cache=None, **kwargs):
+        """ Create a new connection to a CPS cluster.
+
+            Args:
+                urls -- A list of node url strings. See Connection.__init__().
+                See Connection.__init__().
+
+            Keyword args:
+                policy -- How the node for a request is chosen:
+                        'round-robin' -- Each available node in turn (default).
+                        'least-outstanding' -- The node with the fewest requests in flight.
+                        'ewma' -- The node with the lowest exponentially weighted moving average of
+                                response time multiplied by requests in flight plus one.
+                retry_interval -- Seconds to wait before probing an ejected node. Default is 5.
+                probe_timeout -- Deadline in seconds of the status request probing an ejected node. Default is 2.
+                ewma_decay -- Weight of the latest response time in the moving average. Default is 0.3.
+                min_connections -- Connections opened to every node up front. Default is 0,
+                        so nodes that are down at start don't fail the constructor.
+                max_connections -- Maximum number of open connections per node. Default is 10.
+                pool_timeout -- See ConnectionPool.__init__().
+                See Connection.__init__().
+
+            Raises:
+                ParameterError -- No urls or unknown policy given.
+        """
+        if isinstance(urls, basestring):
+            urls = [urls]
+        if not urls:
+            raise ParameterError("No CPS node urls given.")
+        if policy not in POLICIES:
+            raise ParameterError("Unknown balancing policy '{0}', use one of: {1}".format(policy,
+                                                                                         ', '.join(POLICIES)))
+        self.policy = policy
+        self.retry_interval = retry_interval
+        self.probe_timeout = probe_timeout
+        self.ewma_decay = ewma_decay
+        self._cluster_lock = threading.Lock()
+        self._next_node = 0
+        self._nodes = [_Node(url, ConnectionPool(url, storage, user, password, account,
+                                                 min_connections=min_connections,
+                                                 max_connections=max_connections,
+                                                 pool_timeout=pool_timeout, **kwargs))
+                       for url in urls]
+        Connection.__init__(self, urls[0], storage, user, password, account, cache=cache, **kwargs)
+
+    def _open_connection(self):
+        """ Node pools open their connections themselves."""
+        pass
+
+    def close(self):
+        """ Close connections to all nodes."""
+        for node in self._nodes:
+            node.pool.close()
+
+    @property
+    def nodes(self):
+        """ A list of dicts with the url, state and statistics of every node."""
+        with self._cluster_lock:
+            return [{'url': node.url, 'available': not node.ejected, 'outstanding': node.outstanding,
+                     'latency': node.latency, 'requests': node.requests, 'failures': node.failures}
+                    for node in self._nodes]
+
+    def _probe_ejected(self):
+        """ Start probing the ejected nodes that are due from background threads,
+            so an unresponsive node doesn't hold up the caller's request.
+        """
+        now = monotonic()
+        with self._cluster_lock:
+            due = [node for node in self._nodes
+                   if node.ejected and not node.probing and node.retry_time <= now]
+            for node in due:
+                node.probing = True
+        for node in due:
+            thread = threading.Thread(target=self._probe, args=(node,), name='pycps-probe')
+            thread.daemon = True
+            thread.start()
+
+    def _probe(self, node):
+        """ Send a status request to an ejected node and re-admit it if it responds within probe_timeout."""
+        try:
+            node.pool.status(deadline=self.probe_timeout)
+        except _NODE_ERRORS + (TimeoutError,):
+            with self._cluster_lock:
+                node.retry_time = monotonic() + self.retry_interval
+                node.probing = False
+            return
+        except CPSError:   # An error response still means the node is up.
+            pass
+        Debug.ok("Re-admitting CPS node {0}".format(node.url))
+        with self._cluster_lock:
+            node.ejected = False
+            node.probing = False
+
+    def _select_node(self, exclude=()):
+        """ Pick a node for the next request according to the balancing policy.
+
+            Args:
+                exclude -- Nodes not to be picked, e.g. already tried ones.
+
+            Returns:
+                A _Node object. Its outstanding count is incremented, call _release_node() when done.
+
+            Raises:
+                ConnectionError -- No available nodes left.
+        """
+        self._probe_ejected()
+        with self._cluster_lock:
+            nodes = [node for node in self._nodes if not node.ejected and node not in exclude]
+            if not nodes:
+                raise ConnectionError("No available CPS nodes.")
+            if self.policy == 'round-robin':
+                node = nodes[self._next_node % len(nodes)]
+                self._next_node += 1
+            elif self.policy == 'least-outstanding':
+                node = min(nodes, key=lambda node: node.outstanding)
+            else:   # Unmeasured nodes first, so every node gets a latency estimate.
+                node = min(nodes, key=lambda node: (node.latency or 0) * (node.outstanding + 1))
+            node.outstanding += 1
+            node.requests += 1
+        return node
+
+    def _release_node(self, node, seconds=None):
+        """ Update the node's statistics after a request.
+
+            Args:
+                node -- The _Node object returned by _select_node().
+                seconds -- The response time or None if the request failed and the node should be ejected.
+        """
+        with self._cluster_lock:
+            node.outstanding -= 1
+            if seconds is None:
+                node.failures += 1
+                if not node.ejected:
+                    Debug.warn("Ejecting CPS node {0}".format(node.url))
+                    node.ejected = True
+                    node.retry_time = monotonic() + self.retry_interval
+            elif node.latency is None:
+                node.latency = seconds
+            else:
+                node.latency += self.ewma_decay * (seconds - node.latency)
+
+    def _execute(self, request, xml_request):
+        """ Send the request to a node picked by the policy, retrying reads on the other nodes. See Connection._execute()."""
+        send = ('_send_request_streamed' if request.stream else '_send_request')
+        deadline = self._make_deadline(request.deadline)
+        retry = request._command in READ_COMMANDS
+        if self.cache is not None and not request.stream:
+            return self._send_cached(request, xml_request,
+                                     lambda: self._send_to_node(xml_request, send, retry, deadline))
+        return request.handle_response(self._send_to_node(xml_request, send, retry, deadline))
+
+    def _send_request(self, xml_request, deadline=None):
+        """ Send the prepared XML request block to a node. Not retried as the command is unknown here.
+            See Connection._send_request().
+        """
+        return self._send_to_node(xml_request, '_send_request', False, deadline)
+
+    def _send_request_streamed(self, xml_request, deadline=None):
+        return self._send_to_node(xml_request, '_send_request_streamed', False, deadline)
+
+    def _send_to_node(self, xml_request, send, retry, deadline=None):
+        """ Send a request with the named ConnectionPool method.
+
+            Args:
+                xml_request -- A fully formed xml request string for the CPS.
+                send -- Name of the method sending the request.
+                retry -- If True, the request is resent to other nodes on transport errors.
+
+            Keyword args:
+                deadline -- Monotonic time of the request's deadline shared by all tries. Default is None - no limit.
+
+            Returns:
+                Whatever the send method returns.
+
+            Raises:
+                ConnectionError -- No available nodes left.
+                TimeoutError -- The deadline passed.
+        """
+        tried = []
+        while True:
+            node = self._select_node(tried)
+            start = monotonic()
+            try:
+                response = getattr(node.pool, send)(xml_request, deadline)
+            except TimeoutError:    # A slow response, the node is counted as slow but not ejected.
+                self._release_node(node, monotonic() - start)
+                raise
+            except _NODE_ERRORS:
+                self._release_node(node)
+                tried.append(node)
+                if not retry or len(tried) >= len(self._nodes) or (deadline is not None and deadline <= monotonic()):
+                    raise
+                Debug.warn("Retrying the request on another CPS node.")
+                continue
+            except:
+                self._release_node(node, monotonic() - start)
+                raise
+            self._release_node(node, monotonic() - start)
+            return response
+
+    def _send_chunks(self, requests, merge):
+        """ Send the chunks of a split request concurrently, spread over the nodes. See Connection._send_chunks()."""
+        return merge(_send_concurrently(requests, sum(node.pool._max_connections for node in self._nodes)))
+
+    def _scan(self, requests, parallelism, ordered):
+        """ Send the requests of a scan concurrently, spread over the nodes. See Connection._scan()."""
+        return _iter_concurrently(requests, min(parallelism, sum(node.pool._max_connections for node in self._nodes)),
+                                  ordered)
+
+    def _send_pipelined(self, xml_requests, depth):
+        """ Pipeline xml requests to a single node. See Connection._send_pipelined()."""
+        node = self._select_node()
+        start = monotonic()
+        count = 0
+        seconds = None
+        try:
+            for response in node.pool._send_pipelined(xml_requests, depth):
+                count += 1
+                yield response
+            seconds = (monotonic() - start) / max(count, 1)
+        except TimeoutError:
+            seconds = monotonic() - start
+            raise
+        except _NODE_ERRORS:
+            raise
+        except:     # Not a node failure.
+            seconds = monotonic() - start
+            raise
+        finally:
+            self._release_node(node, seconds)
@@ -15,11 +15,320 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with Pycps.  If not, see <http://www.gnu.org/licenses/>.
 
+import base64
+import collections
+import errno
+import hashlib
 import httplib
+import itertools
+import json
+import Queue
 import urlparse
 import socket
+import threading
+import zlib
 
 from request import *
+from response import Response, _merge_responses
+from protobuf import *
+from batching import *
+from cache import *
+from query import term, terms_from_dict, and_terms, numeric_ordering, string_ordering
+
+
+_SEND_JOIN_LIMIT = 16384                # Messages up to this size are joined and sent in one call.
+_RECV_BUFFER_SIZE = 65536               # Initial size of the per connection recieve buffer.
+_RECV_BUFFER_KEEP_LIMIT = 4194304       # Larger recieve buffers are not kept between responses.
+_HTTP_CHUNK_SIZE = 65536                # Uncompressed bytes per chunk of a gzip compressed http request body.
+_ID_CHUNK_SIZE = 10000                  # Default number of ids per request for delete, retrieve and lookup.
+_MULTI_GET_CHUNK_SIZE = 1000           # Default number of ids per request for iter_retrieve and iter_lookup.
+_DOCUMENT_NOT_FOUND = 2824              # Error code for requested documents that don't exist.
+_GZIP_WBITS = 16 + zlib.MAX_WBITS       # zlib window bits for the gzip format.
+# Commands not resent after the connection failed once they were sent: the server may have executed them
+# and the resend would report the documents as already existing or missing.
+_NOT_RESENT_COMMANDS = frozenset(['insert', 'delete'])
+
+
+def _request_command(xml_request):
+    """ Get the command of a fully formed xml request string, or a list of its parts, without parsing it."""
+    if isinstance(xml_request, list):
+        xml_request = xml_request[0]
+    start = xml_request.find('<cps:command>')
+    if start < 0:
+        return None
+    start += len('<cps:command>')
+    return xml_request[start:xml_request.find('<', start)]
+
+
+def _response_from_fields(fields):
+    """ Get the raw xml response string from decoded response message fields.
+
+        Raises:
+            ConnectionError -- The server sent an error message instead of a response.
+            TransportError -- The message has neither.
+    """
+    if ERROR_FIELD in fields:
+        error = fields[ERROR_FIELD]
+        error = (error.tobytes() if isinstance(error, memoryview) else str(error))
+        if REQUEST_FIELD not in fields:
+            raise ConnectionError(error)
+        Debug.warn("Server error message: " + error)
+    try:
+        response = fields[REQUEST_FIELD]
+    except KeyError:
+        raise TransportError("No response in the recieved message.")
+    return (response.tobytes() if isinstance(response, memoryview) else str(response))
+
+
+def _iter_gzip_chunks(data, chunk_size=_HTTP_CHUNK_SIZE, level=6):
+    """ Compress a string, or a list of string or buffer parts, to the gzip format piece by piece.
+
+        Returns:
+            A generator of compressed non-empty strings.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+    for part in (data if isinstance(data, list) else [data]):
+        for offset in xrange(0, len(part), chunk_size):
+            chunk = compressor.compress(part[offset:offset + chunk_size])
+            if chunk:
+                yield chunk
+    yield compressor.flush()
+
+
+def _request_lenght(xml_request):
+    """ Get the size of a xml request string or a list of its parts."""
+    if isinstance(xml_request, list):
+        return sum([len(part) for part in xml_request])
+    return len(xml_request)
+
+
+class _GzipReader(object):
+    """ File-like object decompressing gzip data read from another file-like object as it's read."""
+
+    def __init__(self, read, chunk_size=_HTTP_CHUNK_SIZE):
+        """
+            Args:
+                read -- A function reading up to a given number of compressed bytes, returning '' at the end.
+        """
+        self._read = read
+        self._chunk_size = chunk_size
+        self._decompressor = zlib.decompressobj(_GZIP_WBITS)
+        self._tail = ''     # Compressed data not decompressed yet because of the size limit.
+        self._eof = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                chunk = self.read(self._chunk_size * 4)
+                if not chunk:
+                    return ''.join(chunks)
+                chunks.append(chunk)
+        while not self._eof:
+            data = self._tail or self._read(self._chunk_size)
+            if not data:
+                self._eof = True
+                return self._decompressor.flush()
+            chunk = self._decompressor.decompress(data, size)
+            self._tail = self._decompressor.unconsumed_tail
+            if chunk:
+                return chunk
+        return ''
+
+
+class _ResponseStream(object):
+    """ File-like object reading a single raw xml response straight from a connection."""
+
+    def __init__(self, read, lenght, finish):
+        """
+            Args:
+                read -- A function reading up to a given number of bytes from the connection.
+                lenght -- Number of bytes in the response or None if read() returns '' at the end of it.
+                finish -- A function called with True when the response is read completely or with False
+                        when the stream is closed before that.
+        """
+        self._read = read
+        self._remaining = lenght
+        self._finish = finish
+        self.closed = False
+
+    def read(self, size=-1):
+        if self.closed:
+            return ''
+        if self._remaining is not None:
+            if size < 0 or size > self._remaining:
+                size = self._remaining
+            if size == 0:
+                self._close(True)
+                return ''
+        try:
+            data = (self._read(size) if size >= 0 else self._read())
+        except socket.timeout:
+            self._close(False)
+            raise TimeoutError("The deadline passed while reading the response.")
+        except:
+            self._close(False)
+            raise
+        if self._remaining is None:
+            if not data:
+                self._close(True)
+        elif not data:
+            self._close(False)
+            raise TransportError("Connection closed while recieving the response.")
+        else:
+            self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._close(self._remaining == 0)
+
+    def _close(self, complete):
+        if not self.closed:
+            self.closed = True
+            self._finish(complete)
+
+
+def _page_end(response, page_offset):
+    """ Get the offset after the last document of a paged result set from a page's response, None if it's empty."""
+    if not response.found:
+        return None
+    return page_offset + response.found + response.more
+
+
+def _prefetched(iterator, size):
+    """ Iterate over an iterator advanced by a background thread, up to size items ahead of the caller.
+
+        Errors raised by the iterator are raised to the caller. When the caller stops iterating,
+        the thread stops and the iterator is closed before the generator returns.
+    """
+    items = Queue.Queue(size)
+    stop = threading.Event()
+
+    def put(item, error):
+        while not stop.is_set():
+            try:
+                items.put((item, error), timeout=0.05)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for item in iterator:
+                if not put(item, None):
+                    return
+        except Exception as e:
+            put(None, e)
+        else:
+            put(_prefetched, None)  # The function itself marks the end.
+        finally:
+            iterator.close()
+
+    thread = threading.Thread(target=run, name='pycps-prefetch')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _prefetched:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class KeysetCursor(object):
+    """ Iterator over all documents found by a search in the order of a unique key, such as the document id.
+
+        Every page is a search for the documents with keys after the last key of the previous page,
+        ordered by the key, so the server doesn't rank and skip the documents of the previous pages
+        and every page costs about the same however deep it is. The token property is a string
+        that resumes the iteration after the last document returned, so it can be stored between
+        runs of a batch job. Documents inserted behind the cursor are skipped, others are returned
+        once, unless their key changes while iterating.
+
+        Attributes:
+            key -- The key of the last document returned, None before the first one.
+    """
+
+    def __init__(self, connection, query, key_xpath=None, page_size=100, numeric=False, prefetch=1,
+                 doc_format='dict', cursor=None, **kwargs):
+        """ See Connection.iter_keyset()."""
+        if page_size < 1 or prefetch < 0:
+            raise ParameterError("page_size={0}, prefetch={1}".format(page_size, prefetch))
+        if not isinstance(query, basestring):
+            query = terms_from_dict(query)
+        if isinstance(query, unicode):  # Kept as utf-8 bytes, so keys of either type can be added to it.
+            query = query.encode('utf-8')
+        self.connection = connection
+        self.key_xpath = key_xpath or connection.document_id_xpath
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self.doc_format = doc_format
+        self._query = query
+        self._path = '/'.join([connection.document_root_xpath] +
+                              [step for step in self.key_xpath.split('/') if step not in ('', '.')])
+        self._ordering = (numeric_ordering if numeric else string_ordering)(self._path)
+        self._kwargs = kwargs
+        path = (self._path.encode('utf-8') if isinstance(self._path, unicode) else self._path)
+        self._fingerprint = hashlib.sha1('\n'.join([query, path, str(bool(numeric))])).hexdigest()[:16]
+        self.key = self._decode(cursor) if cursor else None
+        self._documents = None
+
+    @property
+    def token(self):
+        """ A string to pass as the cursor argument of Connection.iter_keyset() with the same query and key
+            to continue after the last document returned.
+        """
+        return base64.urlsafe_b64encode(json.dumps([self._fingerprint, self.key]))
+
+    def _decode(self, cursor):
+        try:
+            fingerprint, key = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        except (TypeError, ValueError):
+            raise ParameterError("cursor=" + repr(cursor))
+        if fingerprint != self._fingerprint:
+            raise ParameterError("cursor is for a different query or key: " + repr(cursor))
+        return key
+
+    def _make_request(self, last_key):
+        """ Make the search for the page after the document with last_key, the first page if it's None."""
+        query = self._query
+        if last_key is not None:
+            if isinstance(last_key, unicode):
+                last_key = last_key.encode('utf-8')
+            query = and_terms(query, term('>' + last_key, self._path))
+        return SearchRequest(self.connection, query, docs=self.page_size, ordering=self._ordering, **self._kwargs)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._documents is None:
+            self._documents = self._iter_documents()
+        return next(self._documents)
+
+    __next__ = next
+
+    def close(self):
+        """ Stop fetching pages. The token stays valid."""
+        if self._documents is not None:
+            self._documents.close()
+
+    def _iter_documents(self):
+        pages = self.connection._fetch_keyset_pages(self._make_request, self.key_xpath, self.key, self.prefetch)
+        try:
+            for response, documents in pages:
+                for document in documents:
+                    converted = response._convert_document(document, self.doc_format)
+                    self.key = document.findtext(self.key_xpath)
+                    yield converted
+        finally:
+            pages.close()
 
 
 class Connection(object):
@@ -31,7 +340,8 @@ class Connection(object):
 
     def __init__(self, url, storage, user, password, account,
                     document_root_xpath = 'document', document_id_xpath = './id',
-                    selector_url = '/cgi-bin/cps2-cgi', application='PYCPS',  reply_charset=None):
+                    selector_url = '/cgi-bin/cps2-cgi', application='PYCPS',  reply_charset=None,
+                    deadline=None, accept_gzip=True, gzip_requests=None, cache=None):
         """ Create a new connection to CPS.
 
             Args:
@@ -48,6 +358,15 @@ class Connection(object):
                 selector_urli -- A nonstandart selector url for xml requests. Default is '/cgi-bin/cps2-cgi'.
                 application -- Optional application string. Default is 'PYCPS'.
                 reply_charset -- Optional reply charset string.
+                deadline -- Default number of seconds a request may take from connecting and sending
+                        it to recieving the whole response. Can be overriden per request with the
+                        deadline keyword argument. Default is None - no limit.
+                accept_gzip -- If True, http responses are requested gzip compressed and are decompressed
+                        while they are read. Servers and proxies that don't compress ignore it. Default is True.
+                gzip_requests -- Size in bytes from which http request bodies are gzip compressed and sent
+                        with chunked transfer encoding while compressing. The server or a proxy in front of it
+                        has to accept compressed requests. Default is None - never compress requests.
+                cache -- A ResponseCache for the responses to reading commands. Default is None - no cache.
         """
         self._debug = 0
         self._storage = storage
@@ -61,6 +380,14 @@ class Connection(object):
         self.application = application
         self.reply_charset = reply_charset
 
+        self._recv_buffer = None
+        self._stream = None     # Response stream being read from the connection.
+        self.deadline = deadline
+        self.accept_gzip = accept_gzip
+        self.gzip_requests = gzip_requests
+        self.cache = cache
+        self._deadline = self._make_deadline(None)  # Monotonic time the current request must finish by.
+
         self._set_url(url)
         self._open_connection()
 
@@ -95,32 +422,157 @@ class Connection(object):
         """ Open a new connection socket to the CPS."""
         if self._scheme == 'unix':
             self._connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, 0)
-            self._connection.connect(self._path)
+            self._connect_socket(self._path)
         elif self._scheme == 'tcp':
             self._connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.SOL_TCP)
-            self._connection.connect((self._host, self._port))
+            self._connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._connect_socket((self._host, self._port))
         elif self._scheme == 'http':
             self._connection =  httplib.HTTPConnection(self._host, self._port, strict=False)
         else:
             raise ConnectionError("Connection scheme not recognized!")
 
+    def _connect_socket(self, address):
+        """ Connect the new unix or tcp socket before the request deadline."""
+        try:
+            self._apply_deadline(self._connection)
+            self._connection.connect(address)
+        except (socket.timeout, TimeoutError):
+            self._connection.close()
+            raise TimeoutError("The deadline passed while connecting to {0}.".format(address))
+
+    def _make_deadline(self, seconds):
+        """ Get the monotonic time a request started now must finish by.
+
+            Args:
+                seconds -- Seconds the request may take or None to use the connection's default deadline.
+
+            Returns:
+                The deadline or None if there is no limit.
+        """
+        if seconds is None:
+            seconds = self.deadline
+        return (monotonic() + seconds if seconds is not None else None)
+
+    def _time_left(self):
+        """ Get the seconds left until the current request's deadline or None if there is no deadline.
+
+            Raises:
+                TimeoutError -- The deadline has already passed.
+        """
+        if self._deadline is None:
+            return None
+        remaining = self._deadline - monotonic()
+        if remaining <= 0:
+            raise TimeoutError("The deadline passed before the response was recieved.")
+        return remaining
+
+    def _apply_deadline(self, sock):
+        """ Make the socket's blocking calls time out when the current request's deadline passes."""
+        sock.settimeout(self._time_left())
+
+    def _abort_request(self, error):
+        """ Close the connection after a request timed out, as the rest of its response may still arrive.
+
+            Returns:
+                A TimeoutError to be raised.
+        """
+        self._stream = None
+        self._connection.close()
+        if isinstance(error, TimeoutError):
+            return error
+        return TimeoutError("The deadline passed before the response was recieved.")
+
+    def close(self):
+        """ Close the connection socket to the CPS."""
+        self._stream = None
+        self._connection.close()
+
+    def _execute(self, request, xml_request):
+        """ Send the request's XML request block and make a Response object from the reply.
+
+            Args:
+                request -- The Request object being sent.
+                xml_request -- The fully formed xml request string made by the request.
+
+            Returns:
+                Response object.
+        """
+        deadline = self._make_deadline(request.deadline)
+        if request.stream:
+            return request.handle_response(self._send_request_streamed(xml_request, deadline))
+        if self.cache is not None:
+            return self._send_cached(request, xml_request, lambda: self._send_request(xml_request, deadline))
+        return request.handle_response(self._send_request(xml_request, deadline))
+
+    def _invalidate_cache(self, request):
+        """ Drop the cached responses a request about to be sent makes stale, if it modifies the Storage.
+            Every path sending modifying requests past _execute() has to call it.
+
+            Returns:
+                A ticket to pass to _complete_cache() once the request is sent or None.
+        """
+        if self.cache is None:
+            return None
+        return self.cache.invalidate(request._command)
+
+    def _complete_cache(self, ticket):
+        """ Invalidate the cache again after a request from _invalidate_cache() is sent or failed."""
+        if ticket is not None:
+            self.cache.complete(ticket)
 
-    def _send_request(self, xml_request):
+    def _send_cached(self, request, xml_request, send):
+        """ Get the response to a request from the connection's cache or send it and store the response.
+
+            Args:
+                request -- The Request object being sent.
+                xml_request -- The fully formed xml request string made by the request.
+                send -- A function sending the request and returning the raw response string.
+
+            Returns:
+                Response object.
+        """
+        raw_response, ticket = self.cache.lookup(request._command, xml_request)
+        if raw_response is not None:
+            return request.handle_response(raw_response)
+        try:
+            raw_response = send()
+            response = request.handle_response(raw_response)
+        except Exception:
+            self.cache.complete(ticket)
+            raise
+        self.cache.complete(ticket, None if response.errors else raw_response)
+        return response
+
+    def _send_request(self, xml_request, deadline=None):
         """ Send the prepared XML request block to the CPS using the corect protocol.
 
             Args:
                 xml_request -- A fully formed xml request string for the CPS.
 
+            Keyword args:
+                deadline -- Monotonic time (see utils.monotonic()) the response must be recieved by.
+                        Default is None - no limit.
+
             Returns:
                 The raw xml response string.
 
             Raises:
                 ConnectionError -- Can't establish a connection with the server.
+                TransportError -- The connection broke while sending the request or recieving the response.
+                TimeoutError -- The deadline passed, the connection's socket is closed.
         """
-        if self._scheme == 'http':
-            return self._send_http_request(xml_request)
-        else:
-            return self._send_socket_request(xml_request)
+        self._close_stream()
+        self._deadline = deadline
+        try:
+            if self._scheme == 'http':
+                return self._send_http_request(xml_request)
+            else:
+                return self._send_socket_request(xml_request)
+        except (socket.timeout, TimeoutError) as e:
+            raise self._abort_request(e)
+        except (socket.error, httplib.HTTPException) as e:
+            raise TransportError(str(e) or e.__class__.__name__)
 
     def _send_http_request(self, xml_request):
         """ Send a request via HTTP protocol.
@@ -131,17 +583,171 @@ class Connection(object):
             Returns:
                 The raw xml response string.
         """
+        response = self._start_http_request(xml_request)
+        self._apply_deadline(self._http_socket)
+        data = response.read()
+        if response.getheader('content-encoding', '').lower() == 'gzip':
+            try:
+                data = zlib.decompress(data, _GZIP_WBITS)
+            except zlib.error as e:
+                raise TransportError("Invalid gzip compressed response: {0}".format(e))
+        return data
+
+    def _start_http_request(self, xml_request):
+        """ Send a request via HTTP protocol and return the httplib response with the body still unread."""
         headers = {"Host": self._host, "Content-Type": "text/xml", "Recipient": self._storage}
+        if self.accept_gzip:
+            headers["Accept-Encoding"] = "gzip"
+        if isinstance(xml_request, unicode):
+            xml_request = xml_request.encode('utf-8')
+        reused = self._connection.sock is not None
+        sent = False
         try: # Retry once if failed in case the socket has just gone bad.
-            self._connection.request("POST", self._selector_url, xml_request, headers)
+            self._start_http_send(xml_request, headers)
+            sent = True
             response = self._connection.getresponse()
-        except (httplib.CannotSendRequest, httplib.BadStatusLine):
+        except (httplib.CannotSendRequest, httplib.BadStatusLine, socket.error) as e:
+            if isinstance(e, socket.error) and (isinstance(e, socket.timeout) or not reused or
+                                                e.args[0] not in (errno.EPIPE, errno.ECONNRESET)):
+                raise   # Only a kept alive connection closed by the server is worth reconnecting.
+            if sent and _request_command(xml_request) in _NOT_RESENT_COMMANDS:
+                self._connection.close()
+                raise TransportError("The connection was closed after sending the request, "
+                                      "it's not resent as it may have been executed.")
             Debug.warn("\nRestarting socket, resending message!")
             self._open_connection()
-            self._connection.request("POST", self._selector_url, xml_request, headers)
+            self._start_http_send(xml_request, headers)
             response = self._connection.getresponse()
-        data = response.read()
-        return data
+        return response
+
+    def _start_http_send(self, xml_request, headers):
+        """ Send the HTTP request within the deadline and remember its socket to time out the response reading.
+            Request bodies of gzip_requests bytes or more are compressed and sent in chunks.
+        """
+        self._connection.timeout = self._time_left()    # Used by httplib when it connects.
+        if self._connection.sock is not None:
+            self._apply_deadline(self._connection.sock)
+        compress = self.gzip_requests is not None and _request_lenght(xml_request) >= self.gzip_requests
+        if not compress and not isinstance(xml_request, list):
+            self._connection.request("POST", self._selector_url, xml_request, headers)
+        else:
+            self._connection.putrequest("POST", self._selector_url, skip_host=True, skip_accept_encoding=True)
+            for name, value in headers.items():
+                self._connection.putheader(name, value)
+            if compress:
+                self._connection.putheader("Content-Encoding", "gzip")
+            self._connection.putheader("Transfer-Encoding", "chunked")
+            self._connection.endheaders()
+            for chunk in (_iter_gzip_chunks(xml_request) if compress else xml_request):
+                if not len(chunk):
+                    continue
+                self._apply_deadline(self._connection.sock)
+                self._connection.send("{0:x}\r\n".format(len(chunk)))
+                self._connection.send(chunk)    # Buffer parts are sent without copying them.
+                self._connection.send("\r\n")
+            self._connection.send("0\r\n\r\n")
+        self._http_socket = self._connection.sock   # httplib forgets it when the server closes the connection.
+        self._apply_deadline(self._http_socket)
+
+    def _send_request_streamed(self, xml_request, deadline=None):
+        """ Send the prepared XML request block to the CPS without reading the response.
+
+            Args:
+                xml_request -- A fully formed xml request string for the CPS.
+
+            Keyword args:
+                deadline -- Monotonic time the whole response must be read by. See _send_request().
+
+            Returns:
+                A file-like _ResponseStream object reading the raw xml response straight from the connection.
+                The connection can't be used for other requests until the stream is read or closed.
+        """
+        self._close_stream()
+        self._deadline = deadline
+        try:
+            if self._scheme == 'http':
+                response = self._start_http_request(xml_request)
+                sock = self._http_socket
+
+                def read(size=-1):
+                    self._apply_deadline(sock)
+                    return response.read(size if size >= 0 else None)
+                if response.getheader('content-encoding', '').lower() == 'gzip':
+                    read = _GzipReader(read).read
+
+                def finish(complete):
+                    self._stream = None
+                    if not (complete or response.isclosed()):
+                        # Unread body left in the socket, httplib reconnects on the next request.
+                        self._connection.close()
+                self._stream = _ResponseStream(read, None, finish)
+            else:
+                self._send_socket_message(self._encode_socket_request(xml_request))
+                try:
+                    self._stream = self._recieve_socket_stream()
+                except (ConnectionError, socket.error):
+                    self._connection.close()    # Reconnected when the next request is sent.
+                    raise
+        except (socket.timeout, TimeoutError) as e:
+            raise self._abort_request(e)
+        except (socket.error, httplib.HTTPException) as e:
+            raise TransportError(str(e) or e.__class__.__name__)
+        return self._stream
+
+    def _close_stream(self):
+        """ Close the response stream still being read from this connection, if any."""
+        if self._stream is not None:
+            self._stream.close()
+
+    def _recieve_socket_stream(self):
+        """ Read a response message header and the fields before the xml response from the socket.
+
+            Returns:
+                A _ResponseStream reading the xml response field from the socket.
+        """
+        remaining = parse_header(self._socket_recieve(HEADER_LENGHT))
+        error = None
+        while remaining > 0:
+            key, used = self._recieve_socket_varint()
+            remaining -= used
+            if key & 0x07 != WIRE_LENGHT_DELIMITED:
+                raise TransportError("Unexpected wire type in the response message.")
+            lenght, used = self._recieve_socket_varint()
+            remaining -= used
+            if key >> 3 == REQUEST_FIELD:
+                trailing = remaining - lenght
+
+                def read(size):
+                    self._apply_deadline(self._connection)
+                    return self._connection.recv(size)
+
+                def finish(complete):
+                    self._stream = None
+                    if complete:
+                        self._socket_recieve(trailing)   # Fields after the response, like storage name.
+                    else:   # Reconnected when the next request is sent.
+                        self._connection.close()
+                return _ResponseStream(read, lenght, finish)
+            data = self._socket_recieve(lenght).tobytes()
+            remaining -= lenght
+            if key >> 3 == ERROR_FIELD:
+                error = data
+        if error:
+            raise ConnectionError(error)
+        raise TransportError("No response in the recieved message.")
+
+    def _recieve_socket_varint(self):
+        """ Read a single varint from the socket.
+
+            Returns:
+                A tuple of the decoded number and number of bytes read.
+        """
+        data = bytearray()
+        while True:
+            byte = self._socket_recieve(1)[0]
+            data.append(byte)
+            if not ord(byte) & 0x80:
+                return (decode_varint(data)[0], len(data))
 
     def _send_socket_request(self, xml_request):
         """ Send a request via protobuf.
@@ -152,132 +758,158 @@ class Connection(object):
             Returns:
                 The raw xml response string.
         """
-        def to_variant(number):
-            buff = []
-            while number:
-                byte = number % 128
-                number = number // 128
-                if number > 0:
-                    byte |= 0x80
-                buff.append(chr(byte))
-            return ''.join(buff)
-
-        def from_variant(stream):
-            used = 0
-            number = 0
-            q = 1
-            while True:
-                byte = ord(stream[used])
-                used += 1
-                number += q * (byte & 0x7F)
-                q *= 128
-                if byte&0x80==0:
-                    break
-            return (number, used)
+        self._send_socket_message(self._encode_socket_request(xml_request))
+        try:
+            return self._recieve_socket_response()
+        except (socket.timeout, TimeoutError):
+            raise
+        except (ConnectionError, socket.error):
+            # Close the socket, so the next request reconnects instead of being sent on a dead connection.
+            self._connection.close()
+            raise
 
-        def encode_fields(fields):
-            chunks = []
-            for field_id, message in fields.items():
-                chunks.append(to_variant((field_id << 3) | 2)) # Hardcoded WireType=2
-                chunks.append(to_variant(len(message)))
-                chunks.append(message)
-            return ''.join(chunks)
-
-        def decode_fields(stream):
-            fields = {}
-            offset = 0
-            stream_lenght = len(stream)
-            while offset<stream_lenght:
-                field_header, used = from_variant(stream[offset:])
-                offset += used
-                wire_type = field_header & 0x07
-                field_id = field_header >> 3
-                if wire_type==2:
-                    message_lenght, used = from_variant(stream[offset:])
-                    offset += used
-                    fields[field_id] = stream[offset:offset+message_lenght]
-                    offset += message_lenght
-                elif wire_type==0:
-                    fields[field_id], used = from_variant(stream[offset:])
-                    offset += used
-                elif wire_type==1:
-                    fields[field_id] = stream[offset:offset+8]
-                    offset += 8
-                elif wire_type==3:
-                    raise ConnectionError()
-                elif wire_type==4:
-                    raise ConnectionError()
-                elif wire_type==5:
-                    fields[field_id] = stream[offse:offset+4]
-                    offset += 4
-                else:
-                    raise ConnectionError()
-            return fields
-
-
-        def make_header(lenght):
-            result = []
-            result.append(chr((lenght & 0x000000FF)))
-            result.append(chr((lenght & 0x0000FF00) >> 8))
-            result.append(chr((lenght & 0x00FF0000) >> 16))
-            result.append(chr((lenght & 0xFF000000) >> 24))
-            return '\t\t\x00\x00' + ''.join(result)
-
-        def parse_header(header):
-            if len(header) == 8 and header[0] == '\t' and header[1] == '\t' and\
-                    header[2] == '\00' and header[3] == '\00':
-                return ord(header[4]) | (ord(header[5]) << 8) |\
-                        (ord(header[6]) << 16) | (ord(header[7]) << 24)
-            else:
-                raise ConnectionError()
+    def _send_socket_message(self, message):
+        """ Send an encoded request message, reconnecting once if the socket has gone bad."""
+        try: # Retry once if failed in case the socket has just gone bad.
+            self._socket_send(message)
+        except (socket.timeout, TimeoutError):
+            raise
+        except (ConnectionError, socket.error):
+            self._connection.close()
+            self._open_connection()
+            self._socket_send(message)
+
+    def _encode_socket_request(self, xml_request):
+        """ Wrap a xml request string, or a list of its string or buffer parts, in the protobuf fields
+            and the message header.
+
+            Returns:
+                A list of string parts making up the message, so the request isn't copied to join them.
+        """
+        if isinstance(xml_request, unicode):
+            xml_request = xml_request.encode('utf-8')
+        parts = (xml_request if isinstance(xml_request, list) else [xml_request])
+        lenght = _request_lenght(xml_request)
+        storage = self._storage if self._storage else "special:detect-storage"
+        request_prefix = encode_field_prefix(REQUEST_FIELD, lenght)
+        storage_field = encode_field_prefix(STORAGE_FIELD, len(storage)) + storage
+        header = make_header(len(request_prefix) + lenght + len(storage_field))
+        return [header + request_prefix] + parts + [storage_field]
+
+    def _recieve_socket_response(self):
+        """ Read one framed response message from the socket and return the raw xml response string."""
+        header = self._socket_recieve(HEADER_LENGHT)
+        lenght = parse_header(header)
+        return _response_from_fields(decode_fields(self._socket_recieve(lenght)))
+
+    def _socket_send(self, parts):
+        """ Send a message made of string parts without joining them.
 
-        def socket_send(data):
+            Args:
+                parts -- A list of strings or buffers (or a single string) to be sent one after another.
+        """
+        if isinstance(parts, basestring):
+            parts = [parts]
+        if sum([len(part) for part in parts]) <= _SEND_JOIN_LIMIT:
+            parts = [''.join(map(str, parts))]    # One packet for small messages.
+        for part in parts:
+            try:
+                data = memoryview(part)     # Slicing a memoryview doesn't copy the data.
+            except TypeError:
+                data = part     # An old style buffer, e.g. a range of a memory mapped file.
             sent_bytes = 0
             failures = 0
             total_bytes = len(data)
             while sent_bytes < total_bytes:
-                sent = self._connection.send(data[sent_bytes:])
+                self._apply_deadline(self._connection)
+                sent = self._connection.send(data[sent_bytes:] if isinstance(data, memoryview) else
+                                             buffer(data, sent_bytes))
                 if sent == 0:
                     failures += 1
                     if failures > 5:
-                        raise ConnectionError()
+                        raise TransportError("Connection closed while sending the request.")
                     continue
                 sent_bytes += sent
 
-        def socket_recieve(lenght):
-            total_recieved = 0
-            failures = 5
-            recieved_chunks = []
-            while total_recieved<lenght:
-                chunk = self._connection.recv(lenght-total_recieved)
-                if not chunk:
-                    failures += 1
-                    if failures > 5:
-                        raise ConnectionError()
-                    continue
-                recieved_chunks.append(chunk)
-                total_recieved += len(chunk)
-            return ''.join(recieved_chunks)
+    def _socket_recieve(self, lenght):
+        """ Recieve exactly lenght bytes into the connection's reusable recieve buffer.
+
+            Returns:
+                A memoryview of the recieved bytes, valid until the next call.
+        """
+        buffer = self._recv_buffer
+        if buffer is None or len(buffer) < lenght:
+            buffer = bytearray(max(lenght, _RECV_BUFFER_SIZE))
+            if len(buffer) <= _RECV_BUFFER_KEEP_LIMIT:   # Don't hold on to huge buffers.
+                self._recv_buffer = buffer
+        view = memoryview(buffer)[:lenght]
+        total_recieved = 0
+        failures = 5
+        while total_recieved<lenght:
+            self._apply_deadline(self._connection)
+            recieved = self._connection.recv_into(view[total_recieved:])
+            if not recieved:
+                failures += 1
+                if failures > 5:
+                    raise TransportError("Connection closed while recieving the response.")
+                continue
+            total_recieved += recieved
+        return view
+
+    def _send_pipelined(self, xml_requests, depth):
+        """ Send xml requests back to back and yield the raw responses in the same order.
 
-        encoded_message = encode_fields({1: xml_request,
-                                         2: self._storage if self._storage else "special:detect-storage"})
-        header = make_header(len(encoded_message))
+            Args:
+                xml_requests -- An iterable of fully formed xml request strings for the CPS.
+                depth -- Maximum number of requests sent ahead of the recieved responses.
 
-        try: # Retry once if failed in case the socket has just gone bad.
-            socket_send(header+encoded_message)
-        except (ConnectionError, socket.error):
-            self._connection.close()
-            self._open_connection()
-            socket_send(header+encoded_message)
+            Returns:
+                A generator of raw xml response strings.
 
-        # TODO: timeout
-        header = socket_recieve(8)
-        lenght = parse_header(header)
-        encoded_response = socket_recieve(lenght)
-        response = decode_fields(encoded_response)
-        # TODO: Test for id=3 error message
-        # TODO: check for and raise errors
-        return response[1]
+            The connection's default deadline applies to sending each batch of requests
+            and to recieving each response.
+        """
+        self._close_stream()
+        if self._scheme == 'http':   # httplib can't pipeline, so fall back to one request at a time.
+            for xml_request in xml_requests:
+                yield self._send_request(xml_request, self._make_deadline(None))
+            return
+        xml_requests = iter(xml_requests)
+        pending = 0
+        sending = False     # A request may be partly written to the socket.
+        exhausted = False
+        try:
+            while True:
+                self._deadline = self._make_deadline(None)
+                while not exhausted and pending < depth:
+                    try:
+                        xml_request = next(xml_requests)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    message = self._encode_socket_request(xml_request)
+                    sending = True
+                    if pending:
+                        self._socket_send(message)
+                    else:   # Nothing in flight, so reconnect if the socket was closed, e.g. after a timeout.
+                        self._send_socket_message(message)
+                    sending = False
+                    pending += 1
+                if not pending:
+                    break
+                self._deadline = self._make_deadline(None)
+                response = self._recieve_socket_response()
+                pending -= 1
+                yield response
+        except socket.timeout:
+            raise TimeoutError("The deadline passed before the response was recieved.")
+        except socket.error as e:
+            raise TransportError(str(e))
+        finally:
+            if pending or sending:
+                # Unread responses or a partly sent request are left in the stream, so the socket can't be
+                # reused. Closed here, it's reopened when the next request is sent, see _send_socket_message().
+                self._connection.close()
 
 
 # Data manipulation methods
@@ -342,19 +974,79 @@ class Connection(object):
         """
         return UpdateRequest(self, *args, **kwargs).send()
 
-    def delete(self, *args, **kwargs):
+    def insert_iter(self, documents, chunk_size=1000, fully_formed=False, depth=2, **kwargs):
+        """ Insert documents from an iterable or generator, sending them in chunks of chunk_size documents.
+
+        Documents are read and converted to xml only for the chunk being sent, so any number of them
+        can be inserted in constant memory. Chunks are pipelined, the next one is converted while the
+        Storage processes the previous ones.
+
+        Args:
+            documents -- If fully_formed is False (default), an iterable of (id, document) pairs where document can be
+                        ether xml string, etree.ElementTree or dict representation of an xml document (see dict_to_etree()).
+                        If fully_formed is True, an iterable of documents with the right root tag and id fields.
+
+        Keyword args:
+            chunk_size -- Number of documents sent in one request or an AdaptiveBatchSize object
+                        choosing it from the latency of the previous chunks. Default is 1000.
+            fully_formed -- See insert().
+            depth -- Maximum number of chunks sent ahead of the recieved responses. See pipeline(). Default is 2.
+            See Request.__init__(), they are passed to every chunk's request.
+
+        Returns:
+            A generator yielding a ModifyResponse object for every chunk as it's recieved.
+            Documents are sent only while it's iterated.
+
+        Raises:
+            ParameterError -- chunk_size is not positive.
+        """
+        return self._modify_iter(InsertRequest, documents, chunk_size, fully_formed, depth, kwargs)
+
+    def update_iter(self, documents, chunk_size=1000, fully_formed=False, depth=2, **kwargs):
+        """ Update documents from an iterable or generator in chunks. See insert_iter() and update()."""
+        return self._modify_iter(UpdateRequest, documents, chunk_size, fully_formed, depth, kwargs)
+
+    def replace_iter(self, documents, chunk_size=1000, fully_formed=False, depth=2, **kwargs):
+        """ Replace documents from an iterable or generator in chunks. See insert_iter() and replace()."""
+        return self._modify_iter(ReplaceRequest, documents, chunk_size, fully_formed, depth, kwargs)
+
+    def partial_replace_iter(self, documents, chunk_size=1000, fully_formed=False, depth=2, **kwargs):
+        """ Partially replace documents from an iterable or generator in chunks. See insert_iter() and partial_replace()."""
+        return self._modify_iter(PartialReplaceRequest, documents, chunk_size, fully_formed, depth, kwargs)
+
+    def _modify_iter(self, request_class, documents, chunk_size, fully_formed, depth, kwargs):
+        if isinstance(chunk_size, AdaptiveBatchSize):
+            return self._send_adaptive(lambda chunk: request_class(self, chunk, fully_formed=fully_formed, **kwargs),
+                                       documents, chunk_size, depth)
+        if chunk_size < 1:
+            raise ParameterError("chunk_size={0}".format(chunk_size))
+        documents = iter(documents)
+
+        def requests():
+            while True:
+                chunk = list(itertools.islice(documents, chunk_size))
+                if not chunk:
+                    return
+                yield request_class(self, chunk, fully_formed=fully_formed, **kwargs)
+        return self.pipeline(requests(), lazy=True, depth=depth)
+
+    def delete(self, doc_ids, chunk_size=_ID_CHUNK_SIZE, **kwargs):
         """ Deletes a document with the specified ID from the Clusterpoint Storage.
 
         Args:
             doc_ids -- Single document id or a list of them to be deleted.
 
         Keyword args:
+            chunk_size -- Lists of more ids are split in requests of chunk_size ids sent concurrently,
+                    their responses are merged in one. None disables splitting. Default is 10000.
+                    With an AdaptiveBatchSize object ids are split in chunks of its size, pipelined two
+                    at a time and recorded in it.
             See Request.__init__().
 
         Returns:
             A ModifyResponse object.
         """
-        return DeleteRequest(self, *args, **kwargs).send()
+        return self._send_ids(DeleteRequest, doc_ids, chunk_size, kwargs)
 
     def search_delete(self, *args, **kwargs):
         """ Delete the documents that would be returned to the result set by a search command using the same parameters.
@@ -471,7 +1163,7 @@ class Connection(object):
         """
         return SearchRequest(self, *args, **kwargs).send()
 
-    def retrieve(self, *args, **kwargs):
+    def retrieve(self, doc_ids, chunk_size=_ID_CHUNK_SIZE, **kwargs):
         """ Return a document with the specified ID from the Storage.
             Error if a document with this ID does not exist in the Storage.
 
@@ -479,6 +1171,7 @@ class Connection(object):
             doc_ids -- Single document id or a list of them.
 
         Keyword args:
+            chunk_size -- See delete().
             See Request.__init__()
 
         Returns:
@@ -486,7 +1179,7 @@ class Connection(object):
             See insert()
 
         """
-        return RetrieveRequest(self, *args, **kwargs).send()
+        return self._send_ids(RetrieveRequest, doc_ids, chunk_size, kwargs)
 
     def similar(self, *args, **kwargs):
         """ Search for documents that are similar to directly supplied text or to the textual content of an existing document.
@@ -526,7 +1219,7 @@ class Connection(object):
         """
         return SimilarRequest(self, *args, mode='text', **kwargs).send()
 
-    def lookup(self, *args, **kwargs):
+    def lookup(self, doc_ids, list=None, chunk_size=_ID_CHUNK_SIZE, **kwargs):
         """  Search for a document in the Storage by it's id.
 
         Args:
@@ -535,12 +1228,178 @@ class Connection(object):
         Keyword args:
             list -- Defines which tags of the search results should be listed in the response.
                     A dict with tag xpaths as keys and listing option strings ('yes', 'no', 'snippet', 'highlight') as values.
+            chunk_size -- See delete().
             See Request.__init__()
 
         Returns:
             A LookupResponse object.
         """
-        return LookupRequest(self, *args, **kwargs).send()
+        kwargs['list'] = list
+        return self._send_ids(LookupRequest, doc_ids, chunk_size, kwargs)
+
+    def iter_retrieve(self, doc_ids, chunk_size=_MULTI_GET_CHUNK_SIZE, parallelism=4, ordered=False,
+                      doc_format='dict', **kwargs):
+        """ Iterate over the documents with the given ids, retrieved in chunks of ids sent concurrently.
+
+            Repeated ids are requested once, ids that aren't strings are converted to strings. Chunks are fetched by parallelism concurrent requests: from
+            threads over a ConnectionPool or ClusterConnection, as futures on an AsyncConnection and
+            pipelined parallelism requests deep on a Connection. A chunk's documents are yielded as soon
+            as it's recieved and dropped when the caller moves on, so only up to parallelism chunks are
+            kept in memory. Ids of documents that don't exist are yielded with None instead of a document.
+
+        Args:
+            doc_ids -- An iterable of document ids.
+
+        Keyword args:
+            chunk_size -- Maximum number of ids per request. Default is 1000.
+            parallelism -- Maximum number of chunks fetched at once. Default is 4.
+            ordered -- If True, chunks are yielded in the order of the ids, otherwise as they are recieved.
+                    Default is False.
+            doc_format -- 'dict', 'etree' or 'string', see Response.iter_documents(). Default is 'dict'.
+            See Request.__init__().
+
+        Returns:
+            A generator of (id, document) pairs, (id, None) for missing documents.
+
+        Raises:
+            ParameterError -- chunk_size or parallelism is not positive or doc_format is not allowed.
+            APIError -- A chunk's response has an error other than missing documents.
+        """
+        return self._iter_ids(RetrieveRequest, doc_ids, chunk_size, parallelism, ordered, doc_format, kwargs)
+
+    def iter_lookup(self, doc_ids, list=None, chunk_size=_MULTI_GET_CHUNK_SIZE, parallelism=4, ordered=False,
+                    doc_format='dict', **kwargs):
+        """ Iterate over the listed tags of the documents with the given ids, looked up in chunks of ids
+            sent concurrently. See iter_retrieve().
+
+        Keyword args:
+            list -- See lookup().
+        """
+        kwargs['list'] = list
+        return self._iter_ids(LookupRequest, doc_ids, chunk_size, parallelism, ordered, doc_format, kwargs)
+
+    def _iter_ids(self, request_class, doc_ids, chunk_size, parallelism, ordered, doc_format, kwargs):
+        """ Iterate over the documents of a multi-get. See iter_retrieve().
+
+            Args:
+                request_class -- RetrieveRequest or LookupRequest.
+                kwargs -- Keyword args of the request class.
+        """
+        if chunk_size < 1 or parallelism < 1:
+            raise ParameterError("chunk_size={0}, parallelism={1}".format(chunk_size, parallelism))
+        if doc_format not in ('dict', 'etree', 'string'):
+            raise ParameterError("doc_format=" + str(doc_format))
+        seen = set()
+        doc_ids = [doc_id if isinstance(doc_id, basestring) else str(doc_id) for doc_id in doc_ids]
+        doc_ids = [doc_id for doc_id in doc_ids if not (doc_id in seen or seen.add(doc_id))]
+        chunks = [doc_ids[start:start + chunk_size] for start in xrange(0, len(doc_ids), chunk_size)]
+        requests = [request_class(self, chunk, raise_errors=False, **kwargs) for chunk in chunks]
+
+        def documents():
+            responses = self._scan(requests, parallelism, ordered)
+            try:
+                for index, response in responses:
+                    found = set()
+                    for doc_id, document in response.iter_documents(doc_format):
+                        found.add(doc_id)
+                        yield doc_id, document
+                    response._parse_for_errors(ignored_codes=(_DOCUMENT_NOT_FOUND,))
+                    for doc_id in chunks[index]:
+                        if doc_id not in found:
+                            yield doc_id, None
+            finally:
+                responses.close()
+        return documents()
+
+    def _send_ids(self, request_class, doc_ids, chunk_size, kwargs):
+        """ Send a request for a list of ids, split in chunks if it's long.
+
+            Args:
+                request_class -- DeleteRequest, RetrieveRequest or LookupRequest.
+                doc_ids -- Single document id or a list of them.
+                chunk_size -- Maximum number of ids per request or None to send one request.
+                kwargs -- Keyword args of the request class.
+
+            Returns:
+                A Response object or whatever the request's send() returns.
+        """
+        sizer = None
+        if isinstance(chunk_size, AdaptiveBatchSize):
+            sizer, chunk_size = chunk_size, chunk_size.size
+        if chunk_size is not None and chunk_size < 1:
+            raise ParameterError("chunk_size={0}".format(chunk_size))
+        if not isinstance(doc_ids, list) or chunk_size is None or len(doc_ids) <= chunk_size or kwargs.get('stream'):
+            return request_class(self, doc_ids, **kwargs).send()
+        seen = set()
+        doc_ids = [doc_id for doc_id in doc_ids if not (doc_id in seen or seen.add(doc_id))]
+        if len(doc_ids) <= chunk_size:
+            return request_class(self, doc_ids, **kwargs).send()
+        raise_errors = kwargs.pop('raise_errors', True)
+        if sizer is not None:
+            responses = self._send_adaptive(lambda chunk: request_class(self, chunk, raise_errors=False, **kwargs),
+                                            doc_ids, sizer, 2)
+            return self._merge_chunks(responses, lambda responses: _merge_responses(responses, raise_errors))
+        requests = [request_class(self, doc_ids[start:start + chunk_size], raise_errors=False, **kwargs)
+                    for start in xrange(0, len(doc_ids), chunk_size)]
+        return self._send_chunks(requests, lambda responses: _merge_responses(responses, raise_errors))
+
+    def _send_chunks(self, requests, merge):
+        """ Send the requests for the chunks of a split request and merge their responses.
+            A single connection pipelines them.
+
+            Args:
+                requests -- A list of Request objects.
+                merge -- A function making one response of a list of the requests' responses.
+
+            Returns:
+                The merged response.
+        """
+        return self._merge_chunks(self.pipeline(requests), merge)
+
+    def _merge_chunks(self, responses, merge):
+        """ Merge the responses to the chunks of a split request, an iterable of what send() returns."""
+        return merge(list(responses))
+
+    def _send_adaptive(self, make_request, items, sizer, depth):
+        """ Pipeline items in chunks sized by an AdaptiveBatchSize, recording every response in it.
+
+            Args:
+                make_request -- A function making the Request object for a list of items.
+                items -- An iterable of documents or ids.
+                sizer -- An AdaptiveBatchSize object.
+                depth -- See pipeline().
+
+            Returns:
+                A generator of responses to the chunks. A chunk is made when the previous chunks'
+                responses leave room for it in the pipeline, so its size follows their latency.
+                A chunk's wall time is counted from when it's sent or, if later, when the previous
+                chunk's response was recieved, leaving out the time it queued behind earlier chunks.
+        """
+        items = iter(items)
+        sent = collections.deque()  # (documents, document bytes, monotonic time it was sent) per chunk.
+        last_recieved = [0]
+
+        def requests():
+            while True:
+                chunk = list(itertools.islice(items, sizer.size))
+                if not chunk:
+                    return
+                request = make_request(chunk)
+                sent.append((len(chunk), sum(len(document) for document in request._documents), monotonic()))
+                yield request
+
+        def responses():
+            try:
+                for response in self.pipeline(requests(), lazy=True, depth=depth):
+                    documents, payload_bytes, sent_time = sent.popleft()
+                    now = monotonic()
+                    sizer.record(documents, now - max(sent_time, last_recieved[0]), response.seconds, payload_bytes)
+                    last_recieved[0] = now
+                    yield response
+            except TimeoutError:
+                sizer.record_failure()
+                raise
+        return responses()
 
     def alternatives(self, *args, **kwargs):
         """ Return a set of words from the Storage vocabulary that are alternatives to the given word.
@@ -667,3 +1526,275 @@ class Connection(object):
             A ListFacetsResponse object.
         """
         return ListFacetsRequest(self, *args, **kwargs).send()
+
+    def iter_search(self, query, page_size=100, prefetch=2, doc_format='dict', offset=0, **kwargs):
+        """ Iterate over all documents found by a search, requesting pages of page_size documents as they are needed.
+
+            Pages are fetched by a background thread, pipelined up to prefetch requests ahead and up to
+            prefetch recieved pages waiting for the caller, so the caller rarely waits for a round trip.
+            Iteration stops after the last document reported by the responses' more counts.
+            The connection must not be used by other threads while iterating unless it's a ConnectionPool
+            or ClusterConnection. An AsyncConnection keeps prefetch requests ahead instead of using a thread.
+
+        Args:
+            query -- See search().
+
+        Keyword args:
+            page_size -- Number of documents requested at once. Default is 100.
+            prefetch -- Number of pages fetched ahead of the page being iterated, 0 fetches a page
+                    only when the previous one is finished. Default is 2.
+            doc_format -- See Response.iter_documents(). Default is 'dict'.
+            offset -- Offset of the first document in the result set. Default is 0.
+            See search(), except docs and offset.
+
+        Returns:
+            A generator of documents, or (id, document) pairs for dict, etree and string formats.
+
+        Raises:
+            ParameterError -- page_size is not positive or prefetch is negative.
+        """
+        return self._iter_pages(lambda docs, offset: SearchRequest(self, query, docs=docs, offset=offset, **kwargs),
+                                page_size, prefetch, doc_format, offset)
+
+    def iter_list_first(self, page_size=100, prefetch=2, doc_format='dict', offset=0, **kwargs):
+        """ Iterate over all documents in the order of list_first(). See iter_search()."""
+        return self._iter_pages(lambda docs, offset: ListFirstRequest(self, docs=docs, offset=offset, **kwargs),
+                                page_size, prefetch, doc_format, offset)
+
+    def iter_list_last(self, page_size=100, prefetch=2, doc_format='dict', offset=0, **kwargs):
+        """ Iterate over all documents in the order of list_last(). See iter_search()."""
+        return self._iter_pages(lambda docs, offset: ListLastRequest(self, docs=docs, offset=offset, **kwargs),
+                                page_size, prefetch, doc_format, offset)
+
+    def iter_retrieve_first(self, page_size=100, prefetch=2, doc_format='dict', offset=0, **kwargs):
+        """ Iterate over all complete documents in the order of retrieve_first(). See iter_search()."""
+        return self._iter_pages(lambda docs, offset: RetrieveFirstRequest(self, docs=docs, offset=offset, **kwargs),
+                                page_size, prefetch, doc_format, offset)
+
+    def iter_retrieve_last(self, page_size=100, prefetch=2, doc_format='dict', offset=0, **kwargs):
+        """ Iterate over all complete documents in the order of retrieve_last(). See iter_search()."""
+        return self._iter_pages(lambda docs, offset: RetrieveLastRequest(self, docs=docs, offset=offset, **kwargs),
+                                page_size, prefetch, doc_format, offset)
+
+    def iter_keyset(self, query, key_xpath=None, page_size=100, numeric=False, prefetch=1, doc_format='dict',
+                    cursor=None, **kwargs):
+        """ Iterate over all documents found by a search in the order of a unique key, requesting every page
+            as the documents with keys after the last key of the previous page instead of by offset.
+
+            Deep pages cost the same as the first one, unlike iter_search() or search() with a large offset
+            where the server ranks and skips all documents before the offset. The key must be unique and
+            a single word, like the document id. The next page is requested by a background thread as soon
+            as a page is recieved, up to prefetch pages ahead of the caller. An AsyncConnection fetches
+            pages when they are needed instead. See KeysetCursor.
+
+        Args:
+            query -- See search().
+
+        Keyword args:
+            key_xpath -- The key tag xpath relative to the document root. Default is the document id xpath.
+            page_size -- Number of documents requested at once. Default is 100.
+            numeric -- If True, keys are ordered and compared as numbers, otherwise as strings. Default is False.
+            prefetch -- Number of pages fetched ahead of the page being iterated. Default is 1.
+            doc_format -- See Response.iter_documents(). Default is 'dict'.
+            cursor -- A KeysetCursor.token string of an earlier iteration with the same query, key_xpath
+                    and numeric arguments to continue after its last document. Default is None - start
+                    from the first document.
+            See search(), except docs, offset and ordering.
+
+        Returns:
+            A KeysetCursor iterating over documents, or (id, document) pairs for dict, etree and string formats.
+
+        Raises:
+            ParameterError -- page_size is not positive, prefetch is negative or the cursor is invalid
+                    or for another query.
+        """
+        return KeysetCursor(self, query, key_xpath, page_size, numeric, prefetch, doc_format, cursor, **kwargs)
+
+    def _fetch_keyset_pages(self, make_request, key_xpath, key, prefetch):
+        """ Get the pages of a keyset paginated search. See iter_keyset().
+
+            Args:
+                make_request -- A function of the last key of the previous page, None for the first page,
+                        making the Request object for a page.
+                key_xpath -- The key tag xpath relative to the document root.
+                key -- The key the first page starts after or None.
+                prefetch -- Number of pages fetched ahead by a background thread, 0 for none.
+
+            Returns:
+                A generator of (response, list of document elements) pairs.
+        """
+        def responses():
+            last_key = key
+            while True:
+                response = make_request(last_key).send()
+                if not isinstance(response, Response):
+                    response = response.result()    # An AsyncConnection's future.
+                documents = list(response.iter_documents('list-etree'))
+                if not documents:
+                    return
+                yield response, documents
+                if not response.more:
+                    return
+                last_key = documents[-1].findtext(key_xpath)
+                if last_key is None:
+                    raise ParameterError("key_xpath={0} not found in a document".format(key_xpath))
+        if not prefetch:
+            return responses()
+        return _prefetched(responses(), prefetch)
+
+    def parallel_scan(self, query, page_size=1000, parallelism=4, ordered=True, doc_format='dict', **kwargs):
+        """ Iterate over all documents found by a search, fetching ranges of the result set concurrently.
+
+            A search with docs=0 gets the number of hits, [0, hits) is split in ranges of page_size
+            documents, and they are fetched by parallelism concurrent searches: from threads over
+            a ConnectionPool or ClusterConnection, as futures on an AsyncConnection and pipelined
+            parallelism requests deep on a Connection. Documents changed while scanning may be
+            skipped or returned twice, as the ranges are fixed by the first search.
+
+        Args:
+            query -- See search().
+
+        Keyword args:
+            page_size -- Number of documents in a range. Default is 1000.
+            parallelism -- Maximum number of ranges fetched at once. Default is 4.
+            ordered -- If True, documents are yielded in the order of the result set, otherwise
+                    a range's documents are yielded as soon as it's recieved. Ranges of a Connection
+                    are always recieved in order. Default is True.
+            doc_format -- See Response.iter_documents(). Default is 'dict'.
+            See search(), except docs and offset.
+
+        Returns:
+            A generator of documents, or (id, document) pairs for dict, etree and string formats.
+
+        Raises:
+            ParameterError -- page_size or parallelism is not positive.
+        """
+        if page_size < 1 or parallelism < 1:
+            raise ParameterError("page_size={0}, parallelism={1}".format(page_size, parallelism))
+        hits = SearchRequest(self, query, docs=0, **kwargs).send()
+        if not isinstance(hits, Response):
+            hits = hits.result()    # An AsyncConnection's future.
+        hits = hits.hits
+        requests = [SearchRequest(self, query, docs=min(page_size, hits - offset), offset=offset, **kwargs)
+                    for offset in xrange(0, hits, page_size)]
+
+        def documents():
+            responses = self._scan(requests, parallelism, ordered)
+            try:
+                for index, response in responses:
+                    for document in response.iter_documents(doc_format):
+                        yield document
+            finally:
+                responses.close()
+        return documents()
+
+    def _scan(self, requests, parallelism, ordered):
+        """ Send the requests of a scan with up to parallelism of them at once.
+
+            Args:
+                requests -- A list of Request objects.
+                parallelism -- Maximum number of requests sent at once.
+                ordered -- If False, responses may be yielded in the order they are recieved.
+
+            Returns:
+                A generator of (request index, response) pairs.
+        """
+        responses = self.pipeline(requests, lazy=True, depth=parallelism)
+        try:
+            for pair in enumerate(responses):
+                yield pair
+        finally:
+            responses.close()
+
+    def _iter_pages(self, make_request, page_size, prefetch, doc_format, offset):
+        """ Iterate over the documents of a paged result set. See iter_search().
+
+            Args:
+                make_request -- A function of docs and offset making the Request object for a page.
+        """
+        if page_size < 1 or prefetch < 0:
+            raise ParameterError("page_size={0}, prefetch={1}".format(page_size, prefetch))
+
+        def documents():
+            pages = self._fetch_pages(make_request, page_size, prefetch, offset)
+            try:
+                for response in pages:
+                    for document in response.iter_documents(doc_format):
+                        yield document
+            finally:
+                pages.close()
+        return documents()
+
+    def _fetch_pages(self, make_request, page_size, prefetch, offset):
+        """ Get the responses to the pages of a result set. See _iter_pages().
+
+            Returns:
+                A generator of responses, the last one has the last document of the result set.
+        """
+        end = [None]    # Offset after the last document, known from the first response.
+
+        def requests():
+            position = offset
+            while end[0] is None or position < end[0]:
+                yield make_request(page_size, position)
+                position += page_size
+
+        def responses():
+            page_offset = offset
+            for response in self.pipeline(requests(), lazy=True, depth=max(prefetch, 1)):
+                end[0] = _page_end(response, page_offset)
+                if end[0] is None:
+                    return
+                yield response
+                page_offset += page_size
+                if page_offset >= end[0]:
+                    return
+        if not prefetch:
+            return responses()
+        return _prefetched(responses(), prefetch)
+
+# Pipelining methods
+    def pipeline(self, requests, lazy=False, depth=64):
+        """ Send several requests back to back on the same socket without waiting for each response.
+            Responses are read in the order the requests were sent, so N requests cost roughly
+            one round trip instead of N. On http connections requests are sent one at a time.
+
+        Args:
+            requests -- An iterable of Request objects made for this connection.
+                    Example: [LookupRequest(con, 1), LookupRequest(con, 2), Request(con, 'status')]
+
+        Keyword args:
+            lazy -- If True, return a generator yielding responses as they are recieved,
+                    instead of a list of all of them. Default is False.
+            depth -- Maximum number of requests sent ahead of the recieved responses.
+                    Limits client and server side buffering for long request streams. Default is 64.
+
+        Returns:
+            A list (or generator, if lazy) of Response objects matching the requests.
+        """
+        if depth < 1:
+            raise ParameterError("depth={0}".format(depth))
+        requests = iter(requests)
+        sent_requests = []    # Requests sent but still waiting for the response.
+
+        def xml_requests():
+            for request in requests:
+                sent_requests.append((request, self._invalidate_cache(request)))
+                yield request.get_xml_request()
+
+        def responses():
+            raw_responses = self._send_pipelined(xml_requests(), depth)
+            try:
+                for response in raw_responses:
+                    request, ticket = sent_requests.pop(0)
+                    self._complete_cache(ticket)
+                    yield request.handle_response(response)
+            finally:
+                raw_responses.close()
+                for request, ticket in sent_requests:  # Writes without a response may still have been applied.
+                    self._complete_cache(ticket)
+
+        if lazy:
+            return responses()
+        else:
+            return list(responses())
@@ -34,10 +34,28 @@ except ImportError:
                 # old ET
                 import elementtree.ElementTree as ET
 
+import re
+
 from utils import *
 from errors import *
 
 
+# dict_to_xml() writes the same xml lxml serializes. Other ET implementations format some things
+# differently (e.g. '<tag />'), so with them it always goes through dict_to_etree().
+_FAST_XML = hasattr(ET, 'LXML_VERSION')
+_SIMPLE_TAG = re.compile(r'[A-Za-z_][A-Za-z0-9_.-]*\Z').match
+_UNSAFE_STR = re.compile(r'[^\t\n\r\x20-\x7e]').search    # lxml accepts only ascii byte strings.
+_UNSAFE_UNICODE = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]').search
+# Texts without these characters are written as they are.
+_SPECIAL_STR = re.compile(r'[^\t\n\x20-\x25\x27-\x3b\x3d\x3f-\x7e]').search
+_SPECIAL_UNICODE = re.compile(u'[\x00-\x08\x0b-\x1f&<>\ud800-\udfff\ufffe\uffff]').search
+_valid_tags = set()     # Tag names already checked by _SIMPLE_TAG.
+
+class _Unsupported(Exception):
+    """ Raised by the direct xml writer for input it can't be sure to serialize exactly like ET does."""
+    pass
+
+
 def etree_to_dict(source):
     """ Recursively load dict/list representation of an XML tree into an etree representation.
 
@@ -119,8 +137,11 @@ def dict_to_etree(source, root_tag=None):
         elif isinstance(source, list):
             for element in source:
                 dict_to_etree_recursive(element, parent)
-        else:   # TODO: Add feature to include xml literals as special objects or a etree subtree
+        elif source is None or isinstance(source, basestring):
+            # TODO: Add feature to include xml literals as special objects or a etree subtree
             parent.text = source
+        else:   # Numbers and other values as their text representation.
+            parent.text = str(source)
 
     if root_tag is None:
         if len(source) == 1:
@@ -138,6 +159,421 @@ def dict_to_etree(source, root_tag=None):
     return root
 
 
+def dict_to_xml(source, root_tag=None, id_xpath=None, doc_id=None):
+    """ Serialize a dict/list representation of an XML tree straight to an XML string.
+
+        Gives the same string as ET.tostring(dict_to_etree(source, root_tag), encoding='utf-8'), with the
+        document id set like Request.set_documents() does, but without building the etree. Input the
+        direct writer can't be sure about (unusual tag names, control characters, ...) and ET
+        implementations other than lxml go through dict_to_etree().
+
+        Args:
+            source -- A dictionary representing an XML document, see dict_to_etree().
+
+        Keyword args:
+            root_tag -- A parent tag in which to wrap the xml tree. See dict_to_etree().
+            id_xpath -- The document id tag xpath relative to the root, e.g. './id'. Default is None - no id is added.
+            doc_id -- The document id to be set at id_xpath. Its text replaces the text of an existing id tag.
+
+        Returns:
+            An utf-8 encoded xml string.
+
+    >>> dict_to_xml({'document': {'title': 'foo & bar', 'list': [{'li': 1}, {'li': 2}]}})
+    '<document><list><li>1</li><li>2</li></list><title>foo &amp; bar</title></document>'
+
+    >>> dict_to_xml({'title': 'foo', 'empty': None}, 'document', './id', 12)
+    '<document><empty/><title>foo</title><id>12</id></document>'
+
+    >>> dict_to_xml({'id': {'old': 'x'}, 'meta': 'm'}, 'document', './id', 12)
+    '<document><meta>m</meta><id>12<old>x</old></id></document>'
+
+    >>> def etree_xml(source, doc_id):
+    ...     root = dict_to_etree(source, 'document')
+    ...     _set_id(root, ['.', 'id'], doc_id)
+    ...     return ET.tostring(root, encoding='utf-8')
+    >>> def random_value(rng, depth):
+    ...     kind = rng.randint(0, 5 if depth else 3)
+    ...     if kind == 0:
+    ...         return rng.choice([None, '', 0, 1.5, True, u'\u0101 & <b>', 'a "q" > x'])
+    ...     if kind < 4:
+    ...         return rng.randint(-99, 99) if kind == 1 else ''.join(rng.choice('ab &<>') for i in range(5))
+    ...     if kind == 4:
+    ...         return [dict([(rng.choice(['li', 'item']), random_value(rng, depth - 1))]) for i in range(3)]
+    ...     return dict((rng.choice(['id', 'a', 'b', 'c-d', 'e_f']), random_value(rng, depth - 1)) for i in range(3))
+    >>> import random
+    >>> rng = random.Random(42)
+    >>> documents = [dict(('f%d' % i, random_value(rng, 3)) for i in range(4)) for n in range(300)]
+    >>> [n for n, source in enumerate(documents) if dict_to_xml(source, 'document', './id', n) != etree_xml(source, n)]
+    []
+    """
+    id_path = None
+    if id_xpath is not None:
+        id_path = id_xpath.split('/')
+    if _FAST_XML:
+        try:
+            if root_tag is None:
+                if len(source) != 1:
+                    raise _Unsupported()
+                root_tag, source = source.items()[0]
+            parts = []
+            if id_path is None:
+                _write_element(root_tag, source, parts)
+            else:
+                steps = [step for step in id_path if step != '.']
+                if len(id_path) > 10 or not all(_SIMPLE_TAG(step) for step in steps):
+                    raise _Unsupported()
+                try:
+                    id_text = _escape_text(str(doc_id))
+                except UnicodeError:
+                    raise _Unsupported()
+                _write_with_id(root_tag, source, parts, steps, id_text)
+            xml = ''.join(parts)
+            return (xml.encode('utf-8') if isinstance(xml, unicode) else xml)
+        except _Unsupported:
+            pass
+    root = dict_to_etree(source, root_tag)
+    if id_path is not None:
+        _set_id(root, id_path, doc_id)
+    return ET.tostring(root, encoding="utf-8")
+
+
+def _set_id(root, id_path, doc_id):
+    """ Set the text of the tag at id_path (a split id xpath) in the root element, creating missing tags."""
+    def make_id_tag(root, rel_path, max_depth):
+        if max_depth < 0:
+            raise ParameterError("document_id_xpath too deep!")
+        if not rel_path:
+            return root
+        else:
+            child = root.find(rel_path[0])
+            if child is None:
+                child = ET.Element(rel_path[0])
+                root.append(child)
+            return make_id_tag(child, rel_path[1:], max_depth - 1)
+    make_id_tag(root, id_path, 10).text = str(doc_id)
+
+
+def _check_text(text):
+    """ Raise _Unsupported for a text lxml would reject or alter."""
+    if isinstance(text, unicode):
+        if _UNSAFE_UNICODE(text):
+            raise _Unsupported()
+    elif _UNSAFE_STR(text):
+        raise _Unsupported()
+    return text
+
+
+def _escape_text(text):
+    """ Escape a text the way lxml serializes it. See _check_text()."""
+    if not (_SPECIAL_UNICODE(text) if isinstance(text, unicode) else _SPECIAL_STR(text)):
+        return text
+    _check_text(text)
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    if '\r' in text:
+        text = text.replace('\r', '&#13;')
+    return text
+
+
+def _check_tag(tag):
+    """ Raise _Unsupported for a tag name that lxml might reject or write differently."""
+    if tag not in _valid_tags:
+        if not isinstance(tag, basestring) or not _SIMPLE_TAG(tag):
+            raise _Unsupported()
+        if len(_valid_tags) < 10000:
+            _valid_tags.add(tag)
+
+
+def _list_content(items, children, text=None):
+    """ Collect the (tag, value) children and the text dict_to_etree() makes of a list of values."""
+    for item in items:
+        if hasattr(item, 'keys'):
+            children.extend(item.iteritems())
+        elif isinstance(item, list):
+            text = _list_content(item, children, text)
+        elif item is None:
+            text = None
+        elif isinstance(item, basestring):
+            text = _check_text(item)    # The last one is the element's text, but lxml checks all.
+        else:
+            text = _check_text(str(item))
+    return text
+
+
+def _write_element(tag, value, parts):
+    """ Append the xml fragments of an element made of a dict representation value to parts."""
+    _check_tag(tag)
+    if value is None:
+        parts.append('<%s/>' % tag)
+    elif isinstance(value, basestring):
+        parts.append('<%s>%s</%s>' % (tag, _escape_text(value), tag))
+    elif hasattr(value, 'keys'):
+        if not value:
+            parts.append('<%s/>' % tag)
+            return
+        parts.append('<%s>' % tag)
+        _write_children(value.iteritems(), parts)
+        parts.append('</%s>' % tag)
+    elif isinstance(value, list):
+        children = []
+        text = _list_content(value, children)
+        if text is None and not children:
+            parts.append('<%s/>' % tag)
+            return
+        parts.append('<%s>' % tag)
+        if text:
+            parts.append(_escape_text(text))
+        _write_children(children, parts)
+        parts.append('</%s>' % tag)
+    else:
+        parts.append('<%s>%s</%s>' % (tag, _escape_text(str(value)), tag))
+
+
+def _write_children(children, parts):
+    """ Write (tag, value) pairs with _write_element(), text and number fields without another call as they are most common."""
+    append = parts.append
+    for key, item in children:
+        item_class = item.__class__
+        if item_class is str or item_class is unicode:
+            if key not in _valid_tags:
+                _check_tag(key)
+            if _SPECIAL_STR(item) if item_class is str else _SPECIAL_UNICODE(item):
+                item = _escape_text(item)
+            append('<%s>%s</%s>' % (key, item, key))
+        elif item_class is int or item_class is long or item_class is float:   # Their str() is plain ascii.
+            if key not in _valid_tags:
+                _check_tag(key)
+            append('<%s>%s</%s>' % (key, item, key))
+        else:
+            _write_element(key, item, parts)
+
+
+def _write_with_id(tag, value, parts, id_path, id_text):
+    """ Like _write_element() with the text of the tag at id_path set to the escaped id_text.
+        Missing tags on the path are appended as the last children, like _set_id() does.
+    """
+    _check_tag(tag)
+    if value is None:
+        text, children = None, ()
+    elif isinstance(value, basestring):
+        text, children = value, ()
+    elif hasattr(value, 'keys'):
+        text, children = None, value.iteritems()
+    elif isinstance(value, list):
+        children = []
+        text = _list_content(value, children)
+    else:
+        text, children = str(value), ()
+    parts.append('<%s>' % tag)
+    if not id_path:     # The id tag itself, its text is replaced.
+        if text:
+            _check_text(text)
+        parts.append(id_text)
+        _write_children(children, parts)
+    else:
+        if text:
+            parts.append(_escape_text(text))
+        if hasattr(value, 'keys') and id_path[0] not in value:  # Usually the id is not in the document.
+            _write_children(children, parts)
+            _write_with_id(id_path[0], None, parts, id_path[1:], id_text)
+        else:
+            found = False
+            for key, item in children:
+                if not found and key == id_path[0]:    # Like find(), the first matching child.
+                    found = True
+                    _write_with_id(key, item, parts, id_path[1:], id_text)
+                else:
+                    _write_element(key, item, parts)
+            if not found:
+                _write_with_id(id_path[0], None, parts, id_path[1:], id_text)
+    parts.append('</%s>' % tag)
+
+
+def _ids_to_xml(doc_ids, doc_root_tag, doc_id_xpath):
+    """ Make id only documents for a list of ids from a template, like dict_to_xml({}, ...) makes them one by one.
+
+        Args:
+            doc_ids -- A list of document ids. Repeated ids are included once.
+            doc_root_tag -- The document root tag, see Connection.document_root_xpath.
+            doc_id_xpath -- The document id tag xpath relative to the root, see Connection.document_id_xpath.
+
+        Returns:
+            A list of xml strings in the order of the ids.
+
+    >>> _ids_to_xml([1, 'a&b', 1], 'document', './id')
+    ['<document><id>1</id></document>', '<document><id>a&amp;b</id></document>']
+    """
+    template = _id_templates.get((doc_root_tag, doc_id_xpath))
+    if template is None:
+        id_path = doc_id_xpath.split('/')
+        steps = [step for step in id_path if step != '.']
+        if _SIMPLE_TAG(doc_root_tag) and len(id_path) <= 10 and all(_SIMPLE_TAG(step) for step in steps):
+            template = ('<' + doc_root_tag + '>' + ''.join('<{0}>'.format(step) for step in steps),
+                        ''.join('</{0}>'.format(step) for step in reversed(steps)) + '</' + doc_root_tag + '>')
+        else:
+            template = (None, None)
+        if len(_id_templates) > 100:
+            _id_templates.clear()
+        _id_templates[(doc_root_tag, doc_id_xpath)] = template
+    prefix, suffix = template
+    seen = set()
+    documents = []
+    for doc_id in doc_ids:
+        if doc_id in seen:
+            continue
+        seen.add(doc_id)
+        try:
+            if prefix is None:
+                raise _Unsupported()
+            document = prefix + _escape_text(str(doc_id)) + suffix
+        except (_Unsupported, UnicodeError):    # Gives the same string or error as the tree path.
+            document = dict_to_xml({}, doc_root_tag, doc_id_xpath, doc_id)
+        documents.append(document)
+    return documents
+
+
+_id_templates = {}
+
+
+class _StringIdPlan(object):
+    """ Sets the id of xml string documents by splicing text, for one document root tag and id xpath.
+
+        Only the root's start tag and closing tag are looked at, the rest of the document is copied as
+        it is. Documents are not checked for being well formed, the server reports malformed ones.
+        inject() returns None for anything it can't be sure to handle like Request.set_documents()
+        does with a parsed document: an existing tag named like the first id xpath step anywhere in
+        the document, namespaces, xml declarations, comments, processing instructions, CDATA sections
+        or doctypes, unusual attributes or tag names, and anything after the root element.
+
+    >>> plan = _StringIdPlan('document', './id')
+    >>> plan.inject('<text>a</text>', 1)
+    '<document><text>a</text><id>1</id></document>'
+    >>> plan.inject('<text>a<text>b</text></text>', 1)
+    '<document><text>a<text>b</text></text><id>1</id></document>'
+    >>> [plan.inject(document, 1) for document in ('<text>a</text><b/>', '<text>a</text><text>b</text>',
+    ...                                             '<document>a</document><document/>', '<text>a</text><!-- c -->')]
+    [None, None, None, None]
+    >>> plan.inject('<text/>', 1), plan.inject('<document a="b" />', 1)
+    ('<document><text/><id>1</id></document>', '<document a="b"><id>1</id></document>')
+    >>> [plan.inject(document, 1) for document in ('<text/><id>5</id>', '<text/>junk', '<text/><b/>',
+    ...                                             '<document/><id>5</id>')]
+    [None, None, None, None]
+    """
+    _START_TAG = re.compile(r"""<([A-Za-z_][A-Za-z0-9_.-]*)((?:\s+[A-Za-z_][A-Za-z0-9_.-]*\s*=\s*"""
+                            r"""(?:"[^"<>]*"|'[^'<>]*'))*)\s*(/?)>""")
+
+    def __init__(self, root_tag, id_xpath):
+        """
+            Args:
+                root_tag -- The document root tag, see Connection.document_root_xpath.
+                id_xpath -- The document id tag xpath relative to the root, see Connection.document_id_xpath.
+        """
+        id_path = id_xpath.split('/')
+        steps = [step for step in id_path if step != '.']
+        self.usable = (_FAST_XML and bool(_SIMPLE_TAG(root_tag)) and 0 < len(steps) and len(id_path) <= 10 and
+                       all(_SIMPLE_TAG(step) for step in steps))
+        if not self.usable:
+            return
+        self.root_tag = root_tag
+        self._first_step = steps[0]
+        self._first_step_open = '<' + steps[0]
+        self._closing_tag = '</{0}>'.format(root_tag)
+        self._id_start = ''.join('<{0}>'.format(step) for step in steps)
+        self._id_end = ''.join('</{0}>'.format(step) for step in reversed(steps))
+
+    def inject(self, document, doc_id):
+        """ Add the id tag to a document string, wrapping it in the root tag if needed.
+
+            Returns:
+                An utf-8 encoded xml string or None if the document has to be parsed.
+        """
+        if not self.usable:
+            return None
+        match = self._START_TAG.match(document)
+        if match is None:
+            return None
+        tag, attributes, empty = match.groups()
+        if 'xmlns' in attributes:
+            return None
+        try:
+            id_tags = self._id_start + _escape_text(str(doc_id)) + self._id_end
+        except (_Unsupported, UnicodeError):
+            return None
+        document = document.rstrip()
+        if empty:
+            if match.end() != len(document):    # Only a self-closing root, nothing after it.
+                return None
+        elif not self._is_single_element(document, tag, match.end()):
+            return None
+        if tag != self.root_tag:    # Wrapped in a new root with the id after the document.
+            if tag == self._first_step:
+                return None
+            xml = '<' + self.root_tag + '>' + document + id_tags + self._closing_tag
+        elif empty:
+            xml = '<' + tag + attributes + '>' + id_tags + self._closing_tag
+        else:
+            if not document.endswith(self._closing_tag) or self._has_first_step_tag(document, match.end()):
+                return None
+            xml = document[:-len(self._closing_tag)] + id_tags + self._closing_tag
+        return (xml.encode('utf-8') if isinstance(xml, unicode) else xml)
+
+    def _is_single_element(self, document, tag, start):
+        """ Check that the element whose start tag ends at start closes at the end of the document,
+            counting nested elements with the same tag. Markup that may hide tags fails the check.
+        """
+        if '<!' in document or '<?' in document:
+            return False
+        open_tag, close_tag = '<' + tag, '</' + tag
+        depth = 1
+        position = start
+        while True:
+            close = document.find(close_tag, position)
+            if close == -1:
+                return False
+            opened = document.find(open_tag, position, close)
+            if opened != -1:
+                position = document.find('>', opened) + 1
+                if not position:
+                    return False
+                if document[opened + len(open_tag)] in ' \t\r\n/>' and document[position - 2] != '/':
+                    depth += 1  # A nested element with the same tag.
+                continue
+            position = document.find('>', close) + 1
+            if not position:
+                return False
+            if document[close + len(close_tag):position - 1].strip():
+                continue    # A longer tag name starting with the tag.
+            depth -= 1
+            if not depth:
+                return position == len(document)
+
+    def _has_first_step_tag(self, document, start):
+        """ Look for a tag named like the first id xpath step, str.find() is a lot faster than a regex here."""
+        position = document.find(self._first_step_open, start)
+        while position != -1:
+            if document[position + len(self._first_step_open)] in ' \t\r\n/>':    # The document ends with '>'.
+                return True
+            position = document.find(self._first_step_open, position + 1)
+        return False
+
+
+_string_id_plans = {}
+
+
+def _string_id_plan(root_tag, id_xpath):
+    """ Get the cached _StringIdPlan for a document root tag and id xpath."""
+    plan = _string_id_plans.get((root_tag, id_xpath))
+    if plan is None:
+        if len(_string_id_plans) > 100:
+            _string_id_plans.clear()
+        plan = _string_id_plans[(root_tag, id_xpath)] = _StringIdPlan(root_tag, id_xpath)
+    return plan
+
+
 def to_etree(source, root_tag=None):
     """ Convert various representations of an XML structure to a etree Element
 
@@ -198,7 +634,6 @@ def to_raw_xml(source):
     elif hasattr(source, 'getiterator'):    # Element or ElementTree.
         return ET.tostring(source, encoding="utf-8")
     elif hasattr(source, 'keys'):   # Dict.
-        xml_root = dict_to_etree(source)
-        return ET.tostring(xml_root, encoding="utf-8")
+        return dict_to_xml(source)
     else:
         raise TypeError("Accepted representations of a document are string, dict and etree")
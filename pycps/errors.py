@@ -39,6 +39,28 @@ class ConnectionError(CPSError):
         return "Unable to connect to the Clusterpoint server! " + self.message
 
 
+class TransportError(ConnectionError):
+    """ Exception raised when the connection to the server breaks: it's closed or reset while a request
+        is sent or its response recieved, or the recieved data doesn't follow the protocol framing.
+        Unlike other ConnectionErrors, like an error message sent by the server, it means the node is unreachable.
+
+    Attributes:
+        message -- An optional error message.
+    """
+    pass
+
+
+class TimeoutError(ConnectionError):
+    """ Exception raised when a request's deadline passes before the response is recieved.
+        The socket the request was sent on is closed, as the response may still arrive on it.
+
+    Attributes:
+        message -- An optional error message.
+    """
+    def __str__(self):
+        return "Clusterpoint request deadline exceeded! " + (self.message or '')
+
+
 class XMLError(CPSError):
     """Exception raised for bad XML document.
 
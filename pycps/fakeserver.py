@@ -0,0 +1,650 @@
+#    Copyright 2012 ClusterPoint, SIA
+#
+#    This file is part of Pycps.
+#
+#    Pycps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Pycps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Pycps.  If not, see <http://www.gnu.org/licenses/>.
+
+""" An in-memory stand-in for a CPS server, for tests and benchmarks without a real cluster.
+
+    Speaks the same 8 byte header and protobuf field framing as CPS over tcp and unix sockets,
+    and HTTP/1.1 POST requests to the selector url. Documents are kept in memory and the data
+    commands are implemented well enough to produce realistic response envelopes; searches
+    support words, '*', ranges and per field terms, not the full CPS query language.
+
+    In process:
+
+    >>> server = FakeServer(latency=0.001).start()  # doctest: +SKIP
+    >>> con = server.connection('tcp')  # doctest: +SKIP
+    >>> con.insert({1: {'title': 'lorem'}})  # doctest: +SKIP
+    >>> server.stop()  # doctest: +SKIP
+
+    As a subprocess: python -m pycps.fakeserver --tcp-port 5550 --http-port 8080 --latency 0.005
+"""
+
+try:
+    from lxml import etree as ET
+except ImportError:
+    try:
+        import xml.etree.cElementTree as ET
+    except ImportError:
+        import xml.etree.ElementTree as ET
+
+import BaseHTTPServer
+import SocketServer
+import collections
+import os
+import random
+import re
+import socket
+import struct
+import threading
+import time
+import zlib
+
+from errors import *
+from protobuf import *
+from utils import *
+
+
+_NS = '{www.clusterpoint.com}'
+_DOCUMENT_NOT_FOUND = 2824
+_DOCUMENT_EXISTS = 2626
+_RANGE = re.compile(r'^\s*(>=|<=|>|<)\s*(.+?)\s*$')
+_INTERVAL = re.compile(r'^\s*(.+?)\s*\.\.\s*(.+?)\s*$')
+
+
+def _xml_escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _comparable(value):
+    """ Numbers compare as numbers, everything else as lowercase strings."""
+    try:
+        return (0, float(value))
+    except (TypeError, ValueError):
+        return (1, (value or '').lower())
+
+
+def _words(text):
+    return re.findall(r'\w+', (text or '').lower(), re.UNICODE)
+
+
+def _element_text(element):
+    return ' '.join(text for text in element.itertext())
+
+
+class FakeServer(object):
+    """ In-memory CPS stand-in serving tcp, unix and http clients from background threads.
+
+        Attributes:
+            documents -- An OrderedDict of document ids and stored document strings, in insertion order.
+            requests -- A collections.Counter of handled requests per command.
+            latency -- Seconds every request is delayed by, or a function of the command returning them.
+            response_padding -- Bytes of padding added to every response envelope, or a function of the
+                    command returning them, to simulate larger responses.
+            drop -- Fraction of requests after which the connection is closed instead of sending the response,
+                    or a function of the command returning True to drop it, to simulate a flaky network.
+                    The request is executed either way.
+            reset -- If True, dropped tcp and unix connections are reset instead of closed, so the client
+                    gets a socket error (ECONNRESET) rather than the end of the stream.
+    """
+
+    def __init__(self, host='127.0.0.1', tcp_port=0, http_port=0, unix_path=None, latency=0, response_padding=0,
+                 storage='storage', document_root_xpath='document', document_id_xpath='./id',
+                 selector_url='/cgi-bin/cps2-cgi', gzip=True, drop=0, reset=False):
+        """
+            Keyword args:
+                host -- Address to listen on. Default is '127.0.0.1'.
+                tcp_port -- Port for the tcp scheme, 0 for any free one or None for no tcp. Default is 0.
+                http_port -- Port for the http scheme, 0 for any free one or None for no http. Default is 0.
+                unix_path -- Socket path for the unix scheme. Default is None - no unix socket.
+                latency -- See attributes. Default is 0.
+                response_padding -- See attributes. Default is 0.
+                storage -- The storage name reported in responses. Default is 'storage'.
+                document_root_xpath -- The document root tag, as given to Connection. Default is 'document'.
+                document_id_xpath -- The document id xpath, as given to Connection. Default is './id'.
+                selector_url -- The http path requests are accepted on. Default is '/cgi-bin/cps2-cgi'.
+                gzip -- If True, http responses are gzip compressed for clients accepting it. Default is True.
+                drop -- See attributes. Default is 0.
+                reset -- See attributes. Default is False.
+        """
+        self.host = host
+        self.tcp_port = tcp_port
+        self.http_port = http_port
+        self.unix_path = unix_path
+        self.latency = latency
+        self.response_padding = response_padding
+        self.storage = storage
+        self.document_root_xpath = document_root_xpath
+        self.document_id_xpath = document_id_xpath
+        self.selector_url = selector_url
+        self.gzip = gzip
+        self.drop = drop
+        self.reset = reset
+        self.documents = collections.OrderedDict()
+        self.requests = collections.Counter()
+        self._lock = threading.RLock()
+        self._servers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+# Server control methods
+    def start(self):
+        """ Start listening and serving requests from daemon threads.
+
+            Returns:
+                The FakeServer itself.
+        """
+        if self.tcp_port is not None:
+            server = _ThreadingTCPServer((self.host, self.tcp_port), _SocketHandler)
+            self.tcp_port = server.server_address[1]
+            self._serve(server)
+        if self.http_port is not None:
+            server = _ThreadingHTTPServer((self.host, self.http_port), _HTTPHandler)
+            self.http_port = server.server_address[1]
+            self._serve(server)
+        if self.unix_path is not None:
+            if os.path.exists(self.unix_path):
+                os.unlink(self.unix_path)
+            self._serve(_ThreadingUnixServer(self.unix_path, _SocketHandler))
+        return self
+
+    def _serve(self, server):
+        server.fake_server = self
+        server._clients = {}    # Client socket -> the thread serving it.
+        server._clients_lock = threading.Lock()
+        thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        self._servers.append(server)
+
+    def stop(self):
+        """ Stop serving, close the listening sockets and the client connections and wait for their threads."""
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+            server.close_clients()
+        self._servers = []
+        if self.unix_path is not None and os.path.exists(self.unix_path):
+            os.unlink(self.unix_path)
+
+    def url(self, scheme='tcp'):
+        """ Get the url of a started server for the given scheme ('tcp', 'http' or 'unix')."""
+        if scheme == 'unix':
+            return 'unix://' + self.unix_path
+        return '{0}://{1}:{2}'.format(scheme, self.host, self.tcp_port if scheme == 'tcp' else self.http_port)
+
+    def connection(self, scheme='tcp', connection_class=None, **kwargs):
+        """ Make a connection to this server.
+
+            Keyword args:
+                scheme -- 'tcp', 'http' or 'unix'. Default is 'tcp'.
+                connection_class -- Connection or its subclass to instantiate. Default is Connection.
+                Any other Connection.__init__() keyword arguments.
+        """
+        if connection_class is None:
+            from connection import Connection
+            connection_class = Connection
+        kwargs.setdefault('document_root_xpath', self.document_root_xpath)
+        kwargs.setdefault('document_id_xpath', self.document_id_xpath)
+        return connection_class(self.url(scheme), self.storage, 'user', 'password', 'account', **kwargs)
+
+# Request handling
+    def handle_request(self, xml_request):
+        """ Execute a raw xml request and make the raw xml response string for it, or None to drop the connection."""
+        start = time.time()
+        try:
+            request = ET.fromstring(xml_request)
+        except Exception as e:
+            return self._envelope('', '', [], self._error(2000, 'Invalid request xml', 'FAILED', str(e)), start)
+        command = request.findtext(_NS + 'command') or ''
+        content = request.find(_NS + 'content')
+        if content is None:
+            content = ET.Element('content')
+        self.requests[command] += 1
+        latency = (self.latency(command) if callable(self.latency) else self.latency)
+        if latency:
+            time.sleep(latency)
+        handler = getattr(self, '_command_' + command.replace('-', '_'), self._command_other)
+        try:
+            with self._lock:
+                output, error = handler(content)
+        except Exception as e:  # Reply with an error like CPS does instead of dropping the connection.
+            output, error = [], self._error(2000, 'Request failed', 'FAILED', '{0}: {1}'.format(type(e).__name__, e))
+        if (self.drop(command) if callable(self.drop) else self.drop and random.random() < self.drop):
+            return None
+        return self._envelope(command, request.findtext(_NS + 'storage') or self.storage, output, error, start)
+
+    def _envelope(self, command, storage, output, error, start):
+        padding = (self.response_padding(command) if callable(self.response_padding) else self.response_padding)
+        parts = ['<?xml version="1.0" encoding="utf-8"?>\n<cps:reply xmlns:cps="www.clusterpoint.com">',
+                 '<cps:storage>', _xml_escape(storage), '</cps:storage>',
+                 '<cps:command>', _xml_escape(command), '</cps:command>',
+                 '<cps:seconds>{0:.6f}</cps:seconds>'.format(time.time() - start)]
+        if error:
+            parts.append(error)
+        if padding:
+            parts += ['<cps:padding>', 'x' * padding, '</cps:padding>']
+        parts += ['<cps:content>'] + output + ['</cps:content></cps:reply>']
+        return ''.join(parts)
+
+    def _error(self, code, text, level, message, document_ids=()):
+        return ''.join(['<cps:error><code>{0}</code><text>{1}</text><level>{2}</level><source>fakeserver</source>'
+                        .format(code, _xml_escape(text), level),
+                        '<message>', _xml_escape(message), '</message>'] +
+                       ['<document_id>{0}</document_id>'.format(_xml_escape(document_id))
+                        for document_id in document_ids] + ['</cps:error>'])
+
+    def _request_documents(self, content):
+        """ Get (id, element) pairs of the documents in a request's content."""
+        documents = []
+        for element in content.findall(self.document_root_xpath):
+            element.tail = None
+            documents.append((element.findtext(self.document_id_xpath), element))
+        return documents
+
+    def _store(self, document_id, element):
+        document = ET.tostring(element)
+        if hasattr(ET, 'cleanup_namespaces') and 'xmlns:cps' in document:    # lxml copies the envelope's namespace.
+            element = ET.fromstring(document)
+            ET.cleanup_namespaces(element)
+            document = ET.tostring(element)
+        self.documents[document_id] = document
+
+    def _id_list(self, ids):
+        """ Modified documents are listed the way ModifyResponse reads them."""
+        return ['<document><id>{0}</id></document>'.format(_xml_escape(document_id)) for document_id in ids]
+
+    def _modify(self, content, command):
+        modified = []
+        failed = []
+        for document_id, element in self._request_documents(content):
+            exists = document_id in self.documents
+            if (document_id is None or command == 'insert' and exists or
+                    command in ('replace', 'partial-replace', 'delete') and not exists):
+                failed.append(document_id)
+                continue
+            if command == 'delete':
+                del self.documents[document_id]
+            elif command == 'partial-replace':
+                stored = ET.fromstring(self.documents[document_id])
+                for child in list(element):
+                    old = stored.find(child.tag)
+                    if old is not None:
+                        stored[list(stored).index(old)] = child
+                    else:
+                        stored.append(child)
+                self._store(document_id, stored)
+            else:
+                self._store(document_id, element)
+            modified.append(document_id)
+        error = None
+        if failed:
+            if command == 'insert':
+                error = self._error(_DOCUMENT_EXISTS, 'Document already exists', 'REJECTED',
+                                    'Documents with these ids already exist.', failed)
+            else:
+                error = self._error(_DOCUMENT_NOT_FOUND, 'Document does not exist', 'REJECTED',
+                                    'Requested documents do not exist.', failed)
+        return self._id_list(modified), error
+
+    def _command_insert(self, content):
+        return self._modify(content, 'insert')
+
+    def _command_update(self, content):
+        return self._modify(content, 'update')
+
+    def _command_replace(self, content):
+        return self._modify(content, 'replace')
+
+    def _command_partial_replace(self, content):
+        return self._modify(content, 'partial-replace')
+
+    def _command_delete(self, content):
+        return self._modify(content, 'delete')
+
+    def _command_clear(self, content):
+        self.documents.clear()
+        return [], None
+
+    def _listing(self, content):
+        """ Get a function applying the request's list option to a stored document string."""
+        options = content.find('list')
+        hidden = set()
+        if options is not None:
+            hidden = set(child.tag for child in options if (child.text or '').strip().lower() == 'no')
+        if not hidden:
+            return lambda document: document
+
+        def listed(document):
+            element = ET.fromstring(document)
+            for child in list(element):
+                if child.tag in hidden:
+                    element.remove(child)
+            return ET.tostring(element)
+        return listed
+
+    def _results(self, content, ids, total=None, offset=0):
+        listed = self._listing(content)
+        total = (len(ids) if total is None else total)
+        return (['<results>'] + [listed(self.documents[document_id]) for document_id in ids] +
+                ['</results><hits>{0}</hits><more>={1}</more><found>{2}</found><from>{3}</from><to>{4}</to>'
+                 .format(total, max(total - offset - len(ids), 0), len(ids), offset, offset + len(ids))])
+
+    def _command_retrieve(self, content):
+        ids = [document_id for document_id, element in self._request_documents(content)]
+        found = [document_id for document_id in ids if document_id in self.documents]
+        missing = [document_id for document_id in ids if document_id not in self.documents]
+        error = None
+        if missing:
+            error = self._error(_DOCUMENT_NOT_FOUND, 'Document does not exist', 'WARNING',
+                                'Requested documents do not exist.', missing)
+        return self._results(content, found), error
+
+    _command_lookup = _command_retrieve
+
+    def _page(self, content, ids):
+        docs = int(content.findtext('docs') or 10)
+        offset = int(content.findtext('offset') or 0)
+        return self._results(content, ids[offset:offset + docs], len(ids), offset), None
+
+    def _command_list_first(self, content):
+        return self._page(content, list(self.documents))
+
+    def _command_list_last(self, content):
+        return self._page(content, list(reversed(self.documents)))
+
+    _command_retrieve_first = _command_list_first
+    _command_retrieve_last = _command_list_last
+
+    def _command_search(self, content):
+        return self._page(content, self._search(content))
+
+    def _command_search_delete(self, content):
+        ids = self._search(content)
+        for document_id in ids:
+            del self.documents[document_id]
+        return ['<hits>{0}</hits>'.format(len(ids))], None
+
+    def _command_status(self, content):
+        return (['<status><storage>{0}</storage><documents>{1}</documents><requests>{2}</requests></status>'
+                 .format(_xml_escape(self.storage), len(self.documents), sum(self.requests.values()))], None)
+
+    def _command_list_paths(self, content):
+        paths = set()
+        for document in self.documents.values():
+            root = ET.fromstring(document)
+            for element in root.iter():
+                if element is not root:
+                    paths.add(element.tag)
+        return ['<paths>'] + ['<path>{0}</path>'.format(path) for path in sorted(paths)] + ['</paths>'], None
+
+    def _command_alternatives(self, content):
+        return ['<alternatives_list/>'], None
+
+    def _command_other(self, content):
+        """ Commands not simulated (reindex, backup, restore, similar, list-words ...) succeed doing nothing."""
+        return [], None
+
+# Searching
+    def _search(self, content):
+        """ Get the ids of documents matching the request's query, ordered by the request's ordering."""
+        query = content.find('query')
+        ids = [document_id for document_id, document in self.documents.items()
+               if query is None or self._matches(ET.fromstring(document), query, True)]
+        for field, numeric, descending in reversed(self._ordering(content)):
+            def key(document_id):
+                value = ET.fromstring(self.documents[document_id]).findtext(field)
+                if numeric:
+                    try:
+                        return (0, float(value))
+                    except (TypeError, ValueError):
+                        return (1, 0.0)
+                return (value is None, (value or '').lower())
+            ids.sort(key=key, reverse=descending)
+        return ids
+
+    def _ordering(self, content):
+        """ Get (field xpath, numeric, descending) tuples from the ordering field,
+            e.g. <numeric><price>descending</price></numeric><string><title>ascending</title></string>.
+            Paths may start with the document root tag, like query paths.
+        """
+        orders = []
+
+        def add_fields(element, path, numeric):
+            if len(element):
+                for child in element:
+                    add_fields(child, path + [child.tag], numeric)
+            else:
+                direction = (element.text or '').split(',')[0].strip().lower()
+                if len(path) > 1 and path[0] == self.document_root_xpath:
+                    path = path[1:]
+                orders.append(('/'.join(path), numeric, direction == 'descending'))
+        for ordering in content.findall('ordering'):
+            for kind in ordering:
+                for field in kind:
+                    add_fields(field, [field.tag], kind.tag != 'string')
+        return orders
+
+    def _matches(self, node, query, is_root):
+        """ Check if a document (sub)element matches a query element's text terms and child terms."""
+        for child in query:
+            tag = child.tag
+            if is_root and tag == node.tag:     # Query paths may start with the document root tag.
+                candidates = [node]
+            else:
+                candidates = node.findall(tag)
+            if not any(self._matches(candidate, child, False) for candidate in candidates):
+                return False
+        text = ' '.join([query.text or ''] + [child.tail or '' for child in query])
+        return self._matches_text(text, node, is_root)
+
+    def _matches_text(self, text, node, is_root):
+        text = text.strip()
+        if not text or text == '*':
+            return True
+        value = (_element_text(node) if is_root or len(node) else (node.text or ''))
+        match = _RANGE.match(text)
+        if match and not is_root:
+            operator, bound = match.groups()
+            value, bound = _comparable(value.strip()), _comparable(bound)
+            return {'>': value > bound, '>=': value >= bound, '<': value < bound, '<=': value <= bound}[operator]
+        match = _INTERVAL.match(text)
+        if match and not is_root:
+            value = _comparable(value.strip())
+            return _comparable(match.group(1)) <= value <= _comparable(match.group(2))
+        words = set(_words(value))
+        for term in text.split():
+            negate = term.startswith('~')
+            term_words = _words(term)
+            if term.strip('~') == '*':
+                found = True
+            elif term.strip('~"').endswith('*'):
+                prefix = (term_words or [''])[-1]
+                found = any(word.startswith(prefix) for word in words)
+            else:
+                found = all(word in words for word in term_words)
+            if found == negate:
+                return False
+        return True
+
+
+def _recieve_exactly(sock, lenght):
+    """ Recieve lenght bytes, or None if the client closed or reset the connection."""
+    chunks = []
+    while lenght > 0:
+        try:
+            chunk = sock.recv(min(lenght, 1 << 20))
+        except socket.error:
+            return None
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        lenght -= len(chunk)
+    return ''.join(chunks)
+
+
+class _SocketHandler(SocketServer.BaseRequestHandler):
+    """ Serves framed protobuf requests over a tcp or unix socket until the client disconnects."""
+    def handle(self):
+        server = self.server.fake_server
+        if self.request.family == socket.AF_INET:
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            header = _recieve_exactly(self.request, HEADER_LENGHT)
+            if header is None:
+                return
+            message = _recieve_exactly(self.request, parse_header(header))
+            if message is None:
+                return
+            fields = decode_fields(message)
+            if REQUEST_FIELD in fields:
+                response = server.handle_request(fields[REQUEST_FIELD])
+                if response is None:
+                    if server.reset:    # Closing with a zero linger time sends RST instead of FIN.
+                        self.request.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                        self.request.close()
+                    return
+                response = encode_fields({REQUEST_FIELD: response, STORAGE_FIELD: server.storage})
+            else:
+                response = encode_fields({ERROR_FIELD: 'No request in the message.'})
+            try:
+                self.request.sendall(make_header(len(response)) + response)
+            except socket.error:
+                return
+
+
+class _HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves HTTP/1.1 POST requests with keep-alive, chunked and gzip compressed bodies."""
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1   # Buffer the status line, headers and body into one write.
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        server = self.server.fake_server
+        if self.path != server.selector_url:
+            self.send_error(404)
+            return
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';', 1)[0], 16)
+                if not size:
+                    while self.rfile.readline().strip():    # Trailers.
+                        pass
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = ''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('content-length', 0)))
+        if self.headers.get('content-encoding', '').lower() == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        response = server.handle_request(body)
+        if response is None:
+            self.close_connection = True
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        if server.gzip and 'gzip' in self.headers.get('accept-encoding', '').lower():
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            response = compressor.compress(response) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ClientTrackingMixIn(SocketServer.ThreadingMixIn):
+    """ Serves every client from its own thread and keeps the client sockets and threads to close on stop."""
+    daemon_threads = True
+    client_join_timeout = 5
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self.process_request_thread, args=(request, client_address))
+        thread.daemon = True
+        with self._clients_lock:
+            self._clients[request] = thread
+        thread.start()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self._clients_lock:
+                self._clients.pop(request, None)
+
+    def close_clients(self):
+        """ Shut the open client sockets down so their handlers return, and wait for the handler threads."""
+        with self._clients_lock:
+            clients = list(self._clients.items())
+        for request, thread in clients:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for request, thread in clients:
+            if thread is not threading.current_thread():
+                thread.join(self.client_join_timeout)
+
+
+class _ThreadingTCPServer(_ClientTrackingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class _ThreadingUnixServer(_ClientTrackingMixIn, SocketServer.UnixStreamServer):
+    request_queue_size = 128
+
+
+class _ThreadingHTTPServer(_ClientTrackingMixIn, BaseHTTPServer.HTTPServer):
+    request_queue_size = 128
+
+
+def main(args=None):
+    """ Run a FakeServer until interrupted."""
+    import argparse
+    parser = argparse.ArgumentParser(description="In-memory CPS stand-in server.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--tcp-port', type=int, default=5550)
+    parser.add_argument('--http-port', type=int, default=8080)
+    parser.add_argument('--unix', dest='unix_path', default=None, help="Unix socket path.")
+    parser.add_argument('--latency', type=float, default=0, help="Seconds every request is delayed by.")
+    parser.add_argument('--padding', type=int, default=0, help="Bytes of padding added to every response.")
+    parser.add_argument('--drop', type=float, default=0, help="Fraction of requests answered by closing the connection.")
+    parser.add_argument('--storage', default='storage')
+    parser.add_argument('--document-root-xpath', default='document')
+    parser.add_argument('--document-id-xpath', default='./id')
+    options = parser.parse_args(args)
+    server = FakeServer(options.host, options.tcp_port, options.http_port, options.unix_path, options.latency,
+                        options.padding, options.storage, options.document_root_xpath,
+                        options.document_id_xpath, drop=options.drop).start()
+    print("Serving tcp on {0}, http on {1}{2}".format(server.tcp_port, server.http_port,
+                                                      ', unix on ' + options.unix_path if options.unix_path else ''))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
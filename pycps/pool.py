@@ -0,0 +1,318 @@
+#    Copyright 2012 ClusterPoint, SIA
+#
+#    This file is part of Pycps.
+#
+#    Pycps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Pycps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Pycps.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import threading
+
+from connection import *
+
+
+def _send_concurrently(requests, threads):
+    """ Send requests from up to threads threads, including the calling one.
+
+        Returns:
+            A list of responses in the order of the requests.
+
+        Raises:
+            The first error raised sending a request, requests not started yet are not sent then.
+    """
+    responses = [None] * len(requests)
+    errors = []
+    indexes = iter(range(len(requests)))
+    lock = threading.Lock()
+
+    def send():
+        while True:
+            with lock:
+                index = (next(indexes, None) if not errors else None)
+            if index is None:
+                return
+            try:
+                responses[index] = requests[index].send()
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+
+    workers = [threading.Thread(target=send) for i in range(min(threads, len(requests)) - 1)]
+    for worker in workers:
+        worker.start()
+    send()
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0]
+    return responses
+
+
+def _iter_concurrently(requests, threads, ordered):
+    """ Send requests from threads threads and yield (request index, response) pairs as they are recieved.
+
+        Args:
+            requests -- A list of Request objects.
+            threads -- Number of requests sent at once.
+            ordered -- If True, responses are yielded in the order of the requests, otherwise in the
+                    order they are recieved.
+
+        A request is started only while fewer than twice threads responses are sent or waiting for the
+        caller, so memory stays bounded if the caller is slower. The first error stops sending and is
+        raised. When the caller stops iterating, requests not started yet are not sent.
+    """
+    condition = threading.Condition()
+    window = 2 * threads
+    state = {'started': 0, 'yielded': 0, 'stop': False}
+    results = {}    # Request index -> (response, error).
+    completed = collections.deque()     # Indexes in the order their responses were recieved.
+
+    def send():
+        while True:
+            with condition:
+                while (not state['stop'] and state['started'] < len(requests) and
+                       state['started'] - state['yielded'] >= window):
+                    condition.wait()
+                if state['stop'] or state['started'] >= len(requests):
+                    return
+                index = state['started']
+                state['started'] += 1
+            try:
+                result = (requests[index].send(), None)
+            except Exception as e:
+                result = (None, e)
+            with condition:
+                results[index] = result
+                completed.append(index)
+                condition.notify_all()
+
+    workers = [threading.Thread(target=send, name='pycps-scan') for i in range(min(threads, len(requests)))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    try:
+        while state['yielded'] < len(requests):
+            with condition:
+                while True:
+                    index = (state['yielded'] if ordered else (completed[0] if completed else None))
+                    if index in results:
+                        break
+                    condition.wait()
+                if not ordered:
+                    completed.popleft()
+                response, error = results.pop(index)
+                state['yielded'] += 1
+                condition.notify_all()
+            if error is not None:
+                raise error
+            yield index, response
+    finally:
+        with condition:
+            state['stop'] = True
+            condition.notify_all()
+        for worker in workers:
+            worker.join()
+
+
+class ConnectionPool(Connection):
+    """ Thread-safe pool of connections to a single CPS endpoint.
+
+        Exposes the same API as Connection, but every request checks out a connection socket
+        from the pool, and returns it when the response is recieved, so several threads can
+        have requests in flight at the same time without opening a new socket per request.
+    """
+
+    def __init__(self, url, storage, user, password, account, min_connections=1, max_connections=10,
+                    pool_timeout=None, cache=None, **kwargs):
+        """ Create a new connection pool to CPS.
+
+            Args:
+                See Connection.__init__().
+
+            Keyword args:
+                min_connections -- Number of connections opened up front and kept open. Default is 1.
+                max_connections -- Maximum number of connections open at the same time. Default is 10.
+                pool_timeout -- Seconds to wait for a free connection when all max_connections are in use.
+                        Default is None - wait forever.
+                See Connection.__init__().
+        """
+        if min_connections < 0 or max_connections < 1 or min_connections > max_connections:
+            raise ParameterError("min_connections={0}, max_connections={1}".format(min_connections,
+                                                                                  max_connections))
+        self._min_connections = min_connections
+        self._max_connections = max_connections
+        self._pool_timeout = pool_timeout
+        self._connection_args = (url, storage, user, password, account)
+        self._connection_kwargs = kwargs
+        self._idle = []     # Connections ready to be checked out, most recently used last.
+        self._size = 0      # Open connections - idle and checked out ones.
+        self._closed = False
+        self._pool_lock = threading.Condition(threading.Lock())
+        Connection.__init__(self, url, storage, user, password, account, cache=cache, **kwargs)
+
+    def _open_connection(self):
+        """ Open the minimal number of connections to the CPS."""
+        while self._size < self._min_connections:
+            self._size += 1
+            try:
+                self._idle.append(self._new_connection())
+            except:
+                self._size -= 1
+                raise
+
+    def _new_connection(self):
+        return Connection(*self._connection_args, **self._connection_kwargs)
+
+    def _checkout(self, deadline=None):
+        """ Take an idle connection from the pool or open a new one if the pool is not full.
+
+            Keyword args:
+                deadline -- Monotonic time of the request's deadline. Default is None - no limit.
+
+            Returns:
+                A Connection object reserved for the calling thread.
+
+            Raises:
+                ConnectionError -- No connection got free in pool_timeout seconds or the pool is closed.
+                TimeoutError -- No connection got free before the deadline.
+        """
+        if self._pool_timeout is not None:
+            end_time = monotonic() + self._pool_timeout
+        with self._pool_lock:
+            while True:
+                if self._closed:
+                    raise ConnectionError("Connection pool is closed.")
+                if self._idle or self._size < self._max_connections:
+                    break
+                remaining = None
+                if self._pool_timeout is not None:
+                    remaining = end_time - monotonic()
+                    if remaining <= 0:
+                        raise ConnectionError("Connection pool exhausted, no free connection in {0} seconds."
+                                              .format(self._pool_timeout))
+                if deadline is not None:
+                    left = deadline - monotonic()
+                    if left <= 0:
+                        raise TimeoutError("The deadline passed while waiting for a free pool connection.")
+                    if remaining is None or left < remaining:
+                        remaining = left
+                self._pool_lock.wait(remaining)
+            if self._idle:
+                return self._idle.pop()
+            self._size += 1
+        # Connect outside the lock so other threads can still check in and out.
+        try:
+            return self._new_connection()
+        except:
+            self._discard(None)
+            raise
+
+    def _send_chunks(self, requests, merge):
+        """ Send the chunks of a split request over up to max_connections connections. See Connection._send_chunks()."""
+        return merge(_send_concurrently(requests, self._max_connections))
+
+    def _scan(self, requests, parallelism, ordered):
+        """ Send the requests of a scan over up to parallelism connections. See Connection._scan()."""
+        return _iter_concurrently(requests, min(parallelism, self._max_connections), ordered)
+
+    def _checkin(self, connection):
+        """ Return a healthy connection back to the pool."""
+        if self._closed:
+            self._discard(connection)
+            return
+        with self._pool_lock:
+            self._idle.append(connection)
+            self._pool_lock.notify()
+
+    def _discard(self, connection):
+        """ Drop a connection, that can't be reused, from the pool."""
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+        with self._pool_lock:
+            self._size -= 1
+            self._pool_lock.notify()
+
+    def _send_request(self, xml_request, deadline=None):
+        """ Send the prepared XML request block to the CPS using a connection from the pool.
+
+            Args:
+                xml_request -- A fully formed xml request string for the CPS.
+
+            Keyword args:
+                deadline -- See Connection._send_request().
+
+            Returns:
+                The raw xml response string.
+
+            Raises:
+                ConnectionError -- Can't establish a connection with the server or the pool is exhausted.
+        """
+        connection = self._checkout(deadline)
+        try:
+            response = connection._send_request(xml_request, deadline)
+        except:
+            # The stream state is unknown, so the socket can't be reused.
+            self._discard(connection)
+            raise
+        self._checkin(connection)
+        return response
+
+    def _send_request_streamed(self, xml_request, deadline=None):
+        """ Send the prepared XML request block using a connection from the pool without reading the response.
+            The connection is returned to the pool when the stream is read or closed.
+            See Connection._send_request_streamed().
+        """
+        connection = self._checkout(deadline)
+        try:
+            stream = connection._send_request_streamed(xml_request, deadline)
+        except:
+            self._discard(connection)
+            raise
+        finish = stream._finish
+
+        def finish_and_checkin(complete):
+            try:
+                finish(complete)
+            except:
+                self._discard(connection)
+                raise
+            self._checkin(connection)
+        stream._finish = finish_and_checkin
+        return stream
+
+    def _send_pipelined(self, xml_requests, depth):
+        """ Pipeline xml requests on a single connection checked out from the pool. See Connection._send_pipelined()."""
+        connection = self._checkout()
+        completed = False
+        try:
+            for response in connection._send_pipelined(xml_requests, depth):
+                yield response
+            completed = True
+        finally:
+            if completed:
+                self._checkin(connection)
+            else:
+                self._discard(connection)
+
+    def close(self):
+        """ Close all idle connections in the pool. Checked out connections are closed when returned."""
+        with self._pool_lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._pool_lock.notify_all()
+        for connection in idle:
+            connection.close()
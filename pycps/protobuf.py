@@ -0,0 +1,208 @@
+#    Copyright 2012 ClusterPoint, SIA
+#
+#    This file is part of Pycps.
+#
+#    Pycps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Pycps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Pycps.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Encoding and decoding of the protobuf fields and message headers used by the unix and tcp transports.
+
+    Decoding works in place on a string, bytearray or memoryview with offsets, so the cost is
+    linear in the number of fields and never depends on the size of the data following them.
+"""
+
+import struct
+
+from errors import *
+
+
+REQUEST_FIELD = 1   # Request or response xml string.
+STORAGE_FIELD = 2   # Storage name.
+ERROR_FIELD = 3     # Error message set by the server instead of a response.
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGHT_DELIMITED = 2
+WIRE_FIXED32 = 5
+
+HEADER_LENGHT = 8
+_HEADER_MAGIC = '\t\t\x00\x00'
+_HEADER_STRUCT = struct.Struct('<I')
+
+
+def encode_varint(number):
+    """ Encode a non-negative integer as a protobuf varint.
+
+    >>> encode_varint(1)
+    '\\x01'
+
+    >>> encode_varint(300)
+    '\\xac\\x02'
+
+    >>> encode_varint(0)
+    '\\x00'
+    """
+    if number < 0x80:
+        return chr(number)
+    buff = bytearray()
+    while number >= 0x80:
+        buff.append((number & 0x7F) | 0x80)
+        number >>= 7
+    buff.append(number)
+    return str(buff)
+
+
+def decode_varint(buffer, offset=0):
+    """ Decode a protobuf varint starting at offset of a string, bytearray or memoryview.
+
+        Returns:
+            A tuple of the decoded number and the offset just after it.
+
+        Raises:
+            TransportError -- The buffer ends in the middle of the varint.
+
+    >>> decode_varint('\\xac\\x02')
+    (300, 2)
+
+    >>> decode_varint(bytearray('\\x08\\xac\\x02'), 1)
+    (300, 3)
+    """
+    number = 0
+    shift = 0
+    end = len(buffer)
+    while True:
+        if offset >= end:
+            raise TransportError("Truncated varint in the message.")
+        byte = buffer[offset]
+        if not isinstance(byte, int):
+            byte = ord(byte)
+        offset += 1
+        number |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return (number, offset)
+        shift += 7
+
+
+def encode_field_prefix(field_id, lenght):
+    """ Encode the protobuf key and lenght preceding a lenght delimited field's data.
+
+    >>> encode_field_prefix(1, 300)
+    '\\n\\xac\\x02'
+    """
+    return encode_varint((field_id << 3) | WIRE_LENGHT_DELIMITED) + encode_varint(lenght)
+
+
+def encode_fields(fields):
+    """ Encode a dict of field ids and strings as lenght delimited protobuf fields.
+
+    >>> encode_fields({1: 'foo', 2: ''})
+    '\\n\\x03foo\\x12\\x00'
+    """
+    chunks = []
+    for field_id, message in sorted(fields.items()):
+        chunks.append(encode_field_prefix(field_id, len(message)))
+        chunks.append(message)
+    return ''.join(chunks)
+
+
+def iter_fields(buffer, offset=0, end=None):
+    """ Walk the protobuf fields in a buffer without copying any of the data.
+
+        Args:
+            buffer -- A string, bytearray or memoryview containing encoded fields.
+
+        Keyword args:
+            offset -- Offset of the first field. Default is 0.
+            end -- Offset the fields end at. Default is the end of the buffer.
+
+        Returns:
+            A generator of (field_id, wire_type, value) tuples. For varint fields the value is the
+            number, for all other wire types it's a (start, stop) tuple of offsets in the buffer.
+
+        Raises:
+            TransportError -- Malformed or unsupported fields in the buffer.
+
+    >>> list(iter_fields('\\n\\x03foo\\x10\\x05'))
+    [(1, 2, (2, 5)), (2, 0, 5)]
+    """
+    if end is None:
+        end = len(buffer)
+    while offset < end:
+        key, offset = decode_varint(buffer, offset)
+        field_id = key >> 3
+        wire_type = key & 0x07
+        if wire_type == WIRE_VARINT:
+            value, offset = decode_varint(buffer, offset)
+            yield (field_id, wire_type, value)
+            continue
+        if wire_type == WIRE_LENGHT_DELIMITED:
+            lenght, offset = decode_varint(buffer, offset)
+        elif wire_type == WIRE_FIXED64:
+            lenght = 8
+        elif wire_type == WIRE_FIXED32:
+            lenght = 4
+        else:   # Groups are not used by CPS.
+            raise TransportError("Unsupported wire type {0} in the message.".format(wire_type))
+        if offset + lenght > end:
+            raise TransportError("Truncated field {0} in the message.".format(field_id))
+        yield (field_id, wire_type, (offset, offset + lenght))
+        offset += lenght
+
+
+def decode_fields(buffer, offset=0, end=None):
+    """ Decode protobuf fields to a dict of field ids and values.
+
+        Args:
+            See iter_fields().
+
+        Returns:
+            A dict where values of varint fields are numbers and others are slices of the buffer -
+            a memoryview buffer is not copied.
+
+    >>> decode_fields('\\n\\x03foo\\x1a\\x05error')
+    {1: 'foo', 3: 'error'}
+
+    >>> fields = decode_fields(memoryview('\\n\\x03foo'))
+    >>> fields[1].tobytes()
+    'foo'
+    """
+    fields = {}
+    for field_id, wire_type, value in iter_fields(buffer, offset, end):
+        if wire_type == WIRE_VARINT:
+            fields[field_id] = value
+        else:
+            fields[field_id] = buffer[value[0]:value[1]]
+    return fields
+
+
+def make_header(lenght):
+    """ Make the 8 byte header preceding a message of the given lenght.
+
+    >>> make_header(258)
+    '\\t\\t\\x00\\x00\\x02\\x01\\x00\\x00'
+    """
+    return _HEADER_MAGIC + _HEADER_STRUCT.pack(lenght)
+
+
+def parse_header(header):
+    """ Get the message lenght from a 8 byte message header.
+
+        Raises:
+            TransportError -- Not a valid message header.
+
+    >>> parse_header('\\t\\t\\x00\\x00\\x02\\x01\\x00\\x00')
+    258
+    """
+    if len(header) != HEADER_LENGHT or bytearray(header[:4]) != _HEADER_MAGIC:
+        raise TransportError("Invalid message header recieved.")
+    return _HEADER_STRUCT.unpack_from(header, 4)[0]
@@ -112,3 +112,41 @@ def not_term(term):
             A negated argument term string.
     """
     return '~{0}'.format(term)
+
+def numeric_ordering(xpath, ascending=True):
+    """ Build an ordering string sorting documents by the numeric value of a tag.
+
+        Args:
+            xpath -- The xpath of the tag to sort by.
+
+        Keyword args:
+            ascending -- Whether the smallest values come first. Default is True.
+
+        Returns:
+            An ordering string for the ordering argument of search().
+
+    >>> numeric_ordering('document/price', False)
+    '<numeric><document><price>descending</price></document></numeric>'
+    """
+    return '<numeric>{0}</numeric>'.format(term('ascending' if ascending else 'descending', xpath))
+
+def string_ordering(xpath, ascending=True, lang=None):
+    """ Build an ordering string sorting documents alphabetically by the text of a tag.
+
+        Args:
+            xpath -- The xpath of the tag to sort by.
+
+        Keyword args:
+            ascending -- Whether the first values in the alphabet come first. Default is True.
+            lang -- An optional language identificator string for the collation, e.g. 'en'.
+
+        Returns:
+            An ordering string for the ordering argument of search().
+
+    >>> string_ordering('document/title', lang='en')
+    '<string><document><title>ascending,en</title></document></string>'
+    """
+    direction = 'ascending' if ascending else 'descending'
+    if lang:
+        direction += ',' + lang
+    return '<string>{0}</string>'.format(term(direction, xpath))
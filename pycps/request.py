@@ -1,3 +1,4 @@
+# -*- coding: utf-8 -*-
 #    Copyright 2012 ClusterPoint, SIA
 #
 #    This file is part of Pycps.
@@ -36,13 +37,77 @@ except ImportError:
 
 from utils import *
 from converters import *
+from converters import _set_id, _string_id_plan, _ids_to_xml
 import query
 from  response import _handle_response
 
 
+def _utf8(value):
+    """ Encode unicode request content to utf-8, like the request envelope declares, leave other values as they are."""
+    return (value.encode('utf-8') if isinstance(value, unicode) else value)
+
+
+def _documents_to_xml(documents, doc_root_tag, doc_id_xpath, fully_formed=False):
+    """ Convert documents to xml strings with the root tag and id. See Request.set_documents().
+
+        Args:
+            documents -- See Request.set_documents().
+            doc_root_tag -- The document root tag, see Connection.document_root_xpath.
+            doc_id_xpath -- The document id tag xpath relative to the root, see Connection.document_id_xpath.
+
+        Keyword args:
+            fully_formed -- See Request.set_documents().
+
+        Returns:
+            A list of xml strings.
+
+    >>> _documents_to_xml([(1, ET.fromstring('<x>1</x>')), (2, {'x': 2}), (3, '<x>3</x>')], 'document', './id')
+    ['<document><x>1</x><id>1</id></document>', '<document><x>2</x><id>2</id></document>', '<document><x>3</x><id>3</id></document>']
+
+    >>> _documents_to_xml([(1, '<text>a</text><b/>')], 'document', './id')  # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    XMLError: Bad xml document
+    >>> _documents_to_xml([(1, '<text/><id>5</id>')], 'document', './id')  # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    XMLError: Bad xml document
+    """
+    if fully_formed: # documents is a list or single document that contians root tags and id fields.
+        if not isinstance(documents, list):
+            documents = [documents]
+        return map(to_raw_xml, documents)
+    else: # documents is dict with ids as keys and documents as values or a list of (id, document) pairs.
+        id_path = doc_id_xpath.split('/')
+        string_id_plan = _string_id_plan(doc_root_tag, doc_id_xpath)
+        if hasattr(documents, 'items'):
+            documents = documents.items()
+        # Convert one document at a time, so only the finished xml strings are kept.
+        xml_documents = []
+        for id, document in documents:
+            if document is None:
+                document = {}
+            if isinstance(document, dict):  # Dicts are written straight to xml, etree Elements have keys() too.
+                xml_documents.append(dict_to_xml(document, doc_root_tag, doc_id_xpath, id))
+                continue
+            if isinstance(document, basestring):    # Strings get the id spliced in if possible.
+                xml_document = string_id_plan.inject(document, id)
+                if xml_document is not None:
+                    xml_documents.append(xml_document)
+                    continue
+            document = to_etree(document, doc_root_tag)
+            # If root not the same as given xpath, make new root and append to it.
+            if document.tag != doc_root_tag:
+                root = ET.Element(doc_root_tag)
+                root.append(document)
+                document = root
+            _set_id(document, id_path, id)
+            xml_documents.append(to_raw_xml(document))
+        return xml_documents
+
+
 class Request(object):
     """ Handles requests to the Storage."""
-    def __init__(self, connection, command, request_id=None, timeout=None, type=None):
+    def __init__(self, connection, command, request_id=None, timeout=None, type=None, stream=False,
+                 deadline=None, raise_errors=True):
         """
             Args:
                 connection -- A Connection object to be used for this request.
@@ -52,9 +117,21 @@ class Request(object):
                 timeout --
                 type -- Type of request processing. Can be 'auto', 'single', 'cluster'. Default is 'auto'.
                 request_id -- Optional request id identificator.
+                stream -- If True, the response is parsed incrementally while it's read from the connection
+                        and documents can be consumed one at a time with iter_documents() without holding
+                        the whole response in memory. The connection can't send other requests until
+                        the response is read or closed. Default is False.
+                deadline -- Seconds the request may take from connecting and sending it to recieving the whole
+                        response, enforced on the client's socket. TimeoutError is raised and the socket is closed
+                        if it passes. Default is None - use the connection's default deadline.
+                raise_errors -- If False, errors in the response are not raised, they can be examined with
+                        the response's errors property instead. Default is True.
         """
         self.connection = connection
         self._command = command
+        self.stream = stream
+        self.deadline = deadline
+        self.raise_errors = raise_errors
 
 # These fields are for the envelope of the request.
         self.request_id = request_id
@@ -71,7 +148,10 @@ class Request(object):
 
             Args:
                 documents -- If fully_formed is False (default), accepts dict where keys are document ids and values can be ether
-                            xml string, etree.ElementTree or dict representation of an xml document (see dict_to_etree()).
+                            xml string, etree.ElementTree or dict representation of an xml document (see dict_to_etree()),
+                            or an iterable of (id, document) pairs, that keeps the documents in order.
+                            Xml strings usually get the id tag spliced in without being parsed, so malformed
+                            ones are reported by the server instead of raising XMLError.
                             If fully_formed is True, accepts list or single document where ids are integrated in document or
                             not needed and document has the right root tag.
 
@@ -80,40 +160,8 @@ class Request(object):
                             to avoid the owerhead of documets beeing parsed at all. If set to True only list of documents or
                             a single document can be pased as 'documents', not a dict of documents. Default is False.
         """
-        def add_id(document, id):
-            def make_id_tag(root, rel_path, max_depth):
-                if max_depth < 0:
-                    raise ParameterError("document_id_xpath too deep!")
-                if not rel_path:
-                    return root
-                else:
-                    child = root.find(rel_path[0])
-                    if child is None:
-                        child = ET.Element(rel_path[0])
-                        root.append(child)
-                    return make_id_tag(child, rel_path[1:], max_depth - 1)
-            make_id_tag(document, doc_id_xpath, 10).text = str(id)
-
-        if fully_formed: # documents is a list or single document that contians root tags and id fields.
-            if not isinstance(documents, list):
-                documents = [documents]
-        else: # documents is dict with ids as keys and documents as values.
-            doc_root_tag = self.connection.document_root_xpath  # Local scope is faster.
-            doc_id_xpath = self.connection.document_id_xpath.split('/')
-            # Convert to etrees.
-            documents = dict([(id, to_etree((document if document is not None else
-                                             query.term('', doc_root_tag)), doc_root_tag))
-                             for id, document in documents.items()])     # TODO: possibly ineficient
-            # If root not the same as given xpath, make new root and append to it.
-            for id, document in documents.items():
-                if document.tag != doc_root_tag:
-                    documents[id] = ET.Element(doc_root_tag)
-                    documents[id].append(document)  # documents is still the old reference
-            # Insert ids in documents and collapse to a list of documents.
-            for id, document in documents.items():
-                add_id(document, id)
-            documents = documents.values()
-        self._documents = map(to_raw_xml, documents)
+        self._documents = _documents_to_xml(documents, self.connection.document_root_xpath,
+                                            self.connection.document_id_xpath, fully_formed)
 
     def set_doc_ids(self, doc_ids):
         """ Build xml documents from a list of document ids.
@@ -121,10 +169,9 @@ class Request(object):
             Args:
                 doc_ids -- A document id or a lost of those.
         """
-        if isinstance(doc_ids, list):
-            self.set_documents(dict.fromkeys(doc_ids))
-        else:
-            self.set_documents({doc_ids: None})
+        if not isinstance(doc_ids, list):
+            doc_ids = [doc_ids]
+        self._documents = _ids_to_xml(doc_ids, self.connection.document_root_xpath, self.connection.document_id_xpath)
 
     def add_property(self, set_property, name, starting_value, tag_name=None):
         """ Set properies of atributes stored in content using stored common fdel and fget and given fset.
@@ -309,12 +356,12 @@ class Request(object):
         for key, value in self._nested_content.items():
             if value:
                 xml_content += ['<{0}>'.format(key)] +\
-                    ['<{0}>{1}</{0}>'.format(sub_key, sub_value) for sub_key, sub_value in value if sub_value] +\
+                    ['<{0}>{1}</{0}>'.format(sub_key, _utf8(sub_value)) for sub_key, sub_value in value if sub_value] +\
                     ['</{0}>'.format(key)]
         for key, value in self._content.items():
             if not isinstance(value, list):
                 value = [value]
-            xml_content += ['<{0}>{1}</{0}>'.format(key, item) for item in value if item]
+            xml_content += ['<{0}>{1}</{0}>'.format(key, _utf8(item)) for item in value if item]
         xml_content = '\n'.join(xml_content)
         return wrap_xml_content(xml_content)
 
@@ -322,7 +369,7 @@ class Request(object):
         """ Send an XML string version of content through the connection.
 
         Returns:
-            Response object.
+            Response object, or a ResponseFuture if sent through an AsyncConnection.
         """
         xml_request = self.get_xml_request()
         if(self.connection._debug == 1):
@@ -335,14 +382,25 @@ class Request(object):
         Debug.dump("Request: \n", xml_request)
 
 
-        response = _handle_response(self.connection._send_request(xml_request),
-                                         self._command, self.connection.document_id_xpath)
+        response = self.connection._execute(self, xml_request)
         # TODO: jāpabeidz debugs 
         # if(self.connection._debug == 1):
         #     # print(response)
         #     print(format(ET.tostring(response)))
         return response
 
+    def handle_response(self, response):
+        """ Make a Response object of the type matching this request's command.
+
+        Args:
+            response -- The raw xml response string recieved for this request.
+
+        Returns:
+            Response object.
+        """
+        return _handle_response(response, self._command, self.connection.document_id_xpath,
+                                raise_errors=self.raise_errors, stream=self.stream)
+
 
 class BackupRequest(Request):
     def __init__(self, connection, backup_file, backup_type=None, **kwargs):
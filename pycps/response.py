@@ -34,6 +34,7 @@ except ImportError:
                 # old ET
                 import elementtree.ElementTree as ET
 
+import io
 import warnings
 
 from utils import *
@@ -75,6 +76,53 @@ def _handle_response(response, command, id_xpath='./id', **kwargs):
     return request_class(response, id_xpath, **kwargs)
 
 
+def _merge_responses(responses, raise_errors=True):
+    """ Merge the responses to the chunks of a request split by document ids into the first one.
+
+        Documents and errors of the other responses are moved to the first one, hits, found and more
+        are summed, to is recounted and seconds is the longest one, as the chunks are sent concurrently.
+
+        Args:
+            responses -- A list of Response objects parsed without raising errors, in the order of the chunks.
+
+        Keyword args:
+            raise_errors -- If True, raise errors of the merged response, see Response.__init__(). Default is True.
+
+        Returns:
+            The merged Response object.
+    """
+    merged = responses[0]
+    merged._consume()
+    content = merged._content
+    for response in responses[1:]:
+        response._consume()
+        for error in response._response.findall('{www.clusterpoint.com}error'):
+            merged._response.append(error)
+        for element in list(response._content):
+            existing = content.find(element.tag)
+            if element.tag in ('from', 'to'):
+                continue
+            elif existing is None or element.tag == 'document':
+                content.append(element)
+            elif element.tag == 'results':
+                existing.extend(list(element))
+            elif element.tag in ('hits', 'found'):
+                existing.text = str(int(existing.text) + int(element.text))
+            elif element.tag == 'more':     # More is in form '=<number>'.
+                existing.text = '=' + str(int(existing.text[1:]) + int(element.text[1:]))
+        seconds = merged._response.find('{www.clusterpoint.com}seconds')
+        other_seconds = response._response.find('{www.clusterpoint.com}seconds')
+        if seconds is not None and other_seconds is not None and float(other_seconds.text) > float(seconds.text):
+            seconds.text = other_seconds.text
+    from_document, to_document, found = content.find('from'), content.find('to'), content.find('found')
+    if from_document is not None and to_document is not None and found is not None:
+        to_document.text = str(int(from_document.text) + int(found.text))
+    merged._raise_errors = raise_errors
+    if raise_errors:
+        merged._parse_for_errors()
+    return merged
+
+
 class Response(object):
     """ Response object to a request to Clusterpoint Storage.
 
@@ -82,8 +130,9 @@ class Response(object):
             seconds -- A float of seconds it took the Clusterpoint Storage to prepare this response.
             storage_name -- The name of Clusterpoint Storage this response was recieved from.
             command -- The command to what this response is made.
+            errors -- A list of APIError objects for the errors in this response.
     """
-    def __init__(self, response, id_xpath='./id', raise_errors=True):
+    def __init__(self, response, id_xpath='./id', raise_errors=True, stream=False):
         """
             Args:
                 response -- A raw XML response block with envelope and all.
@@ -93,12 +142,23 @@ class Response(object):
                         rise them as exceptions. Default is True.
                 id_xpath -- The document id tag xpath relative to the document root used for id extracting.
                         Default is './id'.
+                stream -- If True, response is a file-like object with a read() method, the response is
+                        parsed straight from it without buffering the whole response string. A response
+                        string is accepted too. Default is False.
 
             Raises:
                 APIError -- Recieved an error in the server response.
                 APIWarning -- Recieved an nonfatal error in the server response.
                 ResponseError -- Recieved invalid response string.
         """
+        self._id_xpath = id_xpath.split('/')
+        self._raise_errors = raise_errors
+        self._stream = None
+        if stream:
+            if isinstance(response, basestring):    # Already recieved, e.g. through an AsyncConnection.
+                response = io.BytesIO(response)
+            self._init_stream(response)
+            return
         Debug.dump('Raw response: \n', response)
         try:
             self._response = ET.fromstring(response)
@@ -107,27 +167,59 @@ class Response(object):
         if raise_errors:
             self._parse_for_errors()
         self._content = self._response.find('{www.clusterpoint.com}content')
-        self._id_xpath = id_xpath.split('/')
 
-    def _parse_for_errors(self):
-        """ Look for an error tag and raise APIError for fatal errors or APIWarning for nonfatal ones. """
-        error = self._response.find('{www.clusterpoint.com}error')
-        if error is not None:
+    def _init_stream(self, source):
+        """ Parse the whole response from a file-like source. """
+        try:
+            try:
+                self._response = ET.parse(source).getroot()
+            except: # Various ET types have differnet errors ..
+                raise ResponseError("Unable to parse the streamed response.")
+        finally:
+            source.close()
+        if self._raise_errors:
+            self._parse_for_errors()
+        self._content = self._response.find('{www.clusterpoint.com}content')
+
+    def _consume(self):
+        """ Make sure the whole response is parsed. Only streamed responses may be parsed partially. """
+        pass
+
+    def close(self):
+        """ Stop reading a streamed response and release the connection it is read from. """
+        pass
+
+    def _parse_for_errors(self, ignored_codes=()):
+        """ Look for error tags and raise APIError for the first fatal error or APIWarning for nonfatal ones,
+            except for errors with ignored_codes.
+        """
+        for error in self._response.findall('{www.clusterpoint.com}error'):
+            if int(error.find('code').text) in ignored_codes:
+                continue
             if error.find('level').text.lower() in ('rejected', 'failed', 'error', 'fatal'):
                 raise APIError(error)
             else:
                 warnings.warn(APIWarning(error))
 
+    @property
+    def errors(self):
+        """ A list of APIError objects for all errors in the response, including nonfatal ones."""
+        self._consume()
+        return [APIError(error) for error in self._response.findall('{www.clusterpoint.com}error')]
+
     def get_content_dict(self):
         """ Get the Clusterpoint response's content as a dict. See etree_to_dict(). """
+        self._consume()
         return etree_to_dict(self._content)['{www.clusterpoint.com}content']
 
     def get_content_etree(self):
         """ Get the Clusterpoint response's content as an etree. """
+        self._consume()
         return self._content
 
     def get_content_string(self):
         """ Ge thet Clusterpoint response's content as a string. """
+        self._consume()
         return ''.join([ET.tostring(element, encoding="utf-8", method="xml")
                         for element in list(self._content)])
 
@@ -141,6 +233,7 @@ class Response(object):
                 A dict representing the contents of the specified field or a list of dicts
                 if there are multiple fields with that tag name. Returns None if no field found.
         """
+        self._consume()
         fields = self._content.findall(name)
         if not fields:
             return None
@@ -151,14 +244,17 @@ class Response(object):
 
     @property
     def seconds(self):
+        self._consume()
         return float(self._response.find('{www.clusterpoint.com}seconds').text)
 
     @property
     def storage_name(self):
+        self._consume()
         return self._response.find('{www.clusterpoint.com}storage').text
 
     @property
     def command(self):
+        self._consume()
         return self._response.find('{www.clusterpoint.com}command').text
 
 
@@ -182,6 +278,8 @@ class ModifyResponse(Response):
     @property
     def modified_ids(self):
         documents = self.get_content_field('document')
+        if documents is None:
+            return []
         if not isinstance(documents, list):
             documents = [documents]
         return [document['id'] for document in documents]
@@ -209,6 +307,20 @@ class ListPathsResponse(Response):
         return [path.text for path in self._content.find('paths').findall('path')]
 
 
+_DOC_FORMATS = ('dict', 'etree', 'list-etree', 'list-string', '', None, 'string')
+_RESULTS_START, _RESULTS_END, _END = range(3)   # Stream parsing states. See ListResponse._advance().
+
+
+def _get_doc_id(root, rel_path):
+    if not rel_path:
+        return root.text
+    else:
+        child = root.find(rel_path[0])
+        if child is None:
+            return None
+        return _get_doc_id(child, rel_path[1:])
+
+
 class ListResponse(Response):
     """ ListResponse object to a request to Clusterpoint Storage.
 
@@ -219,51 +331,154 @@ class ListResponse(Response):
             more -- Number of documents matching but not returned.
             hits -- The number of documents matching the query.
     """
+    def _init_stream(self, source):
+        """ Parse the response from a file-like source up to the start of the results.
+            Documents are parsed when iterated over with iter_documents(). """
+        self._stream = source
+        self._events = iter(ET.iterparse(source, events=('start', 'end')))
+        self._depth = 0
+        self._response = None
+        self._content = None
+        self._results = None
+        self._in_results = False
+        while self._advance() not in (_RESULTS_START, _END):
+            pass
+        if self._response is None:
+            raise ResponseError("Empty streamed response.")
+        if self._raise_errors:
+            self._parse_for_errors()
+
+    def _advance(self):
+        """ Pull parser events from the stream until something interesting happens.
+
+            Returns:
+                A document element that has just been parsed completely, _RESULTS_START or _RESULTS_END
+                when the results tag starts or ends, or _END when the whole response is parsed.
+        """
+        while True:
+            try:
+                event, element = next(self._events)
+            except StopIteration:
+                self._finish_stream()
+                return _END
+            except CPSError:
+                self._finish_stream(error=True)
+                raise
+            except Exception: # Various ET types have differnet errors ..
+                self._finish_stream(error=True)
+                raise ResponseError("Unable to parse the streamed response.")
+            if event == 'start':
+                self._depth += 1
+                if self._depth == 1:
+                    self._response = element
+                elif self._depth == 2 and element.tag == '{www.clusterpoint.com}content':
+                    self._content = element
+                elif self._depth == 3 and element.tag == 'results' and self._content is not None and\
+                        self._results is None:
+                    self._results = element
+                    self._in_results = True
+                    return _RESULTS_START
+            else:
+                self._depth -= 1
+                if self._in_results:
+                    if element is self._results:
+                        self._in_results = False
+                        return _RESULTS_END
+                    elif self._depth == 3:
+                        return element
+
+    def _finish_stream(self, error=False):
+        source, self._stream = self._stream, None
+        if source is not None:
+            source.close()
+            if not error and self._raise_errors:
+                self._parse_for_errors()
+
+    def _consume(self):
+        """ Parse the rest of a streamed response, keeping all not yet iterated documents. """
+        while self._stream is not None:
+            self._advance()
+
+    def close(self):
+        """ Stop reading a streamed response and release the connection it is read from. """
+        self._finish_stream(error=True)
+
     def _get_doc_list(self):
+        self._consume()
         # ET.Element returns a list of subelements if pased to the inbuilt list().
         return list(self._content.find('results'))
 
+    def _convert_document(self, document, doc_format):
+        """ Convert a document element to an (id, document) pair or just a document for 'list-' formats. """
+        if doc_format == 'dict':
+            return (_get_doc_id(document, self._id_xpath), etree_to_dict(document)['document'])
+        elif doc_format == 'etree':
+            return (_get_doc_id(document, self._id_xpath), document)
+        elif doc_format == 'list-etree':
+            return document
+        elif doc_format == 'list-string':
+            return ET.tostring(document)
+        elif doc_format in ('', None, 'string'):
+            return (_get_doc_id(document, self._id_xpath), ET.tostring(document))
+        else:
+            raise ParameterError("doc_format=" + doc_format)
+
     def get_documents(self, doc_format='dict'):
         """ Get the documents returned from Storege in this response.
 
             Keyword args:
                 doc_format -- Specifies the doc_format for the returned documents.
-                    Can be 'dict', 'etree' or 'string'. Default is 'dict'.
+                    Can be 'dict', 'etree', 'string', 'list-etree' or 'list-string'. Default is 'dict'.
 
             Returns:
                 A dict where keys are document ids and values depending of the required doc_format:
                     A dict representations of documents (see etree_to_dict());
                     A etree Element representing the document;
                     A raw XML document string.
+                For 'list-etree' and 'list-string' formats a list of documents in the returned order.
 
             Raises:
                 ParameterError -- The doc_format value is not allowed.
         """
-        def get_doc_id(root, rel_path):
-            if not rel_path:
-                return root.text
-            else:
-                child = root.find(rel_path[0])
-                if child is None:
-                    return None
-                return get_doc_id(child, rel_path[1:])
+        if doc_format not in _DOC_FORMATS:
+            raise ParameterError("doc_format=" + str(doc_format))
+        documents = [self._convert_document(document, doc_format) for document in self._get_doc_list()]
+        if doc_format in ('list-etree', 'list-string'):
+            return documents
+        return dict(documents)
 
-        if doc_format == 'dict':
-            return dict([(get_doc_id(document, self._id_xpath), etree_to_dict(document)['document']) for
-                        document in self._get_doc_list()])
-        elif doc_format == 'etree':
-            return dict([(get_doc_id(document, self._id_xpath), document) for
-                        document in self._get_doc_list()])
-        elif doc_format == 'list-etree':
-            return self._get_doc_list()
-        elif doc_format == 'list-string':
-            return list([(ET.tostring(document)) for
-                        document in self._get_doc_list()])
-        elif doc_format in ('', None, 'string'):
-            return dict([(get_doc_id(document, self._id_xpath), ET.tostring(document)) for
-                        document in self._get_doc_list()])
-        else:
-            raise ParameterError("doc_format=" + doc_format)
+    def iter_documents(self, doc_format='dict'):
+        """ Iterate over the documents returned from Storage in the returned order.
+
+            For streamed responses (see the stream argument of Request) documents are parsed straight
+            from the connection as they arrive and dropped from the response after they are yielded,
+            so only one document at a time is kept in memory. Such response can be iterated only once.
+
+            Keyword args:
+                doc_format -- See get_documents().
+
+            Returns:
+                A generator of (id, document) pairs, or just documents for 'list-etree' and 'list-string' formats.
+
+            Raises:
+                ParameterError -- The doc_format value is not allowed.
+        """
+        if doc_format not in _DOC_FORMATS:
+            raise ParameterError("doc_format=" + str(doc_format))
+        if self._stream is None:
+            for document in self._get_doc_list():
+                yield self._convert_document(document, doc_format)
+            return
+        while self._in_results:
+            document = self._advance()
+            if document is _RESULTS_END or document is _END:
+                break
+            converted = self._convert_document(document, doc_format)
+            self._results.remove(document)
+            if doc_format not in ('etree', 'list-etree'):
+                document.clear()
+            yield converted
+        self._consume()
 
     @property
     def found(self):
@@ -305,6 +520,7 @@ class SearchResponse(ListResponse):
                                     } // Repeated for every term.
                     } // Repeated for every facet.
         """
+        self._consume()
         return dict([(facet.attrib['path'], dict([(term.text, int(term.attrib['hits']))
                                                   for term in facet.findall('term')]))
                      for facet in self._content.findall('facet')])
@@ -315,6 +531,7 @@ class SearchResponse(ListResponse):
             Returns:
                 A dict in with queries as keys and results as values.
         """
+        self._consume()
         return dict([(aggregate.find('query').text, [(ET.tostring(data).lstrip('<data xmlns:cps="www.clusterpoint.com" xmlns:cpse="www.clusterpoint.com">').strip().rstrip("</data>")) for data in aggregate.findall('data')])
                    for aggregate in self._content.findall('aggregate')])
 
@@ -18,6 +18,38 @@
 from __future__ import print_function
 
 import re
+import sys
+import threading
+import time
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    try:
+        if not sys.platform.startswith('linux'):
+            raise ImportError("CLOCK_MONOTONIC id is only known for Linux.")
+        import ctypes
+        import ctypes.util
+
+        class _timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'),
+                                     use_errno=True).clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        _CLOCK_MONOTONIC = 1    # Linux value of CLOCK_MONOTONIC.
+
+        def monotonic():
+            """ Seconds from a clock that isn't affected by system time changes."""
+            spec = _timespec()
+            if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(spec)):
+                raise OSError(ctypes.get_errno(), "clock_gettime failed")
+            return spec.tv_sec + spec.tv_nsec * 1e-9
+
+        monotonic()
+    except (ImportError, AttributeError, TypeError, OSError):
+        monotonic = time.time   # No monotonic clock available, system time is the best we have.
+
 
 def version_parse(version):
     return [int(x) for x in re.sub(r'(\.0+)*$','', version).split(".")]
@@ -69,3 +101,71 @@ class RawXML(object):
             raw_string -- The wraped string.
     """
         self.raw_string = raw_string
+
+
+class Future(object):
+    """ Placeholder for a result that is made available later, by another thread or an event loop."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        """ Return True if the result or exception is set."""
+        return self._done
+
+    def result(self, timeout=None):
+        """ Wait for and return the result, or raise the exception, the future was completed with.
+
+            Keyword args:
+                timeout -- Seconds to wait for the result. Default is None - wait forever.
+
+            Raises:
+                RuntimeError -- The result is not available in timeout seconds.
+        """
+        with self._condition:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise RuntimeError("Result not available in {0} seconds.".format(timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """ Wait for the future to complete and return the exception it failed with or None."""
+        try:
+            self.result(timeout)
+        except RuntimeError:
+            if not self._done:
+                raise
+        except Exception:
+            pass
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """ Call callback with this future as the only argument when it completes, or right away if it has."""
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, result):
+        self._complete(result, None)
+
+    def set_exception(self, exception):
+        self._complete(None, exception)
+
+    def _complete(self, result, exception):
+        with self._condition:
+            self._result = result
+            self._exception = exception
+            self._done = True
+            callbacks, self._callbacks = self._callbacks, []
+            self._condition.notify_all()
+        for callback in callbacks:
+            callback(self)